@@ -1,12 +1,58 @@
-from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import SystemMessage
 from datetime import datetime
 
 if __package__ is None or __package__ == '':
-    from utils.text_generation import generate, generate_with_docs
+    from utils.text_generation import (generate, generate_with_docs, agenerate, stream_with_docs, astream_with_docs,
+                                       stream_with_docs_and_history, astream_with_docs_and_history)
+    from utils.chat_history import HistoryManager
 else:
-    from .utils.text_generation import generate, generate_with_docs
+    from .utils.text_generation import (generate, generate_with_docs, agenerate, stream_with_docs, astream_with_docs,
+                                        stream_with_docs_and_history, astream_with_docs_and_history)
+    from .utils.chat_history import HistoryManager
 
-debug = True
+# Keeps the history sent with each chat turn within a token budget, summarizing older turns per (userid, chatid)
+history_manager = HistoryManager()
+
+
+class ChatMessageHistory(BaseChatMessageHistory):
+    # In-memory chat history. Same as langchain_community's ChatMessageHistory, whose package import loads every
+    # history backend and adds about a second to cold start.
+    def __init__(self, messages=None):
+        self.messages = list(messages or [])
+
+    def add_message(self, message):
+        self.messages.append(message)
+
+    def clear(self):
+        self.messages = []
+
+
+def _history_key(userid, chatid):
+    # chat IDs are only unique per user, so summaries are cached per (userid, chatid); no chatid caches nothing
+    return None if chatid is None else (userid, chatid)
+
+
+def _build_chat_history(summary, messages):
+    chat_history = ChatMessageHistory(messages=[])  # remove messages=[] if causing issues
+    if summary:
+        chat_history.add_message(SystemMessage(content="Summary of the earlier conversation: " + summary))
+    for i in range(len(messages)):
+        if i % 2 == 0:
+            chat_history.add_user_message(messages[i])
+        else:
+            chat_history.add_ai_message(messages[i])
+    return chat_history
+
+
+def _stream_event(chunk, answer, sources):
+    # Turns a retrieval chain chunk into a token event (or None), collecting the answer and source metadata on the way
+    if "context" in chunk:
+        sources.extend(doc.metadata for doc in chunk["context"])
+    if chunk.get("answer"):
+        answer.append(chunk["answer"])
+        return {"type": "token", "content": chunk["answer"]}
+    return None
 
 
 class Agent:
@@ -17,6 +63,25 @@ class Agent:
     def __repr__(self):
         return f"Agent({self.name}, {self.description})"
 
+    def respond(self, prompt_meta, user_name, user_description, user_input, temperature=0.7):
+        """
+        Generates a response to the user input without retrieval or chat history.
+
+        Parameters:
+        - prompt_meta (str): A formattable string used as a part of the system prompt.
+        - user_name (str): The name the user inputting text will be identified as.
+        - user_description (str): Unused parameter.
+        - user_input (str): The user input used in generation.
+        - temperature (float, optional): Parameter controlling the randomness of the response generation. Defaults to 0.7.
+
+        Returns:
+        - str: The response generated based on the user input.
+        """
+        prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
+        response = generate(user_input, prompt_meta.format(prompt), temperature=temperature)
+
+        return response
+
     def respond_with_docs(self, prompt_meta, user_name, user_description, user_input, retriever, temperature=0.7):
         """
         Generates a response to the user input with Retrival Augmented Generation (RAG).
@@ -37,11 +102,9 @@ class Agent:
         prompt = f"You are {self.name}. {self.description} It is currently {now}. You are interacting with {user_name}. "
         response = generate(user_input, prompt_meta.format(prompt), retriever=retriever, temperature=temperature)
 
-        if debug: print(f"============Agent Prompt============\n{prompt}\n\n")
-
         return response
 
-    def respond_with_docs_and_history(self, system_prompt, user_name, user_description, user_input, retriever, messages, temperature=0.7):
+    def respond_with_docs_and_history(self, system_prompt, user_name, user_description, user_input, retriever, messages, temperature=0.7, chatid=None, userid=None):
         """
         Generates a response to the user input with Retrival Augmented Generation (RAG) and chat history.
 
@@ -53,6 +116,9 @@ class Agent:
         - retriever (obj): The retriever object used to fetch relevant information from the vector store.
         - messages (list): The chat history used in generation. Even indices are user messages and odd indices are AI responses.
         - temperature (float, optional): Parameter controlling the randomness of the response generation. Defaults to 0.7.
+        - chatid (str, optional): The ID of the chat, used to cache the summary of turns that no longer fit in the
+          history token budget and to reuse the chat's last retrieval on follow-up turns. Defaults to None (nothing cached).
+        - userid (str, optional): The ID of the user the chat belongs to; chats are cached per (userid, chatid). Defaults to None.
 
         Returns:
         - str: The response generated based on the user input and additional information.
@@ -60,19 +126,131 @@ class Agent:
         prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
 
         # Build chat history
-        chat_history = ChatMessageHistory(messages=[])  # remove messages=[] if causing issues
-        for i in range(len(messages)):
-            if i % 2 == 0:
-                chat_history.add_user_message(messages[i])
-            else:
-                chat_history.add_ai_message(messages[i])
+        chat_history = _build_chat_history(*history_manager.build(_history_key(userid, chatid), messages))
 
         def get_chat_history(session_id: str = None):
             return chat_history
 
-        response = generate(user_input, system_prompt.format(prompt), get_chat_history, retriever, temperature=temperature)
+        response = generate(user_input, system_prompt.format(prompt), get_chat_history, retriever, temperature=temperature,
+                            chatid=chatid, userid=userid)
+
+        return response
+
+    async def arespond(self, prompt_meta, user_name, user_description, user_input, temperature=0.7):
+        """
+        Awaitable version of respond(). Takes the same parameters and returns the same response.
+        """
+        prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
+        response = await agenerate(user_input, prompt_meta.format(prompt), temperature=temperature)
+
+        return response
+
+    async def arespond_with_docs(self, prompt_meta, user_name, user_description, user_input, retriever, temperature=0.7):
+        """
+        Awaitable version of respond_with_docs(). Takes the same parameters and returns the same response.
+        """
+        now = datetime.now()
+
+        prompt = f"You are {self.name}. {self.description} It is currently {now}. You are interacting with {user_name}. "
+        response = await agenerate(user_input, prompt_meta.format(prompt), retriever=retriever, temperature=temperature)
+
+        return response
+
+    async def arespond_with_docs_and_history(self, system_prompt, user_name, user_description, user_input, retriever, messages, temperature=0.7, chatid=None, userid=None):
+        """
+        Awaitable version of respond_with_docs_and_history(). Takes the same parameters and returns the same response.
+        """
+        prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
+
+        chat_history = _build_chat_history(*await history_manager.abuild(_history_key(userid, chatid), messages))
+
+        def get_chat_history(session_id: str = None):
+            return chat_history
 
-        if debug: print(f"============Chat History============\n{get_chat_history()}\n\n")
-        if debug: print(f"============Agent Prompt============\n{prompt}\n\n")
+        response = await agenerate(user_input, system_prompt.format(prompt), get_chat_history, retriever, temperature=temperature,
+                                   chatid=chatid, userid=userid)
 
         return response
+
+    def stream_respond_with_docs(self, prompt_meta, user_name, user_description, user_input, retriever, temperature=0.7):
+        """
+        Streaming version of respond_with_docs(). Takes the same parameters. Closing the generator early stops the
+        generation.
+
+        Yields:
+        - dict: {"type": "token", "content": str} for each answer token as it arrives, then a final
+          {"type": "end", "response": str, "sources": list} with the full stripped response and the metadata of the
+          retrieved documents.
+        """
+        now = datetime.now()
+
+        prompt = f"You are {self.name}. {self.description} It is currently {now}. You are interacting with {user_name}. "
+
+        answer, sources = [], []
+        for chunk in stream_with_docs(user_input, prompt_meta.format(prompt), retriever, temperature=temperature):
+            event = _stream_event(chunk, answer, sources)
+            if event is not None:
+                yield event
+
+        yield {"type": "end", "response": "".join(answer).strip(), "sources": sources}
+
+    async def astream_respond_with_docs(self, prompt_meta, user_name, user_description, user_input, retriever, temperature=0.7):
+        """
+        Async generator version of stream_respond_with_docs(). Takes the same parameters and yields the same events.
+        """
+        now = datetime.now()
+
+        prompt = f"You are {self.name}. {self.description} It is currently {now}. You are interacting with {user_name}. "
+
+        answer, sources = [], []
+        async for chunk in astream_with_docs(user_input, prompt_meta.format(prompt), retriever, temperature=temperature):
+            event = _stream_event(chunk, answer, sources)
+            if event is not None:
+                yield event
+
+        yield {"type": "end", "response": "".join(answer).strip(), "sources": sources}
+
+    def stream_respond_with_docs_and_history(self, system_prompt, user_name, user_description, user_input, retriever, messages, temperature=0.7, chatid=None, userid=None):
+        """
+        Streaming version of respond_with_docs_and_history(). Takes the same parameters.
+
+        Yields:
+        - dict: {"type": "token", "content": str} for each answer token as it arrives, then a final
+          {"type": "end", "response": str, "sources": list} with the full stripped response and the metadata of the
+          retrieved documents.
+        """
+        prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
+
+        chat_history = _build_chat_history(*history_manager.build(_history_key(userid, chatid), messages))
+
+        def get_chat_history(session_id: str = None):
+            return chat_history
+
+        answer, sources = [], []
+        for chunk in stream_with_docs_and_history(user_input, system_prompt.format(prompt), retriever, get_chat_history,
+                                                  temperature=temperature, chatid=chatid, userid=userid):
+            event = _stream_event(chunk, answer, sources)
+            if event is not None:
+                yield event
+
+        yield {"type": "end", "response": "".join(answer).strip(), "sources": sources}
+
+    async def astream_respond_with_docs_and_history(self, system_prompt, user_name, user_description, user_input, retriever, messages, temperature=0.7, chatid=None, userid=None):
+        """
+        Async generator version of stream_respond_with_docs_and_history(). Takes the same parameters and yields the same events.
+        """
+        prompt = f"You are {self.name}. {self.description} You are interacting with {user_name}. "
+
+        chat_history = _build_chat_history(*await history_manager.abuild(_history_key(userid, chatid), messages))
+
+        def get_chat_history(session_id: str = None):
+            return chat_history
+
+        answer, sources = [], []
+        async for chunk in astream_with_docs_and_history(user_input, system_prompt.format(prompt), retriever, get_chat_history,
+                                                         temperature=temperature, chatid=chatid, userid=userid):
+            event = _stream_event(chunk, answer, sources)
+            if event is not None:
+                yield event
+
+        yield {"type": "end", "response": "".join(answer).strip(), "sources": sources}
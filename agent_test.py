@@ -0,0 +1,158 @@
+import asyncio
+
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import main
+    import generate_quizzes
+    import agent as agent_module
+    from agent import Agent
+    from utils.chat_history import HistoryManager
+    from utils.text_generation import set_llm_factory
+    from utils.rubric_cache import RubricCache
+else:
+    from . import main
+    from . import generate_quizzes
+    from . import agent as agent_module
+    from .agent import Agent
+    from .utils.chat_history import HistoryManager
+    from .utils.text_generation import set_llm_factory
+    from .utils.rubric_cache import RubricCache
+
+
+class InMemoryRetriever(BaseRetriever):
+    """Retriever that returns a fixed list of documents, so tests never touch the database."""
+
+    documents: list
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.documents
+
+
+def _use_fake_llm(responses):
+    set_llm_factory(lambda model_name, temperature: FakeListChatModel(responses=responses))
+
+
+def _retriever():
+    return InMemoryRetriever(documents=[Document(page_content="Overfitting is when a model memorizes noise.",
+                                                 metadata={"source": "lecture3.pdf"})])
+
+
+def test_arespond_with_docs_and_history():
+    _use_fake_llm(["  What do you think causes it?  "])
+    agent = Agent("Tutor", "Tutor is a helpful AI assistant.")
+
+    response = asyncio.run(agent.arespond_with_docs_and_history("{}", "Student", "", "What is overfitting?", _retriever(),
+                                                                ["Hi", "Hello! What are we studying?"]))
+    assert response == "What do you think causes it?"
+
+
+def test_arun_chat_concurrent(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+
+    async def fake_aget_retriever():
+        return _retriever()
+    monkeypatch.setattr(main, "aget_retriever", fake_aget_retriever)
+
+    async def run_many():
+        return await asyncio.gather(*[main.arun_chat(message="What is overfitting?") for _ in range(20)])
+
+    results = asyncio.run(run_many())
+    assert len(results) == 20
+    assert all(response == "Think about the training error." for response, _ in results)
+
+
+def test_run_chat_uses_server_side_session(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+    monkeypatch.setattr(main, "get_retriever", _retriever)
+
+    async def fake_aget_retriever():
+        return _retriever()
+    monkeypatch.setattr(main, "aget_retriever", fake_aget_retriever)
+    store = main.enable_sessions(None)
+    try:
+        main.run_chat(userid="u1", chatid="c1", message="What is overfitting?")
+        asyncio.run(main.arun_chat(userid="u1", chatid="c1", message="Why?"))
+        assert store.get("u1", "c1") == ["What is overfitting?", "Think about the training error.",
+                                         "Why?", "Think about the training error."]
+
+        # clients that still send the full history replace the stored one
+        main.run_chat(userid="u1", chatid="c1", message="Hi", previous_messages=["Earlier", "Yes."])
+        assert store.get("u1", "c1") == ["Earlier", "Yes.", "Hi", "Think about the training error."]
+    finally:
+        main.disable_sessions()
+
+
+def test_history_summaries_are_kept_per_user(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+    monkeypatch.setattr(main, "get_retriever", _retriever)
+    summarized = []
+
+    def summarize(summary, messages):
+        summarized.append(messages[0])
+        return "Earlier: " + " ".join(messages)
+    monkeypatch.setattr(agent_module, "history_manager", HistoryManager(token_budget=60, summarize=summarize,
+                                                                        count_tokens=lambda text: len(text.split())))
+
+    histories = {userid: [userid + " asked about topic " + str(i) for i in range(12)] for userid in ["u1", "u2"]}
+    for _ in range(2):
+        for userid in ["u1", "u2"]: # both clients use the default chatid
+            main.run_chat(userid=userid, message="Why?", previous_messages=histories[userid])
+
+    # each user's older turns are summarized once, and never with the other user's
+    assert summarized == ["u1 asked about topic 0", "u2 asked about topic 0"]
+
+
+def test_stream_chat(monkeypatch):
+    _use_fake_llm(["Think about it. "])
+    monkeypatch.setattr(main, "get_retriever", _retriever)
+
+    events = list(main.stream_chat(message="What is overfitting?"))
+    tokens = [event["content"] for event in events if event["type"] == "token"]
+    assert len(tokens) > 1
+    assert "".join(tokens) == "Think about it. "
+    assert events[-1]["type"] == "end"
+    assert events[-1]["response"] == "Think about it."
+    assert events[-1]["sources"] == [{"source": "lecture3.pdf"}]
+    assert "datetime" in events[-1]
+
+
+def test_astream_respond_with_docs_and_history():
+    _use_fake_llm(["Think about it."])
+    agent = Agent("Tutor", "Tutor is a helpful AI assistant.")
+
+    async def collect():
+        return [event async for event in agent.astream_respond_with_docs_and_history("{}", "Student", "", "What is overfitting?",
+                                                                                     _retriever(), [])]
+
+    events = asyncio.run(collect())
+    assert "".join(event["content"] for event in events[:-1]) == "Think about it."
+    assert events[-1] == {"type": "end", "response": "Think about it.", "sources": [{"source": "lecture3.pdf"}]}
+
+
+def test_agrade_quiz(monkeypatch):
+    _use_fake_llm(["yes, yes, no, yes"])
+    monkeypatch.setattr(generate_quizzes, "rubric_cache", RubricCache(":memory:"))
+    questions = [
+        {"question": "A Lasso regularizer acts as a feature selector.", "type": "TRUE_FALSE", "answers": "True", "user_answer": "True"},
+        {"question": "Neural networks are more interpretable than linear regression.", "type": "TRUE_FALSE", "answers": "False", "user_answer": "True"},
+        {"question": "What is the difference between L1 and L2 regularization?", "type": "SHORT_ANSWER",
+         "answers": "L1 penalizes absolute values, L2 penalizes squares.", "user_answer": "L1 uses absolute values."},
+    ]
+
+    final_score, question_scores, code_errors = asyncio.run(generate_quizzes.agrade_quiz(questions))
+    assert question_scores == [1, 0, 0.75]
+    assert code_errors == [None]
+    assert final_score == 1.75 / 3
+
+
+def run_tests():
+    import pytest
+    pytest.main([__file__, "-q"])
+
+
+if __name__ == '__main__':
+    run_tests()
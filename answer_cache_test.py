@@ -0,0 +1,61 @@
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import main
+    from agent_test import _retriever
+    from utils.answer_cache import SemanticAnswerCache
+    from utils.embeddings_cache import CachedEmbeddings
+    from utils.text_generation import set_llm_factory
+else:
+    from . import main
+    from .agent_test import _retriever
+    from .utils.answer_cache import SemanticAnswerCache
+    from .utils.embeddings_cache import CachedEmbeddings
+    from .utils.text_generation import set_llm_factory
+
+
+def _cache(**kwargs):
+    # normalization in CachedEmbeddings makes differently spaced/cased questions embed identically
+    return SemanticAnswerCache(CachedEmbeddings(DeterministicFakeEmbedding(size=16), persist=False), **kwargs)
+
+
+def test_lookup_store_and_invalidate():
+    cache = _cache()
+
+    assert cache.lookup("corpus", "What is overfitting?")[0] is None
+    cache.store("corpus", "What is overfitting?", "Think about training error.")
+
+    assert cache.lookup("corpus", "what is  overfitting?")[0] == "Think about training error."
+    assert cache.lookup("other", "What is overfitting?")[0] is None
+    assert cache.lookup("corpus", "What is a kernel?")[0] is None
+
+    cache.invalidate("corpus")
+    assert cache.lookup("corpus", "What is overfitting?")[0] is None
+    assert cache.stats() == {"hits": 1, "misses": 4, "size": 0}
+
+
+def test_lru_eviction():
+    cache = _cache(max_size=2)
+    cache.store("corpus", "a", "A")
+    cache.store("corpus", "b", "B")
+    cache.lookup("corpus", "a")
+    cache.store("corpus", "c", "C")
+
+    assert cache.lookup("corpus", "a")[0] == "A"
+    assert cache.lookup("corpus", "b")[0] is None
+    assert cache.stats()["size"] == 2
+
+
+def test_run_chat_uses_cache_for_first_turn_only(monkeypatch):
+    set_llm_factory(lambda model_name, temperature: FakeListChatModel(responses=["First answer.", "Second answer."]))
+    retrievers = []
+    monkeypatch.setattr(main, "get_retriever", lambda: retrievers.append(_retriever()) or retrievers[-1])
+    monkeypatch.setattr(main, "answer_cache", _cache())
+
+    assert main.run_chat(message="What is overfitting?")[0] == "First answer."
+    assert main.run_chat(message="what is overfitting?")[0] == "First answer."
+    assert len(retrievers) == 1 # a cache hit does not load the vector store
+    # follow-up turns depend on the history, so they are generated
+    assert main.run_chat(message="What is overfitting?", previous_messages=["Hi", "Hello!"])[0] == "Second answer."
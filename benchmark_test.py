@@ -0,0 +1,24 @@
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.benchmark import run_benchmark, build_corpus, FakeEmbeddings, SCENARIOS
+else:
+    from .utils.benchmark import run_benchmark, build_corpus, FakeEmbeddings, SCENARIOS
+
+
+def test_benchmark_runs_every_scenario_offline():
+    results = run_benchmark(concurrency_levels=[1, 3], requests=3, llm_latency=0, embedding_latency=0)
+
+    assert [(result["scenario"], result["concurrency"]) for result in results] == [
+        (scenario, concurrency) for scenario in SCENARIOS for concurrency in [1, 3]]
+    for result in results:
+        assert result["errors"] == 0
+        assert result["p50"] <= result["p95"] <= result["p99"]
+        assert result["throughput"] > 0
+
+
+def test_in_memory_vectorstore_search():
+    vectorstore = build_corpus(FakeEmbeddings(latency=0), num_documents=50)
+
+    assert vectorstore.similarity_search("Lecture notes on clustering, part 5.", k=1)[0].metadata["page"] == 5
+    documents = vectorstore.search("Lecture notes on clustering, part 5.", "mmr", k=4)
+    assert len(documents) == 4 and documents[0].metadata["page"] == 5
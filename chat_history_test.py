@@ -0,0 +1,75 @@
+import asyncio
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.chat_history import HistoryManager, MESSAGE_TOKEN_OVERHEAD
+else:
+    from .utils.chat_history import HistoryManager, MESSAGE_TOKEN_OVERHEAD
+
+
+def _manager(budget_messages, calls):
+    # every message is 10 words, so the budget holds exactly budget_messages messages
+    def summarize(summary, messages):
+        calls.append(list(messages))
+        return (summary + " " if summary else "") + "+".join(messages)
+
+    async def asummarize(summary, messages):
+        return summarize(summary, messages)
+
+    return HistoryManager(token_budget=budget_messages * (10 + MESSAGE_TOKEN_OVERHEAD), summarize=summarize,
+                          asummarize=asummarize, count_tokens=lambda text: len(text.split()))
+
+
+def _messages(n):
+    return [("m" + str(i) + " ") * 10 for i in range(n)]
+
+
+def test_short_history_is_sent_verbatim():
+    calls = []
+    manager = _manager(8, calls)
+
+    assert manager.build("chat", _messages(6)) == ("", _messages(6))
+    assert calls == []
+
+
+def test_older_turns_are_folded_into_a_cached_summary():
+    calls = []
+    manager = _manager(8, calls)
+
+    summary, recent = manager.build("chat", _messages(10))
+    # folds down to half the budget, on a user message
+    assert recent == _messages(10)[6:]
+    assert calls == [_messages(10)[:6]]
+
+    # the next turns fit again next to the cached summary, no new summary call
+    assert manager.build("chat", _messages(12)) == (summary, _messages(12)[6:])
+    assert len(calls) == 1
+
+    # once they don't, only the newly dropped turns are summarized
+    new_summary, recent = manager.build("chat", _messages(16))
+    assert calls[1] == _messages(16)[6:12]
+    assert new_summary.startswith(summary) and recent == _messages(16)[12:]
+
+
+def test_edited_history_is_summarized_again():
+    calls = []
+    manager = _manager(8, calls)
+    manager.build("chat", _messages(10))
+
+    edited = ["edited " * 10] + _messages(10)[1:]
+    summary, recent = asyncio.run(manager.abuild("chat", edited))
+    assert calls[-1] == edited[:6]
+    assert summary == "+".join(edited[:6])
+
+
+def test_summaries_are_cached_per_chat():
+    calls = []
+    manager = _manager(8, calls)
+
+    manager.build("a", _messages(10))
+    manager.build("b", _messages(10))
+    manager.build("a", _messages(10))
+    manager.build(None, _messages(10))
+    manager.build(None, _messages(10))
+
+    assert len(calls) == 4
@@ -0,0 +1,71 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import pytest
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.code_runner import CodeRunnerClient, CodeRunnerError, StubCodeRunner
+else:
+    from .utils.code_runner import CodeRunnerClient, CodeRunnerError, StubCodeRunner
+
+
+def test_run_reports_syntax_errors():
+    with StubCodeRunner() as runner:
+        client = CodeRunnerClient(runner.url)
+        assert client.run("print(1)") == {"ran": True, "errors": "", "status_code": 200}
+        result = client.run("def f(:")
+        assert result["status_code"] == 400 and result["errors"].startswith("SyntaxError")
+        client.close()
+
+
+def test_failing_code_reported_with_http_400_is_a_result():
+    with StubCodeRunner(mirror_status=True) as runner:
+        client = CodeRunnerClient(runner.url)
+        result = client.run("def f(:")
+        assert result["status_code"] == 400 and result["errors"].startswith("SyntaxError")
+        assert len(runner.requests) == 1 # not retried
+        client.close()
+
+
+def test_identical_submissions_are_run_once():
+    with StubCodeRunner() as runner:
+        client = CodeRunnerClient(runner.url)
+        codes = ["x = 1", "x = 2", "x = 1", "x = 1"]
+
+        results = [future.result() for future in client.submit_many(codes)]
+        assert [result["ran"] for result in results] == [True] * 4
+        assert client.run("x = 2")["ran"]
+
+        assert sorted(runner.requests) == ["x = 1", "x = 2"]
+        client.close()
+
+
+def test_retries_server_errors_with_backoff():
+    attempts = []
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            attempts.append(1)
+            body = b'{"ran": true, "errors": "", "status_code": 200}'
+            self.send_response(503 if len(attempts) < 3 else 200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = "http://127.0.0.1:" + str(server.server_address[1]) + "/runcode"
+        assert CodeRunnerClient(url, backoff=0.01).run("pass")["status_code"] == 200
+        assert len(attempts) == 3
+
+        attempts.clear()
+        with pytest.raises(CodeRunnerError):
+            CodeRunnerClient(url, retries=1, backoff=0.01).run("pass")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,77 @@
+from langchain_core.documents import Document
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from agent_test import InMemoryRetriever
+    from utils.chat_history import count_tokens
+    from utils.context_packing import pack_documents, set_token_budget
+    from utils.text_generation import generate_with_docs, set_llm_factory
+    from utils import tracing
+else:
+    from .agent_test import InMemoryRetriever
+    from .utils.chat_history import count_tokens
+    from .utils.context_packing import pack_documents, set_token_budget
+    from .utils.text_generation import generate_with_docs, set_llm_factory
+    from .utils import tracing
+
+LECTURE = " ".join("Sentence " + str(i) + " of the lecture on regularization and overfitting." for i in range(200))
+
+
+def _document(text, source="lecture3.pdf"):
+    return Document(page_content=text, metadata={"source": source})
+
+
+def test_duplicates_and_chunk_overlap_are_removed():
+    first, second = LECTURE[:1000], LECTURE[800:1800] # consecutive chunks sharing 200 characters
+    packed, report = pack_documents([_document(first), _document("  " + first.upper()), _document(second),
+                                     _document(LECTURE[100:300])], budget=10000)
+
+    assert [document.page_content for document in packed] == [first, LECTURE[1000:1800].strip()]
+    assert packed[0].metadata == packed[1].metadata == {"source": "lecture3.pdf"}
+    assert (report["kept"], report["duplicates"], report["truncated"]) == (2, 2, 0)
+    assert report["tokens_saved"] == report["tokens_in"] - report["tokens_out"] > 0
+
+
+def test_documents_are_picked_by_relevance_and_truncated_to_the_budget():
+    documents = [_document(LECTURE[i * 2000:(i + 1) * 2000], "lecture" + str(i) + ".pdf") for i in range(4)]
+    packed, report = pack_documents(documents, budget=700)
+
+    assert [document.metadata["source"] for document in packed] == ["lecture0.pdf", "lecture1.pdf"]
+    assert packed[0].page_content == documents[0].page_content
+    assert documents[1].page_content.startswith(packed[1].page_content)
+    assert report["truncated"] == 1
+    assert report["tokens_out"] == sum(count_tokens(document.page_content) for document in packed) <= 700
+
+
+def test_retrieval_chain_packs_context_and_reports_savings():
+    prompts = []
+
+    class RecordingModel:
+        def __call__(self, model_name, temperature):
+            from langchain_community.chat_models.fake import FakeListChatModel
+
+            class Model(FakeListChatModel):
+                def _call(self, messages, *args, **kwargs):
+                    prompts.append("\n".join(str(message.content) for message in messages))
+                    return super()._call(messages, *args, **kwargs)
+            return Model(responses=["Regularization."])
+
+    set_llm_factory(RecordingModel())
+    retriever = InMemoryRetriever(documents=[_document(LECTURE[:4000]), _document(LECTURE[:4000]),
+                                             _document(LECTURE[4000:8000])])
+    sink = tracing.enable_tracing()
+    try:
+        set_token_budget(300)
+        assert generate_with_docs("What is regularization?", "", retriever) == "Regularization."
+        packed_prompt = prompts[-1]
+        set_token_budget(None)
+        generate_with_docs("What is regularization?", "", retriever)
+    finally:
+        set_token_budget()
+        tracing.disable_tracing()
+        set_llm_factory()
+
+    assert count_tokens(packed_prompt) < 500 < count_tokens(prompts[-1])
+    stats = sink.snapshot()["context_packing"]
+    assert stats["count"] == 1 and stats["kept"] == 1 and stats["tokens_out"] <= 300
+    assert stats["tokens_saved"] == stats["tokens_in"] - stats["tokens_out"] > 0
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.embeddings_cache import CachedEmbeddings
+else:
+    from .utils.embeddings_cache import CachedEmbeddings
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    calls: int = 0
+    texts: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts += len(texts)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.calls += 1
+        self.texts += 1
+        return super().embed_query(text)
+
+
+def test_memory_hits_and_normalization(tmp_path):
+    inner = CountingEmbeddings(size=8)
+    cached = CachedEmbeddings(inner, cache_dir=str(tmp_path))
+
+    first = cached.embed_query("Backpropagation")
+    assert cached.embed_query("  backpropagation ") == first
+    assert cached.embed_documents(["Backpropagation", "ensemble learning", "ensemble  learning"])[0] == first
+
+    assert inner.texts == 2  # "Backpropagation" once, "ensemble learning" once
+    stats = cached.stats()
+    assert stats["misses"] == 2 and stats["hits"] == 2
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    inner = CountingEmbeddings(size=8)
+    vector = CachedEmbeddings(inner, cache_dir=str(tmp_path)).embed_query("overfitting")
+
+    restarted = CachedEmbeddings(inner, cache_dir=str(tmp_path), max_size=1)
+    assert restarted.embed_query("overfitting") == vector
+    assert inner.texts == 1
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_ttl_and_lru(tmp_path):
+    inner = CountingEmbeddings(size=8)
+    cached = CachedEmbeddings(inner, max_size=2, ttl=0.05, persist=False)
+
+    cached.embed_documents(["a", "b", "c"])
+    assert cached.stats()["memory_size"] == 2
+
+    time.sleep(0.1)
+    cached.embed_query("c")
+    assert inner.texts == 4
+
+
+def test_async(tmp_path):
+    inner = CountingEmbeddings(size=8)
+    cached = CachedEmbeddings(inner, cache_dir=str(tmp_path))
+
+    vectors = asyncio.run(cached.aembed_documents(["svm", "kernel trick", "svm"]))
+    assert vectors[0] == vectors[2]
+    assert asyncio.run(cached.aembed_query("SVM")) == vectors[0]
+    assert inner.texts == 2
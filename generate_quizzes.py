@@ -1,17 +1,35 @@
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from better_profanity import profanity
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FuturesTimeoutError, wait
+import contextvars
+import threading
+import asyncio
+import time
 import os
-import json
-import re
-import requests
 
 # fix errors when importing locally versus as submodule
 if __package__ is None or __package__ == '':
     from agent import Agent
-    from utils.vectorstore import load_vectorstore
+    from utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore
+    from utils.quiz_bank import QuizBank, QUIZ_BANK_PATH
+    from utils.quiz_parser import QuizStreamParser, QuizFormatError
+    from utils.rubric_cache import RubricCache, RUBRIC_CACHE_PATH
+    from utils.code_runner import CodeRunnerClient
+    from utils.moderation import censor
+    from utils.tracing import span
+    from utils.llm_scheduler import llm_priority, BACKGROUND
+    from utils.single_flight import SingleFlight
+    from utils.embeddings_cache import normalize_text
 else:
     from .agent import Agent
-    from .utils.vectorstore import load_vectorstore
+    from .utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore
+    from .utils.quiz_bank import QuizBank, QUIZ_BANK_PATH
+    from .utils.quiz_parser import QuizStreamParser, QuizFormatError
+    from .utils.rubric_cache import RubricCache, RUBRIC_CACHE_PATH
+    from .utils.code_runner import CodeRunnerClient
+    from .utils.moderation import censor
+    from .utils.tracing import span
+    from .utils.llm_scheduler import llm_priority, BACKGROUND
+    from .utils.single_flight import SingleFlight
+    from .utils.embeddings_cache import normalize_text
 
 
 
@@ -44,253 +62,666 @@ def _parse_quiz(quiz, numQs, topics, types):
     # 4. ...
     ###############
 
-    body = {"questions": []}
-
-    # traverse each question
-    split_quiz = quiz.split("------DIVIDER------\n")
-    for section in split_quiz:
-
-        question = ""
-        topic = ""
-        type = ""
-        choices = ""
-        answer = ""
-
-        # skip blank question sections (i.e. if divider is at end of quiz)
-        if section == "" or section == "\n": continue
-
-        # traverse each line
-        lines = section.split("\n")
-        within_answer = False # flag for handling multi-line answers (for coding questions)
-        for line in lines:
-
-            question_pattern = re.compile(r'\d+\.')
-            topic_pattern = re.compile(r'Topic: ')
-            type_pattern = re.compile(r'Type: ')
-            answer_pattern = re.compile(r'Answer: ')
-            choices_pattern = re.compile(r'[A-D]\) ') # for MC questions specifically
-
-            # search each line for applicable patterns
-            if within_answer: # for handling multi-line answers (for coding questions)
-                answer += line
-            if question_pattern.search(line):
-                question = line.split(". ")[1]
-            elif topic_pattern.search(line):
-                topic = line.split(": ")[1]
-            elif type_pattern.search(line):
-                type = line.split(": ")[1]
-            elif answer_pattern.search(line):
-                within_answer = True
-                answer += line.split(": ")[1]
-            elif choices_pattern.search(line):
-                choices += line.split(") ")[1] + "@"
-
-        # check question-specific conditions of incorrect quiz format:
-        # if question is MULTIPLE_CHOICE but does not have exactly 4 answer choices
-        if (type == "MULTIPLE_CHOICE" and len(choices[:-2].split("@")) != 4):
-            print('ERROR: mc question does not have exactly 4 choices\nCHOICES: ' + choices + '\nQUIZ:\n' + quiz)
-            return False
-        # if question is TRUE_FALSE but does not have exactly 2 answer choices
-        if (type == "TRUE_FALSE" and len(choices[:-2].split("@")) != 2): # -2 to remove comma at end
-            print('ERROR: tf question does not have exactly 2 choices\nCHOICES: ' + choices + '\nQUIZ:\n' + quiz)
-            return False
-        # if question is not a valid type
-        if type != "MULTIPLE_CHOICE" and type != "SHORT_ANSWER" and type != "CODING" and type != "TRUE_FALSE":
-            print('ERROR: question type is not valid\nTYPE: ' + type + '\nQUIZ:\n' + quiz)
-            return False
-        # if question topic is not one of the specified topics
-        topics_split = topics.split(",")
-        validTopic = False
-        for topic_split in topics_split:
-            topic_split = topic_split[1:] if topic_split[0] == " " else topic_split # remove leading space if present
-            if topic.lower() == topic_split.lower(): # .lower to be case insensitive
-                validTopic = True
-        if not validTopic:
-            return False
+    parser = QuizStreamParser(numQs, topics, types)
+    try:
+        with span("parse", questions=numQs):
+            parser.feed(quiz)
+            return parser.close()
+    except QuizFormatError as e:
+        print('ERROR: ' + str(e))
+        return False
 
-        # append question to JSON list
-        if type == "MULTIPLE_CHOICE" or type == "TRUE_FALSE": # these types require an extra "choices" key
-            body["questions"].append({
-                "type": type,
-                "question": question,
-                "topics": topic,
-                "choices": choices[:-1], # -2 to remove '@' at end
-                "answer": answer
-            })
-        else:
-            body["questions"].append({
-                "type": type,
-                "question": question,
-                "topics": topic,
-                "choices": None,
-                "answer": answer
-            })
-
-    # check general conditions of incorrect quiz format:
-
-    # if number of questions does not match number asked for in quiz generation
-    if len(body["questions"]) != numQs:
-        print('ERROR: generated num of questions does not match expected num\nEXPECTED: ' + str(numQs) + '\nGENERATED: ' + str(len(body['questions'])) + '\nQUIZ:\n' + quiz)
+
+QUIZ_GENERATOR_NAME = "Quiz Generation AI"
+QUIZ_GENERATOR_DESCRIPTION = ("You are Quiz Generation AI. Quiz Generation AI is given a number of quiz questions, quiz topics, and quiz question "
+                              "types from which to generate a quiz.")
+
+QUIZ_GRADER_NAME = "Quiz Grader"
+QUIZ_GRADER_DESCRIPTION = ("You are Quiz Grader. Quiz Grader helps grade free response questions.")
+
+CODE_RUNNER_URL = "http://localhost:5002/runcode"
+code_runner = None # CodeRunnerClient for CODE_RUNNER_URL, created on first use
+_code_runner_lock = threading.Lock()
+CODING_SCORE_RATIO = 0.8 # 0.8 from syntax, 0.2 from running
+
+MAX_GRADING_WORKERS = 8 # max free response questions graded concurrently per quiz
+GRADING_SAMPLES = 3 # scoring attempts per SHORT_ANSWER question, the highest score counts
+GRADING_TIMEOUT = 120 # seconds a free response question may take to grade before it is scored 0
+GRADING_CALL_WORKERS = 16 # LLM and code runner calls of grading in flight at once, shared by every quiz
+
+QUIZ_CHUNK_SIZE = 5 # max questions per generation request, longer quizzes are generated in concurrent chunks
+MAX_QUIZ_WORKERS = 4 # max concurrent generation requests per quiz
+
+QUIZ_BANK_TARGET = 30 # questions per (topic, type) pair that fill_quiz_bank generates up to
+QUIZ_BANK_LOW_WATER = 10 # (topic, type) pairs with fewer questions are refilled in the background
+QUIZ_TOP_UP_ROUNDS = 3 # max live generations for the shortfall of a bank quiz, when they repeat questions already drawn
+
+# Opt-in bank of pre-generated questions, see enable_quiz_bank()
+quiz_bank = None
+_refill_executor = ThreadPoolExecutor(max_workers=1)
+_refilling = set() # (topic, type) pairs with a queued or running refill
+_refill_lock = threading.Lock()
+
+# Answer points of SHORT_ANSWER questions, extracted once per question, see enable_rubric_cache()
+rubric_cache = None # opened at RUBRIC_CACHE_PATH on first use
+_rubric_executor = ThreadPoolExecutor(max_workers=2) # extracts rubrics of newly generated questions in the background
+_grading_executor = ThreadPoolExecutor(max_workers=GRADING_CALL_WORKERS) # runs the calls of every free response question
+
+# Concurrent identical quiz generations share one live generation (i.e. a whole class opening the same assignment).
+# Set to None to generate every request separately.
+quiz_flights = SingleFlight("coalesce_generate_quiz")
+
+
+def _quiz_prompt(numQs, types, topics):
+    '''Builds the quiz generation prompt for the given number of questions, question types and (censored) topics.'''
+
+    return ("Make a quiz with exactly " + str(numQs) + "questions on the following question topics: " + topics + ", and only "
+            "using the following types of questions: " + types + ". Additional instructions: "
+            "\n\nStart immediately with the first question and no other unnecessary text like a quiz title, i.e. \"1. How does regularization work?.\""
+            "\n\nOn the line immediately after the question, list the question topic, i.e. \"Topic: topic1\"."
+            "\n\nOn the line immediately after the topic, list the question type, i.e. \"Type: MULTIPLE_CHOICE\". The type should only be one of the aforementioned types requested."
+            "\n\nFor MULTIPLE_CHOICE questions, list exactly 4 answer choices immediately following the topic, i.e. \"A) choice1\nB) choice2\nC) choice3\nD) choice4\"."
+            "\n\nFor TRUE_FALSE questions, also list the 2 true/false options immediately following the topic, i.e. \"A) True\nB) False\"."
+            "\n\nOn the immediate next line, list the answer to the question, i.e.: \"Answer: A) True\" or \"Answer: choice1\". For CODING question answers, list the full code implementation in Python within triple apostrophes."
+            "\n\nEntire questions must be separated by a line with the text \"------DIVIDER------\" and nothing else."
+            "\n\nDo not generate the quiz if the topics are highly irrelevant to a machine learning course, i.e. \"Ponies\".")
+
+            # "\n\nNext to each question, list the question topic and type of question once, i.e.: \"5. Here is a question.\nTopic: topic1\nType: MULTIPLE_CHOICE\"."
+            # "\n\nMULTIPLE_CHOICE questions will list the answer choices immediately after the \"Type\" line with no whitespace, i.e.: \"A) choice1\nB) choice2\nC) choice3\nD) choice4\""
+            # "\n\nTRUE_FALSE questions will list the true/false answer choices immediately after the \"Type\" line with no whitespace, similar to MULTIPLE_CHOICE. I.e.: \"Type: TRUE_FALSE\nA) True\nB) False\"."
+            # "\n\nFor CODING questions, ensure the \"Answer: ...\" provides the full code implementation in Python and within triple apostrophes."
+            # "\n\nSHORT_ANSWER questions should not pertain to any code or code implementations."
+            # "\n\nFor all questions, list the answer on the last relevant line for the question, i.e.: \"...\nAnswer: \". There should not be a blank line before the answer."
+            # "\n\nDo not generate a quiz if the topics are not relevant to a machine learning course.")
+
+
+def _plan_quiz_chunks(numQs, topics, chunk_size):
+    '''Splits a quiz into chunks of at most chunk_size questions, returned as a list of (number of questions, topics).
+    When there are at least as many topics as chunks, each chunk gets its own group of topics; otherwise every chunk
+    covers all topics.'''
+
+    num_chunks = max(1, -(-numQs // chunk_size)) # ceiling division
+    topic_list = [topic.strip() for topic in topics.split(",") if topic.strip() != ""]
+
+    chunks = []
+    for i in range(num_chunks):
+        chunk_numQs = numQs // num_chunks + (1 if i < numQs % num_chunks else 0)
+        chunk_topics = ", ".join(topic_list[i::num_chunks]) if len(topic_list) >= num_chunks else topics
+        chunks.append((chunk_numQs, chunk_topics))
+    return chunks
+
+
+def _merge_quiz_chunks(bodies):
+    '''Concatenates parsed quiz chunks in order, or returns False if any chunk failed.'''
+
+    if any(body == False for body in bodies):
         return False
-    
+    return {"questions": [question for body in bodies for question in body["questions"]]}
+
+
+def _stream_quiz_chunk(agent, retriever, prompt, numQs, types, topics, seeRawQuiz):
+    '''Streams one generation attempt through a QuizStreamParser. Stops consuming (and so cancels the generation) at
+    the first unrecoverable format error. Returns the parsed quiz, or False if it is not formatted properly. API and
+    network errors are raised, not retried as format errors; the LLM scheduler retries those (see set_llm_scheduler).'''
+
+    parser = QuizStreamParser(numQs, topics, types)
+    stream = agent.stream_respond_with_docs(QUIZ_GENERATOR_DESCRIPTION, "miscellaneous student", "", prompt, retriever)
+    try:
+        with span("quiz_attempt", questions=numQs):
+            for event in stream:
+                if event["type"] == "token":
+                    parser.feed(event["content"])
+            return parser.close()
+    except QuizFormatError as e:
+        print("ERROR: stopped quiz generation early: " + str(e))
+        return False
+    finally:
+        stream.close()
+        if seeRawQuiz:
+            print(parser.raw)
+
+
+async def _astream_quiz_chunk(agent, retriever, prompt, numQs, types, topics, seeRawQuiz):
+    '''Awaitable version of _stream_quiz_chunk.'''
+
+    parser = QuizStreamParser(numQs, topics, types)
+    stream = agent.astream_respond_with_docs(QUIZ_GENERATOR_DESCRIPTION, "miscellaneous student", "", prompt, retriever)
+    try:
+        with span("quiz_attempt", questions=numQs):
+            async for event in stream:
+                if event["type"] == "token":
+                    parser.feed(event["content"])
+            return parser.close()
+    except QuizFormatError as e:
+        print("ERROR: stopped quiz generation early: " + str(e))
+        return False
+    finally:
+        await stream.aclose()
+        if seeRawQuiz:
+            print(parser.raw)
+
+
+def _generate_quiz_chunk(agent, retriever, numQs, types, topics, seeRawQuiz):
+    '''Generates and parses one chunk of a quiz, with 2 retries of just this chunk if it is not formatted properly.
+    Questions are parsed as they stream in, so a badly formatted attempt is abandoned as soon as it goes wrong.'''
+
+    prompt = _quiz_prompt(numQs, types, topics)
+
+    body = False
+    with span("quiz_chunk", questions=numQs) as chunk:
+        for i in range(3):
+            body = _stream_quiz_chunk(agent, retriever, prompt, numQs, types, topics, seeRawQuiz)
+            if body != False:
+                break
+        chunk.set(retries=i, failed=int(body == False))
+
     return body
-        
 
 
-def generate_quiz(numQs, types, topics, seeRawQuiz=False):
-    '''Given a numer of question, question types, question topics, and a bool debugMode, generates and
-    returns a quiz using GPT. Takes 3 total attempts if the quiz is not formatted properly, and will
-    ultimately return False if a proper quiz is not generated.
-    
-    If seeRawQuiz is true, prints the raw generated quiz independently, before trying parsing.'''
+async def _agenerate_quiz_chunk(agent, retriever, numQs, types, topics, seeRawQuiz):
+    '''Awaitable version of _generate_quiz_chunk.'''
+
+    prompt = _quiz_prompt(numQs, types, topics)
+
+    body = False
+    with span("quiz_chunk", questions=numQs) as chunk:
+        for i in range(3):
+            body = await _astream_quiz_chunk(agent, retriever, prompt, numQs, types, topics, seeRawQuiz)
+            if body != False:
+                break
+        chunk.set(retries=i, failed=int(body == False))
+
+    return body
+
+
+def _generate_quiz_live(numQs, types, topics, seeRawQuiz=False, chunk_size=QUIZ_CHUNK_SIZE):
+    '''Generates a quiz with the LLM for already censored topics. See generate_quiz.'''
+
+    # model setup
+    agent = Agent(QUIZ_GENERATOR_NAME, QUIZ_GENERATOR_DESCRIPTION)
 
-    topics = profanity.censor(topics) # profanity check the topics
-
-    # model setup and prompting
-    name = "Quiz Generation AI"
-    description = ("You are Quiz Generation AI. Quiz Generation AI is given a number of quiz questions, quiz topics, and quiz question "
-                   "types from which to generate a quiz.")
-    
-    agent = Agent(name, description)
-
-    prompt = ("Make a quiz with exactly " + str(numQs) + "questions on the following question topics: " + topics + ", and only "
-              "using the following types of questions: " + types + ". Additional instructions: "
-              "\n\nStart immediately with the first question and no other unnecessary text like a quiz title, i.e. \"1. How does regularization work?.\""
-              "\n\nOn the line immediately after the question, list the question topic, i.e. \"Topic: topic1\"."
-              "\n\nOn the line immediately after the topic, list the question type, i.e. \"Type: MULTIPLE_CHOICE\". The type should only be one of the aforementioned types requested."
-              "\n\nFor MULTIPLE_CHOICE questions, list exactly 4 answer choices immediately following the topic, i.e. \"A) choice1\nB) choice2\nC) choice3\nD) choice4\"."
-              "\n\nFor TRUE_FALSE questions, also list the 2 true/false options immediately following the topic, i.e. \"A) True\nB) False\"."
-              "\n\nOn the immediate next line, list the answer to the question, i.e.: \"Answer: A) True\" or \"Answer: choice1\". For CODING question answers, list the full code implementation in Python within triple apostrophes."
-              "\n\nEntire questions must be separated by a line with the text \"------DIVIDER------\" and nothing else."
-              "\n\nDo not generate the quiz if the topics are highly irrelevant to a machine learning course, i.e. \"Ponies\".")
-
-                # "\n\nNext to each question, list the question topic and type of question once, i.e.: \"5. Here is a question.\nTopic: topic1\nType: MULTIPLE_CHOICE\"."
-                # "\n\nMULTIPLE_CHOICE questions will list the answer choices immediately after the \"Type\" line with no whitespace, i.e.: \"A) choice1\nB) choice2\nC) choice3\nD) choice4\""
-                # "\n\nTRUE_FALSE questions will list the true/false answer choices immediately after the \"Type\" line with no whitespace, similar to MULTIPLE_CHOICE. I.e.: \"Type: TRUE_FALSE\nA) True\nB) False\"."
-                # "\n\nFor CODING questions, ensure the \"Answer: ...\" provides the full code implementation in Python and within triple apostrophes."
-                # "\n\nSHORT_ANSWER questions should not pertain to any code or code implementations."
-                # "\n\nFor all questions, list the answer on the last relevant line for the question, i.e.: \"...\nAnswer: \". There should not be a blank line before the answer."
-                # "\n\nDo not generate a quiz if the topics are not relevant to a machine learning course.")
-    
     # RAG for embeddings similar to user-supplied topics
-    vectorstore = load_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"), collection_name="corpus")
+    vectorstore = get_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"), collection_name="corpus")
     retriever = vectorstore.as_retriever()
 
-    # generate quiz
-    print('\n========== GENERATION 1 ==========\n')
-    response = agent.respond_with_docs(description, "miscellaneous student", "", prompt, retriever)
+    chunks = _plan_quiz_chunks(numQs, topics, chunk_size)
+    if len(chunks) == 1:
+        body = _generate_quiz_chunk(agent, retriever, numQs, types, topics, seeRawQuiz)
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_QUIZ_WORKERS)) as executor:
+            # chunks keep the caller's LLM priority class (i.e. BACKGROUND for quiz bank refills)
+            futures = [executor.submit(contextvars.copy_context().run, _generate_quiz_chunk, agent, retriever, chunk_numQs,
+                                       types, chunk_topics, seeRawQuiz)
+                       for chunk_numQs, chunk_topics in chunks]
+            body = _merge_quiz_chunks([future.result() for future in futures])
+
+    if body != False:
+        _schedule_rubrics(body["questions"])
+    return body
 
-    if seeRawQuiz:
-        print(response)
 
-    # parse quiz and return formatted JSON
-    try: # catch hard errors (logic errors handled in _parse_quiz)
-        body = _parse_quiz(response, numQs, topics, types)
-    except Exception as e:
-        print("ERROR: caught exception in parsing quiz: " + str(e))
-        body = False
+async def _agenerate_quiz_live(numQs, types, topics, seeRawQuiz=False, chunk_size=QUIZ_CHUNK_SIZE):
+    '''Awaitable version of _generate_quiz_live.'''
 
-    # 2 retries if quiz is not formatted properly
-    for i in range(2):
-        if body == False:
-            print('\n========== GENERATION ' + str(i+2) + ' ==========\n')
-            response = agent.respond_with_docs(description, "miscellaneous student", "", prompt, retriever)
-            body = _parse_quiz(response, numQs, topics, types)
+    agent = Agent(QUIZ_GENERATOR_NAME, QUIZ_GENERATOR_DESCRIPTION)
+
+    vectorstore = await aget_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"), collection_name="corpus")
+    retriever = vectorstore.as_retriever()
+
+    chunks = _plan_quiz_chunks(numQs, topics, chunk_size)
+    if len(chunks) == 1:
+        body = await _agenerate_quiz_chunk(agent, retriever, numQs, types, topics, seeRawQuiz)
+    else:
+        semaphore = asyncio.Semaphore(MAX_QUIZ_WORKERS)
+
+        async def generate_chunk(chunk_numQs, chunk_topics):
+            async with semaphore:
+                return await _agenerate_quiz_chunk(agent, retriever, chunk_numQs, types, chunk_topics, seeRawQuiz)
+
+        body = _merge_quiz_chunks(await asyncio.gather(*[generate_chunk(chunk_numQs, chunk_topics)
+                                                         for chunk_numQs, chunk_topics in chunks]))
 
+    if body != False:
+        _schedule_rubrics(body["questions"])
     return body
 
 
+def enable_rubric_cache(path=RUBRIC_CACHE_PATH):
+    '''Opens the rubric cache used for SHORT_ANSWER grading at path (by default it is opened at RUBRIC_CACHE_PATH on
+    first use). Returns the cache.'''
 
-def grade_quiz(questions, temperature=0.7):
-    '''Takes formatted JSON quiz and debugMode, grades all questions, and returns [total quiz score out of 1, [scores for each FRQ out of 1], [errors for each question if CODING]].'''
+    global rubric_cache
+    rubric_cache = RubricCache(path)
+    return rubric_cache
 
-    num_mc = len(questions)
 
-    # model setup
-    name = "Quiz Grader"
-    description = ("You are Quiz Grader. Quiz Grader helps grade free response questions.")
-    agent = Agent(name, description)
+def _get_rubric_cache():
+    if rubric_cache is None:
+        enable_rubric_cache()
+    return rubric_cache
 
-    # grade all questions
-    question_scores = []
-    code_errors = [] # errors from running CODING questions...None if no errors or not applicable to question type
-    for question in questions:
 
-        errors = None
+def _answer_points(agent, question, temperature=0.7):
+    '''Returns the answer points of a SHORT_ANSWER question, extracting them with the LLM only if they are not cached.'''
 
-        # MULTIPLE_CHOICE and TRUE_FALSE: grade 0 or 1
-        if question["type"] == "MULTIPLE_CHOICE" or question["type"] == "TRUE_FALSE":
-            if question["answers"] == question["user_answer"]:
-                question_scores.append(1)
-            else:
-                question_scores.append(0)
+    return _get_rubric_cache().get_or_extract(
+        question["question"], question["answers"],
+        lambda: agent.respond(QUIZ_GRADER_DESCRIPTION, "miscellaneous student", "", _answer_points_prompt(question), temperature=temperature))
+
+
+async def _aanswer_points(agent, question, temperature=0.7):
+    '''Awaitable version of _answer_points.'''
+
+    return await _get_rubric_cache().aget_or_extract(
+        question["question"], question["answers"],
+        lambda: agent.arespond(QUIZ_GRADER_DESCRIPTION, "miscellaneous student", "", _answer_points_prompt(question), temperature=temperature))
+
+
+def _schedule_rubrics(questions):
+    '''Queues background rubric extraction for newly generated SHORT_ANSWER questions, so grading finds them cached.
+    Returns the futures of the queued extractions.'''
+
+    agent = Agent(QUIZ_GRADER_NAME, QUIZ_GRADER_DESCRIPTION)
+    futures = []
+    for question in questions:
+        if question["type"] != "SHORT_ANSWER":
             continue
 
+        def extract(question={"question": question["question"], "answers": question["answer"]}):
+            try:
+                with llm_priority(BACKGROUND):
+                    _answer_points(agent, question)
+            except Exception as e:
+                print("ERROR: caught exception in extracting rubric: " + str(e))
+
+        futures.append(_rubric_executor.submit(extract))
+    return futures
+
+
+def _split_list(items):
+    return [item.strip() for item in items.split(",") if item.strip() != ""]
+
+
+def enable_quiz_bank(path=QUIZ_BANK_PATH):
+    '''Turns on serving generate_quiz/agenerate_quiz requests that pass a userid from the local quiz bank. Returns the bank.'''
+
+    global quiz_bank
+    quiz_bank = QuizBank(path)
+    return quiz_bank
+
+
+def disable_quiz_bank():
+    global quiz_bank
+    quiz_bank = None
+
+
+def fill_quiz_bank(topics, types, target=None, bank=None):
+    '''Pre-generates questions offline until the bank holds at least target questions for every (topic, type) pair of the
+    given comma-separated topics and types. Questions are generated with the regular quiz prompt and validated by
+    the quiz parser. Defaults to QUIZ_BANK_TARGET questions per pair. Fills the enabled quiz bank (see enable_quiz_bank)
+    unless a bank is given. Returns the number of questions added.'''
+
+    bank = bank or quiz_bank
+    if bank is None:
+        raise ValueError("No quiz bank to fill, call enable_quiz_bank() or pass a bank")
+    target = QUIZ_BANK_TARGET if target is None else target
+    added = 0
+    for topic in _split_list(censor(topics)):
+        for type in _split_list(types):
+            missing = target - bank.count(topic, type)
+            if missing <= 0:
+                continue
+            body = _generate_quiz_live(missing, type, topic)
+            if body != False:
+                added += bank.add(body["questions"])
+    return added
+
+
+def _schedule_refill(bank, topic_list, type_list):
+    '''Queues a background fill_quiz_bank for every (topic, type) pair that has dropped below QUIZ_BANK_LOW_WATER.'''
+
+    for topic in topic_list:
+        for type in type_list:
+            pair = (QuizBank.topic_key(topic), QuizBank.type_key(type))
+            with _refill_lock:
+                if pair in _refilling or bank.count(topic, type) >= QUIZ_BANK_LOW_WATER:
+                    continue
+                _refilling.add(pair)
+
+            def refill(topic=topic, type=type, pair=pair):
+                try:
+                    with llm_priority(BACKGROUND):
+                        fill_quiz_bank(topic, type, bank=bank)
+                except Exception as e:
+                    print("ERROR: caught exception in refilling quiz bank: " + str(e))
+                finally:
+                    with _refill_lock:
+                        _refilling.discard(pair)
+
+            _refill_executor.submit(refill)
+
+
+def _quiz_key(numQs, types, topics, seeRawQuiz, chunk_size):
+    return (int(numQs), tuple(sorted(type.upper() for type in _split_list(types))),
+            tuple(sorted(normalize_text(topic) for topic in _split_list(topics))), bool(seeRawQuiz), chunk_size)
+
+
+def _generate_quiz_shared(numQs, types, topics, seeRawQuiz, chunk_size):
+    '''_generate_quiz_live, joining an identical generation already in flight (see quiz_flights).'''
+
+    flights = quiz_flights
+    if flights is None:
+        return _generate_quiz_live(numQs, types, topics, seeRawQuiz, chunk_size)
+    return flights.do(_quiz_key(numQs, types, topics, seeRawQuiz, chunk_size),
+                      lambda: _generate_quiz_live(numQs, types, topics, seeRawQuiz, chunk_size))
+
+
+async def _agenerate_quiz_shared(numQs, types, topics, seeRawQuiz, chunk_size):
+    '''Awaitable version of _generate_quiz_shared.'''
+
+    flights = quiz_flights
+    if flights is None:
+        return await _agenerate_quiz_live(numQs, types, topics, seeRawQuiz, chunk_size)
+    return await flights.ado(_quiz_key(numQs, types, topics, seeRawQuiz, chunk_size),
+                             lambda: _agenerate_quiz_live(numQs, types, topics, seeRawQuiz, chunk_size))
+
+
+def _add_unseen(questions, generated):
+    '''Appends the generated questions whose text is not in questions yet, i.e. not drawn from the bank already.'''
+
+    seen = {normalize_text(question["question"]) for question in questions}
+    for question in generated:
+        key = normalize_text(question["question"])
+        if key not in seen:
+            seen.add(key)
+            questions.append(question)
+
+
+def generate_quiz(numQs, types, topics, seeRawQuiz=False, chunk_size=QUIZ_CHUNK_SIZE, userid=None):
+    '''Given a numer of question, question types, question topics, and a bool debugMode, generates and
+    returns a quiz using GPT. Quizzes longer than chunk_size questions are split into chunks (grouped by topic when
+    possible) that are generated concurrently on a bounded worker pool and merged in order. Each chunk takes 3 total
+    attempts if it is not formatted properly, and the quiz will ultimately be False if a chunk is not generated.
+
+    If the quiz bank is enabled (see enable_quiz_bank) and a userid is given, questions the user has not seen yet are
+    drawn from the bank first; only the shortfall is generated live (again, up to QUIZ_TOP_UP_ROUNDS times, while
+    generated questions repeat drawn ones), and low (topic, type) pairs are refilled in the background.
+
+    If seeRawQuiz is true, prints the raw generated quiz independently, before trying parsing.'''
+
+    topics = censor(topics) # profanity check the topics
+
+    bank = quiz_bank
+    if bank is None or userid is None:
+        return _generate_quiz_shared(numQs, types, topics, seeRawQuiz, chunk_size)
+
+    topic_list, type_list = _split_list(topics), _split_list(types)
+    # questions are only marked as served once the whole quiz is assembled, so a failed quiz does not use them up
+    questions = bank.sample(userid, numQs, topic_list, type_list, mark_served=False)
+
+    for _ in range(QUIZ_TOP_UP_ROUNDS):
+        if len(questions) >= numQs:
+            break
+        body = _generate_quiz_shared(numQs - len(questions), types, topics, seeRawQuiz, chunk_size)
+        if body == False:
+            return False
+        _add_unseen(questions, body["questions"])
+    bank.add(questions, userid=userid)
+
+    _schedule_refill(bank, topic_list, type_list)
+
+    return {"questions": questions}
+
+
+async def agenerate_quiz(numQs, types, topics, seeRawQuiz=False, chunk_size=QUIZ_CHUNK_SIZE, userid=None):
+    '''Awaitable version of generate_quiz. Takes the same arguments and returns the same parsed quiz, or False.'''
+
+    topics = censor(topics) # profanity check the topics
+
+    bank = quiz_bank
+    if bank is None or userid is None:
+        return await _agenerate_quiz_shared(numQs, types, topics, seeRawQuiz, chunk_size)
+
+    topic_list, type_list = _split_list(topics), _split_list(types)
+    questions = await asyncio.to_thread(bank.sample, userid, numQs, topic_list, type_list, False)
+
+    for _ in range(QUIZ_TOP_UP_ROUNDS):
+        if len(questions) >= numQs:
+            break
+        body = await _agenerate_quiz_shared(numQs - len(questions), types, topics, seeRawQuiz, chunk_size)
+        if body == False:
+            return False
+        _add_unseen(questions, body["questions"])
+    await asyncio.to_thread(bank.add, questions, userid)
+
+    await asyncio.to_thread(_schedule_refill, bank, topic_list, type_list)
+
+    return {"questions": questions}
+
+
+def _answer_points_prompt(question):
+    return ("Here is a question: " + question["question"] + "\n\nHere is the optimal answer to the question:" + question["answers"] + "\n\nFrom the optimal answer, "
+            "split it up into its logical points and return them line by line, i.e. \"- Here is point 1.\n- Here is point 2.\". Only return the points with no other text.")
+
+
+def _points_check_prompt(question, answer_points):
+    return ("You will be provided with text delimited by triple quotes that is the answer to a question. Check if the following pieces of information "
+            "are mentioned in the answer:\n\n" + answer_points + "\n\nFor each piece of information, return a comma-separated \"yes\" if it is mentioned in the "
+            "answer or a comma-separated \"no\" if it is not mentioned in the answer I.e., if 3 out of 4 points are mentioned in the answer, return \"yes, yes, yes, no\". "
+            "Be lenient. Do not return any other text."
+            "\n\n\"\"\"" + question["user_answer"] + "\"\"\"")
+
+
+def _points_check_score(response):
+    '''Fraction of "yes" answers in a comma-separated yes/no grading response.'''
+
+    return float(response.replace(' ', '').split(',').count("yes")) / float(len(response.replace(' ', '').split(',')))
+
+
+def _coding_syntax_prompt(question):
+    return ("You will be provided with text delimited by triple quotes that is a user's code answer to a coding question. Compare the user code to the following optimal "
+            "code answer that is delimited by double quotes:\n\n\"\"" + question["user_answer"] + "\"\"\n\nScore the user-supplied code on a continuous scale of 0.0 "
+            "to " + str(CODING_SCORE_RATIO) + " based on whether it performs the same key functionality as the optimal code. Only return the score with no other text.")
+
+
+def _get_code_runner():
+    global code_runner
+    with _code_runner_lock:
+        if code_runner is None:
+            code_runner = CodeRunnerClient(CODE_RUNNER_URL)
+    return code_runner
+
+
+def _submit_code_answers(questions):
+    '''Submits all CODING answers of a quiz to the code runner as one batch up front, so _run_code finds them running or done.'''
+
+    codes = [question["user_answer"] for question in questions if question["type"] == "CODING"]
+    if codes:
+        _get_code_runner().submit_many(codes)
+
+
+def _run_code(code):
+    '''Runs a CODING answer through the code runner service and returns (ran score, errors).'''
+
+    try:
+        with span("code_run") as s:
+            response = _get_code_runner().run(code)
+            errors = response["errors"]
+            s.set(ran=int(response["status_code"] == 200))
+
+        if response["status_code"] == 200:
+            ran_score = 1 - CODING_SCORE_RATIO
+        else:
+            ran_score = 0
+
+    except Exception as e:
+        raise Exception("ERROR: caught exception in grading coding question: " + str(e))
+
+    return ran_score, errors
+
+
+def _grade_choice_question(question):
+    # MULTIPLE_CHOICE and TRUE_FALSE: grade 0 or 1
+    return 1 if question["answers"] == question["user_answer"] else 0
+
+
+def _submit_grading_call(func, *args, **kwargs):
+    '''Runs one call of a question's grading on the shared grading pool, keeping the caller's LLM priority and tracing.'''
+
+    return _grading_executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def _wait_grading_calls(futures, deadline):
+    '''Returns the results of a question's grading calls, or cancels the calls that have not started yet and raises
+    concurrent.futures.TimeoutError if they are not all done by deadline.'''
+
+    done, pending = wait(futures, timeout=max(0, deadline - time.monotonic()))
+    if pending:
+        for future in pending:
+            future.cancel()
+        raise FuturesTimeoutError()
+    return [future.result() for future in futures]
+
+
+def _grade_question(agent, question, temperature):
+    '''Grades one SHORT_ANSWER or CODING question, running its independent calls concurrently on the shared grading
+    pool. Raises concurrent.futures.TimeoutError if grading takes longer than GRADING_TIMEOUT seconds from its start;
+    no scoring samples are issued after that and queued calls are dropped. Returns (score, errors).'''
+
+    description = QUIZ_GRADER_DESCRIPTION
+    deadline = time.monotonic() + GRADING_TIMEOUT
+    errors = None
+    score = 0
+
+    with span("grading", type=question["type"]):
+
         # SHORT_ANSWER: grade [0, 1]
         if question["type"] == "SHORT_ANSWER":
+            answer_points = _wait_grading_calls([_submit_grading_call(_answer_points, agent, question, temperature)], deadline)[0]
+            if time.monotonic() >= deadline:
+                raise FuturesTimeoutError()
+            prompt2 = _points_check_prompt(question, answer_points)
 
-            prompt1 = ("Here is a question: " + question["question"] + "\n\nHere is the optimal answer to the question:" + question["answers"] + "\n\nFrom the optimal answer, "
-                    "split it up into its logical points and return them line by line, i.e. \"- Here is point 1.\n- Here is point 2.\". Only return the points with no other text.")
-            answer_points = agent.respond(description, "miscellaneous student", "", prompt1, temperature=temperature)
-            prompt2 = ("You will be provided with text delimited by triple quotes that is the answer to a question. Check if the following pieces of information "
-                    "are mentioned in the answer:\n\n" + answer_points + "\n\nFor each piece of information, return a comma-separated \"yes\" if it is mentioned in the "
-                    "answer or a comma-separated \"no\" if it is not mentioned in the answer I.e., if 3 out of 4 points are mentioned in the answer, return \"yes, yes, yes, no\". "
-                    "Be lenient. Do not return any other text."
-                    "\n\n\"\"\"" + question["user_answer"] + "\"\"\"")
-            
-            best_score = 0.0
-            for i in range(3): # 3 attempts for grading, takes highest score
-                response = agent.respond(description, "miscellaneous student", "", prompt2, temperature=temperature)
-                score = float(response.replace(' ', '').split(',').count("yes")) / float(len(response.replace(' ', '').split(',')))
-                if score > best_score:
-                    best_score = score
-
-            # print(answer_points)
-            # print(response, '\n')
+            # GRADING_SAMPLES attempts for grading in parallel, takes highest score
+            samples = [_submit_grading_call(agent.respond, description, "miscellaneous student", "", prompt2, temperature=temperature)
+                       for i in range(GRADING_SAMPLES)]
+            score = max(_points_check_score(sample) for sample in _wait_grading_calls(samples, deadline))
 
         # CODING: grade [0, 1]
         if question["type"] == "CODING":
+            ran = _submit_grading_call(_run_code, question["user_answer"]) # grade whether it ran
+            syntax = _submit_grading_call(agent.respond, description, "miscellaneous student", "", _coding_syntax_prompt(question),
+                                          temperature=temperature) # grade general syntax
+            (ran_score, errors), syntax_score = _wait_grading_calls([ran, syntax], deadline)
+            score = ran_score + float(syntax_score)
 
-            score_ratio = 0.8 # 0.8 from syntax, 0.2 from running
+    return score, errors
 
-            # grade whether it ran
-            url="http://localhost:5002/runcode"
-            payload = {'code': question["user_answer"]}
-            headers = {'Content-Type': 'application/json'}
-            try:
-                response = json.loads(requests.post(url, json=payload, headers=headers).text) # converts request to text, then parses back to JSON (instead of a Response obj)
-                errors = response["errors"]
-                
-                # print debugging info
-                print("Code Question Running - Status:")
-                print("ran: ", response["ran"])
-                print("errors: ", errors)
-                print("status_code: ", response["status_code"], "\n")
-
-                if response["status_code"] == 200:
-                    ran_score = 1 - score_ratio
-                else:
-                    ran_score = 0
 
-            except Exception as e:
-                raise Exception("ERROR: caught exception in grading coding question: " + str(e))
-            
-            # grade general syntax
-            prompt = ("You will be provided with text delimited by triple quotes that is a user's code answer to a coding question. Compare the user code to the following optimal "
-                      "code answer that is delimited by double quotes:\n\n\"\"" + question["user_answer"] + "\"\"\n\nScore the user-supplied code on a continuous scale of 0.0 "
-                      "to " + str(score_ratio) + " based on whether it performs the same key functionality as the optimal code. Only return the score with no other text.")
-            syntax_score = float(agent.respond(description, "miscellaneous student", "", prompt, temperature=temperature))
+async def _agrade_question(agent, question, temperature):
+    '''Awaitable version of _grade_question.'''
 
-            score = ran_score + syntax_score
+    description = QUIZ_GRADER_DESCRIPTION
+    errors = None
+    score = 0
 
-        # append question score and (if applicable) errors
+    with span("grading", type=question["type"]):
+        # SHORT_ANSWER: grade [0, 1]
+        if question["type"] == "SHORT_ANSWER":
+            answer_points = await _aanswer_points(agent, question, temperature)
+            prompt2 = _points_check_prompt(question, answer_points)
+
+            responses = await asyncio.gather(*[agent.arespond(description, "miscellaneous student", "", prompt2, temperature=temperature)
+                                               for i in range(GRADING_SAMPLES)])
+            score = max(_points_check_score(response) for response in responses)
+
+        # CODING: grade [0, 1]
+        if question["type"] == "CODING":
+            (ran_score, errors), syntax_score = await asyncio.gather(
+                asyncio.to_thread(_run_code, question["user_answer"]), # blocking HTTP call
+                agent.arespond(description, "miscellaneous student", "", _coding_syntax_prompt(question), temperature=temperature))
+            score = ran_score + float(syntax_score)
+
+    return score, errors
+
+
+def _collect_grades(questions, results):
+    '''Puts per-question (score, errors) results, in question order, into grade_quiz's return format.'''
+
+    question_scores = []
+    code_errors = [] # errors from running CODING questions...None if no errors or not applicable to question type
+    for question, (score, errors) in zip(questions, results):
         question_scores.append(score)
+        if question["type"] == "MULTIPLE_CHOICE" or question["type"] == "TRUE_FALSE":
+            continue
         if errors == "" or errors == None:
             code_errors.append(None)
         else:
             code_errors.append(errors)
 
     # get final score
-    final_score = sum(question_scores) / num_mc
+    final_score = sum(question_scores) / len(questions)
 
-    return final_score, question_scores, code_errors
\ No newline at end of file
+    return final_score, question_scores, code_errors
+
+
+def grade_quiz(questions, temperature=0.7):
+    '''Takes formatted JSON quiz and debugMode, grades all questions, and returns [total quiz score out of 1, [scores for each FRQ out of 1], [errors for each question if CODING]].
+    Free response questions are graded concurrently on a bounded worker pool, and their LLM and code runner calls share
+    one pool of GRADING_CALL_WORKERS across all quizzes; a question that takes longer than GRADING_TIMEOUT seconds to
+    grade (not counting time queued for a worker) is scored 0 instead of failing the quiz.'''
+
+    # model setup
+    agent = Agent(QUIZ_GRADER_NAME, QUIZ_GRADER_DESCRIPTION)
+
+    # grade all questions
+    with span("grade_quiz", questions=len(questions)) as graded:
+        _submit_code_answers(questions)
+        executor = ThreadPoolExecutor(max_workers=MAX_GRADING_WORKERS)
+        try:
+            pending = []
+            for question in questions:
+                if question["type"] == "MULTIPLE_CHOICE" or question["type"] == "TRUE_FALSE":
+                    pending.append((_grade_choice_question(question), None))
+                else:
+                    pending.append(executor.submit(_grade_question, agent, question, temperature))
+
+            results = []
+            for i, result in enumerate(pending):
+                if isinstance(result, Future):
+                    try:
+                        result = result.result()
+                    except FuturesTimeoutError:
+                        print("ERROR: grading question " + str(i+1) + " timed out, scoring it 0")
+                        graded.add("timeouts")
+                        result = (0, None)
+                results.append(result)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return _collect_grades(questions, results)
+
+
+async def agrade_quiz(questions, temperature=0.7):
+    '''Awaitable version of grade_quiz. Takes the same arguments and returns the same (final score, question scores, code errors).'''
+
+    agent = Agent(QUIZ_GRADER_NAME, QUIZ_GRADER_DESCRIPTION)
+
+    with span("grade_quiz", questions=len(questions)) as graded:
+        _submit_code_answers(questions)
+        semaphore = asyncio.Semaphore(MAX_GRADING_WORKERS)
+
+        async def grade(i, question):
+            if question["type"] == "MULTIPLE_CHOICE" or question["type"] == "TRUE_FALSE":
+                return _grade_choice_question(question), None
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(_agrade_question(agent, question, temperature), GRADING_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print("ERROR: grading question " + str(i+1) + " timed out, scoring it 0")
+                    graded.add("timeouts")
+                    return 0, None
+
+        results = await asyncio.gather(*[grade(i, question) for i, question in enumerate(questions)])
+
+    return _collect_grades(questions, results)
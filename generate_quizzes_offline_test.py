@@ -0,0 +1,381 @@
+import itertools
+import pytest
+import asyncio
+import time
+import re
+
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.messages import AIMessageChunk
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import generate_quizzes
+    from agent_test import _retriever
+    from utils.text_generation import set_llm_factory
+    from utils.rubric_cache import RubricCache
+    from utils.code_runner import CodeRunnerClient, StubCodeRunner
+else:
+    from . import generate_quizzes
+    from .agent_test import _retriever
+    from .utils.text_generation import set_llm_factory
+    from .utils.rubric_cache import RubricCache
+    from .utils.code_runner import CodeRunnerClient, StubCodeRunner
+
+
+def fake_quiz(numQs, topic, type="TRUE_FALSE", batch=0):
+    '''Builds a quiz in the format generate_quiz prompts for.'''
+
+    sections = []
+    for i in range(numQs):
+        sections.append(str(i+1) + ". Is question " + str(batch) + "-" + str(i+1) + " about " + topic + "?\nTopic: " + topic + "\nType: " + type +
+                        "\nA) True\nB) False\nAnswer: A) True\n")
+    return "------DIVIDER------\n".join(sections)
+
+
+_batches = itertools.count(1) # keeps generated question texts unique across tests
+
+
+class QuizChatModel(SimpleChatModel):
+    '''Fake chat model that answers quiz prompts with a well-formed quiz for the requested size and first topic.
+    Topics listed in fail_once get a malformed quiz on their first request. Streams line by line, recording every
+    streamed line in streamed.'''
+
+    fail_once: list = []
+    calls: list = []
+    streamed: list = []
+
+    @property
+    def _llm_type(self):
+        return "fake-quiz-chat-model"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        numQs = int(re.search(r"exactly (\d+)questions", prompt).group(1))
+        topic = re.search(r"question topics: (.*?), and only", prompt).group(1).split(",")[0].strip()
+        self.calls.append((numQs, topic))
+        if topic in self.fail_once:
+            self.fail_once.remove(topic)
+            return fake_quiz(numQs, topic, type="ESSAY")
+        return fake_quiz(numQs, topic, batch=next(_batches))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for line in self._call(messages, stop, run_manager, **kwargs).splitlines(keepends=True):
+            self.streamed.append(line)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=line))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._stream(messages, stop, run_manager, **kwargs):
+            yield chunk
+
+
+class GradingChatModel(SimpleChatModel):
+    '''Fake chat model for grading prompts: returns two answer points, then cycles through scoring responses.'''
+
+    scores: list = ["yes, no", "yes, yes", "no, no"]
+    calls: list = []
+    turn: itertools.count = itertools.count()
+
+    @property
+    def _llm_type(self):
+        return "fake-grading-chat-model"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        self.calls.append(prompt)
+        if "split it up into its logical points" in prompt:
+            return "- point 1\n- point 2"
+        if "Score the user-supplied code" in prompt:
+            return "0.5"
+        return self.scores[next(self.turn) % len(self.scores)]
+
+
+class FakeVectorStore:
+    def as_retriever(self):
+        return _retriever()
+
+
+def _setup(monkeypatch, fail_once=()):
+    model = QuizChatModel(fail_once=list(fail_once), calls=[], streamed=[])
+    set_llm_factory(lambda model_name, temperature: model)
+    monkeypatch.setattr(generate_quizzes, "get_shared_vectorstore", lambda **kwargs: FakeVectorStore())
+
+    async def fake_aget_shared_vectorstore(**kwargs):
+        return FakeVectorStore()
+    monkeypatch.setattr(generate_quizzes, "aget_shared_vectorstore", fake_aget_shared_vectorstore)
+    return model
+
+
+def test_plan_quiz_chunks():
+    assert generate_quizzes._plan_quiz_chunks(4, "a, b", 5) == [(4, "a, b")]
+    assert generate_quizzes._plan_quiz_chunks(12, "a, b, c", 5) == [(4, "a"), (4, "b"), (4, "c")]
+    assert generate_quizzes._plan_quiz_chunks(11, "a", 5) == [(4, "a"), (4, "a"), (3, "a")]
+
+
+def test_generate_quiz_fans_out_and_retries_only_failed_chunk(monkeypatch):
+    model = _setup(monkeypatch, fail_once=["b"])
+
+    body = generate_quizzes.generate_quiz(12, "TRUE_FALSE", "a, b, c")
+
+    assert len(body["questions"]) == 12
+    assert [question["topics"] for question in body["questions"]] == ["a"] * 4 + ["b"] * 4 + ["c"] * 4
+    assert sorted(model.calls) == [(4, "a"), (4, "b"), (4, "b"), (4, "c")]
+
+
+def test_generate_quiz_stops_streaming_at_first_bad_question(monkeypatch):
+    model = _setup(monkeypatch, fail_once=["a"])
+
+    body = generate_quizzes.generate_quiz(4, "TRUE_FALSE", "a")
+
+    assert len(body["questions"]) == 4
+    assert model.calls == [(4, "a"), (4, "a")]
+    # the failed attempt was abandoned after its first question (7 lines including the divider)
+    assert len(model.streamed) == 7 + len(fake_quiz(4, "a").splitlines())
+
+
+def test_agenerate_quiz_single_chunk(monkeypatch):
+    model = _setup(monkeypatch)
+
+    body = asyncio.run(generate_quizzes.agenerate_quiz(3, "TRUE_FALSE", "ensemble learning"))
+
+    assert len(body["questions"]) == 3
+    assert model.calls == [(3, "ensemble learning")]
+
+
+def test_agenerate_quiz_fails_when_chunk_never_parses(monkeypatch):
+    _setup(monkeypatch, fail_once=["b", "b", "b"])
+
+    assert asyncio.run(generate_quizzes.agenerate_quiz(10, "TRUE_FALSE", "a, b")) == False
+
+
+def test_generate_quiz_does_not_retry_api_errors_as_format_errors(monkeypatch):
+    model = _setup(monkeypatch)
+
+    def unreachable(*args, **kwargs):
+        model.calls.append("unreachable")
+        raise ConnectionError("connection reset by peer")
+    monkeypatch.setattr(QuizChatModel, "_stream", unreachable)
+
+    with pytest.raises(ConnectionError):
+        generate_quizzes.generate_quiz(3, "TRUE_FALSE", "a")
+    assert model.calls == ["unreachable"]
+
+
+def test_quiz_bank_serves_without_repetition(monkeypatch, tmp_path):
+    model = _setup(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "QUIZ_BANK_LOW_WATER", 0) # no background refills
+    bank = generate_quizzes.enable_quiz_bank(str(tmp_path / "bank.sqlite3"))
+    try:
+        assert generate_quizzes.fill_quiz_bank("a, b", "TRUE_FALSE", target=4) == 8
+        assert generate_quizzes.fill_quiz_bank("a, b", "TRUE_FALSE", target=4) == 0
+        model.calls.clear()
+
+        first = generate_quizzes.generate_quiz(4, "TRUE_FALSE", "a, b", userid="u1")
+        assert sorted(question["topics"] for question in first["questions"]) == ["a", "a", "b", "b"]
+        assert model.calls == []
+
+        # 4 unseen questions left for u1, the other 2 are generated live and added to the bank
+        second = asyncio.run(generate_quizzes.agenerate_quiz(6, "TRUE_FALSE", "a, b", userid="u1"))
+        assert len(second["questions"]) == 6
+        assert model.calls == [(2, "a")]
+        seen = [question["question"] for question in first["questions"] + second["questions"]]
+        assert len(set(seen)) == len(seen)
+
+        # another user can be served everything, including the live questions that were added to the bank
+        assert len(bank.sample("u2", 20, ["a", "b"], ["TRUE_FALSE"])) == 10
+    finally:
+        generate_quizzes.disable_quiz_bank()
+
+
+def test_quiz_bank_failed_quiz_does_not_use_up_questions(monkeypatch, tmp_path):
+    with pytest.raises(ValueError):
+        generate_quizzes.fill_quiz_bank("a", "TRUE_FALSE", target=2)
+
+    _setup(monkeypatch, fail_once=["a"] * 3)
+    monkeypatch.setattr(generate_quizzes, "QUIZ_BANK_LOW_WATER", 0) # no background refills
+    bank = generate_quizzes.enable_quiz_bank(str(tmp_path / "bank.sqlite3"))
+    try:
+        bank.add(generate_quizzes._parse_quiz(fake_quiz(2, "a", batch=next(_batches)), 2, "a", "TRUE_FALSE")["questions"])
+
+        # the 2 banked questions are sampled, but the live shortfall never parses
+        assert generate_quizzes.generate_quiz(4, "TRUE_FALSE", "a", userid="u1") == False
+        assert len(bank.sample("u1", 4, ["a"], ["TRUE_FALSE"], mark_served=False)) == 2
+
+        assert len(generate_quizzes.generate_quiz(2, "TRUE_FALSE", "a", userid="u1")["questions"]) == 2
+        assert bank.sample("u1", 4, ["a"], ["TRUE_FALSE"]) == []
+    finally:
+        generate_quizzes.disable_quiz_bank()
+
+
+def test_quiz_bank_live_questions_repeating_drawn_ones_are_topped_up(monkeypatch, tmp_path):
+    model = _setup(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "QUIZ_BANK_LOW_WATER", 0) # no background refills
+    bank = generate_quizzes.enable_quiz_bank(str(tmp_path / "bank.sqlite3"))
+    try:
+        batch = next(_batches)
+        bank.add(generate_quizzes._parse_quiz(fake_quiz(1, "a", batch=batch), 1, "a", "TRUE_FALSE")["questions"])
+
+        # the first live question repeats the banked one, so it is dropped and the shortfall generated again
+        monkeypatch.setitem(globals(), "_batches", iter([batch, next(_batches)]))
+        quiz = generate_quizzes.generate_quiz(2, "TRUE_FALSE", "a", userid="u1")
+        texts = [question["question"] for question in quiz["questions"]]
+        assert len(texts) == 2 and len(set(texts)) == 2
+        assert model.calls == [(1, "a"), (1, "a")]
+    finally:
+        generate_quizzes.disable_quiz_bank()
+
+
+def test_quiz_bank_matches_types_in_any_case(monkeypatch, tmp_path):
+    model = _setup(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "QUIZ_BANK_LOW_WATER", 0) # no background refills
+    bank = generate_quizzes.enable_quiz_bank(str(tmp_path / "bank.sqlite3"))
+    try:
+        generate_quizzes.fill_quiz_bank("a", "TRUE_FALSE", target=2)
+        model.calls.clear()
+
+        assert bank.count("a", "true_false") == 2
+        assert len(generate_quizzes.generate_quiz(2, "true_false", "a", userid="u1")["questions"]) == 2
+        assert model.calls == []
+    finally:
+        generate_quizzes.disable_quiz_bank()
+
+
+def test_quiz_bank_refills_in_background(monkeypatch, tmp_path):
+    model = _setup(monkeypatch)
+    bank = generate_quizzes.enable_quiz_bank(str(tmp_path / "bank.sqlite3"))
+    monkeypatch.setattr(generate_quizzes, "QUIZ_BANK_TARGET", 3)
+    try:
+        generate_quizzes.generate_quiz(2, "TRUE_FALSE", "a", userid="u1")
+        generate_quizzes._refill_executor.submit(lambda: None).result() # wait for queued refills
+
+        assert bank.count("a", "TRUE_FALSE") >= 3
+        assert model.calls[0] == (2, "a")
+    finally:
+        generate_quizzes.disable_quiz_bank()
+
+
+GRADED_QUESTIONS = [
+    {"question": "Explain L1 vs L2.", "type": "SHORT_ANSWER", "answers": "L1 is sparse. L2 is smooth.", "user_answer": "L1 is sparse."},
+    {"question": "Is Lasso L1?", "type": "TRUE_FALSE", "answers": "True", "user_answer": "True"},
+    {"question": "Write relu.", "type": "CODING", "answers": "def relu(x): return max(0, x)", "user_answer": "def relu(x) return x"},
+    {"question": "Pick one.", "type": "MULTIPLE_CHOICE", "answers": "A", "user_answer": "B"},
+]
+
+
+def _use_grading_model(monkeypatch):
+    model = GradingChatModel(calls=[], turn=itertools.count())
+    set_llm_factory(lambda model_name, temperature: model)
+    monkeypatch.setattr(generate_quizzes, "rubric_cache", RubricCache(":memory:"))
+    return model
+
+
+def test_grade_quiz_grades_concurrently_in_order(monkeypatch):
+    model = _use_grading_model(monkeypatch)
+
+    with StubCodeRunner() as runner:
+        monkeypatch.setattr(generate_quizzes, "code_runner", CodeRunnerClient(runner.url))
+        final_score, question_scores, code_errors = generate_quizzes.grade_quiz(GRADED_QUESTIONS)
+
+        # best of the 3 scoring samples counts, one of which is "yes, yes"; the code has a syntax error
+        assert question_scores == [1.0, 1, 0.5, 0]
+        assert code_errors[0] is None and code_errors[1].startswith("SyntaxError")
+        assert final_score == 2.5 / 4
+        assert len(model.calls) == 1 + generate_quizzes.GRADING_SAMPLES + 1
+
+        assert asyncio.run(generate_quizzes.agrade_quiz(GRADED_QUESTIONS)) == (final_score, question_scores, code_errors)
+        assert len(runner.requests) == 1 # the second run was cached
+
+
+def test_code_that_fails_with_http_400_scores_0_for_running(monkeypatch):
+    _use_grading_model(monkeypatch)
+
+    with StubCodeRunner(mirror_status=True) as runner:
+        monkeypatch.setattr(generate_quizzes, "code_runner", CodeRunnerClient(runner.url))
+        final_score, question_scores, code_errors = generate_quizzes.grade_quiz(GRADED_QUESTIONS[2:3])
+
+    assert question_scores == [0.5] and code_errors[0].startswith("SyntaxError")
+
+
+def test_grade_quiz_scores_timed_out_question_0(monkeypatch):
+    _use_grading_model(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "GRADING_TIMEOUT", 0.2)
+    monkeypatch.setattr(generate_quizzes, "_submit_code_answers", lambda questions: None)
+
+    def hung_run_code(code):
+        time.sleep(1)
+        return 0.2, None
+    monkeypatch.setattr(generate_quizzes, "_run_code", hung_run_code)
+
+    assert generate_quizzes.grade_quiz(GRADED_QUESTIONS)[1] == [1.0, 1, 0, 0]
+    assert asyncio.run(generate_quizzes.agrade_quiz(GRADED_QUESTIONS))[1] == [1.0, 1, 0, 0]
+
+
+def test_timed_out_question_issues_no_more_samples(monkeypatch):
+    model = _use_grading_model(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "GRADING_TIMEOUT", 0.2)
+
+    def slow_answer_points(agent, question, temperature=0.7):
+        time.sleep(0.4)
+        return "- point 1"
+    monkeypatch.setattr(generate_quizzes, "_answer_points", slow_answer_points)
+
+    assert generate_quizzes.grade_quiz(GRADED_QUESTIONS[:1])[1] == [0]
+    time.sleep(0.4) # the rubric call finishes in the background, but no scoring samples follow it
+    assert model.calls == []
+
+
+def test_grade_quiz_timeout_excludes_queue_time(monkeypatch):
+    _use_grading_model(monkeypatch)
+    monkeypatch.setattr(generate_quizzes, "GRADING_TIMEOUT", 0.5)
+    monkeypatch.setattr(generate_quizzes, "MAX_GRADING_WORKERS", 1)
+    monkeypatch.setattr(generate_quizzes, "_submit_code_answers", lambda questions: None)
+
+    def slow_run_code(code):
+        time.sleep(0.3)
+        return 0.5, None
+    monkeypatch.setattr(generate_quizzes, "_run_code", slow_run_code)
+
+    # graded one at a time, the third question waits 0.6s for the worker but takes only 0.3s itself
+    questions = [GRADED_QUESTIONS[2]] * 3
+    assert generate_quizzes.grade_quiz(questions)[1] == [1.0, 1.0, 1.0]
+    assert asyncio.run(generate_quizzes.agrade_quiz(questions))[1] == [1.0, 1.0, 1.0]
+
+
+def _rubric_calls(model):
+    return [prompt for prompt in model.calls if "split it up into its logical points" in prompt]
+
+
+def test_rubric_is_extracted_once_per_question(monkeypatch):
+    model = _use_grading_model(monkeypatch)
+    submissions = [[dict(GRADED_QUESTIONS[0], user_answer="answer " + str(i))] for i in range(5)]
+
+    for questions in submissions[:4]:
+        generate_quizzes.grade_quiz(questions)
+    asyncio.run(generate_quizzes.agrade_quiz(submissions[4]))
+
+    assert len(_rubric_calls(model)) == 1
+
+
+def test_concurrent_async_graders_extract_rubric_once(monkeypatch):
+    model = _use_grading_model(monkeypatch)
+    submissions = [[dict(GRADED_QUESTIONS[0], user_answer="answer " + str(i))] for i in range(4)]
+
+    async def grade_all():
+        return await asyncio.gather(*[generate_quizzes.agrade_quiz(questions) for questions in submissions])
+    asyncio.run(grade_all())
+
+    assert len(_rubric_calls(model)) == 1
+    assert generate_quizzes.rubric_cache._extractions.stats()["in_flight"] == 0
+
+
+def test_rubric_is_extracted_at_generation_time(monkeypatch):
+    model = _use_grading_model(monkeypatch)
+    generated = {"type": "SHORT_ANSWER", "question": "Explain L1 vs L2.", "topics": "svm", "choices": None,
+                 "answer": "L1 is sparse.  L2 is smooth."}
+
+    for future in generate_quizzes._schedule_rubrics([generated]):
+        future.result()
+    assert len(_rubric_calls(model)) == 1
+
+    generate_quizzes.grade_quiz(GRADED_QUESTIONS[:1])
+    assert len(_rubric_calls(model)) == 1
@@ -1,16 +1,87 @@
+import asyncio
 import os
 
 # fix errors when importing locally versus as submodule
 if __package__ is None or __package__ == '':
     from agent import Agent
-    from utils.vectorstore import load_vectorstore
+    from utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore, search_candidates_by_vectors, \
+        supports_batch_search
+    from utils.mmr import batch_maximal_marginal_relevance
+    from utils.tracing import span
+    from utils.single_flight import SingleFlight
+    from utils.embeddings_cache import normalize_text
 else:
     from .agent import Agent
-    from .utils.vectorstore import load_vectorstore
+    from .utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore, search_candidates_by_vectors, \
+        supports_batch_search
+    from .utils.mmr import batch_maximal_marginal_relevance
+    from .utils.tracing import span
+    from .utils.single_flight import SingleFlight
+    from .utils.embeddings_cache import normalize_text
+
+FETCH_K = 20  # candidates fetched per topic before MMR re-ranking (same as langchain's default)
+
+# Concurrent identical searches share one search. Set to None to search for every request separately.
+similar_flights = SingleFlight("coalesce_get_similar")
+
+
+def _get_vectorstore():
+    return get_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
+                                  collection_name="corpus")
+
+
+def search_similar_batch(vs, topics: list[str], max_per_topic: int = 5, dedupe: bool = False) -> list:
+    """
+    Batched MMR search for several topics: one embeddings request for all topics, one database round trip for all
+    candidates, and one vectorized MMR re-ranking pass.
+
+    Parameters:
+    - vs (PGVector or MmapVectorStore): The vector store to search.
+    - topics (list[str]): String array of topics to search for similar documents.
+    - max_per_topic (int, optional): Maximum number of documents to return per topic. Defaults to 5.
+    - dedupe (bool, optional): If True, a document is returned for at most one topic. Defaults to False.
+
+    Returns:
+    - list: For each topic, the list of selected documents.
+    """
+    if not topics:
+        return []
+
+    query_embeddings = vs.embeddings.embed_documents(list(topics))
+    candidates = search_candidates_by_vectors(vs, query_embeddings, fetch_k=FETCH_K)
+
+    selections = batch_maximal_marginal_relevance(
+        query_embeddings,
+        [[embedding for _, embedding, _ in topic_candidates] for topic_candidates in candidates],
+        k=max_per_topic,
+        candidate_ids=[[id for _, _, id in topic_candidates] for topic_candidates in candidates] if dedupe else None,
+    )
+
+    return [[candidates[t][i][0] for i in selection] for t, selection in enumerate(selections)]
+
+
+def _similar(vs, topics, max_per_topic, dedupe):
+    with span("retrieval", topics=len(topics)) as s:
+        if supports_batch_search(vs):
+            searches = search_similar_batch(vs, topics, max_per_topic, dedupe)
+        else:
+            searches = [vs.search(t, "mmr", k=max_per_topic) for t in topics]
+        s.set(documents=sum(len(search) for search in searches))
+
+    return [{t: [item.metadata for item in search]} for t, search in zip(topics, searches)]
+
+
+def _similar_key(topics, max_per_topic, dedupe):
+    return tuple(normalize_text(t) for t in topics), max_per_topic, dedupe
+
+
+def _retitled(topics, results):
+    # a shared search is keyed by the topics of the request that ran it, use the caller's spelling instead
+    return [{t: metadatas} for t, result in zip(topics, results) for metadatas in result.values()]
 
 
 # takes in string array
-def get_similar(topics: list[str], max_per_topic: int = 5) -> list:
+def get_similar(topics: list[str], max_per_topic: int = 5, dedupe: bool = False) -> list:
     """
     Function to get similar documents from vector store given a list of topics.
     Useful to find resources to learn more about a topic.
@@ -18,16 +89,36 @@ def get_similar(topics: list[str], max_per_topic: int = 5) -> list:
     Parameters:
     - topics (list[str]): String array of topics to search for similar documents.
     - max_per_topic (int, optional): Maximum number of documents to return per topic. Defaults to 5.
+    - dedupe (bool, optional): If True, a document is listed under at most one topic. Defaults to False.
 
     Returns:
     - list: List of dictionaries containing topic and list of similar documents.
     """
-    result = []
-    vs = load_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
-                          collection_name="corpus")
+    flights = similar_flights
+    if flights is None:
+        return _similar(_get_vectorstore(), topics, max_per_topic, dedupe)
+    return _retitled(topics, flights.do(_similar_key(topics, max_per_topic, dedupe),
+                                        lambda: _similar(_get_vectorstore(), topics, max_per_topic, dedupe)))
 
-    for t in topics:
-        search = [item.metadata for item in vs.search(t, "mmr", k=max_per_topic)]
-        result.append({t: search})
 
-    return result
+async def aget_similar(topics: list[str], max_per_topic: int = 5, dedupe: bool = False) -> list:
+    """
+    Awaitable version of get_similar(). The batched search runs in a worker thread.
+
+    Parameters:
+    - topics (list[str]): String array of topics to search for similar documents.
+    - max_per_topic (int, optional): Maximum number of documents to return per topic. Defaults to 5.
+    - dedupe (bool, optional): If True, a document is listed under at most one topic. Defaults to False.
+
+    Returns:
+    - list: List of dictionaries containing topic and list of similar documents.
+    """
+    async def search():
+        vs = await aget_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
+                                          collection_name="corpus")
+        return await asyncio.to_thread(_similar, vs, topics, max_per_topic, dedupe)
+
+    flights = similar_flights
+    if flights is None:
+        return await search()
+    return _retitled(topics, await flights.ado(_similar_key(topics, max_per_topic, dedupe), search))
@@ -0,0 +1,79 @@
+import threading
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.benchmark import FakeEmbeddings
+    from utils.ingest import ingest_directory, iter_chunks, MemoryChunkStore
+else:
+    from .utils.benchmark import FakeEmbeddings
+    from .utils.ingest import ingest_directory, iter_chunks, MemoryChunkStore
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        super().__init__(size=16, latency=0.01)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.requests.append(len(texts))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return super().embed_documents(texts)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def _write_corpus(directory, lectures=6, paragraphs=20):
+    for i in range(lectures):
+        path = directory / ("week" + str(i // 3)) / ("lecture" + str(i) + ".md")
+        path.parent.mkdir(exist_ok=True)
+        path.write_text("\n\n".join("Lecture " + str(i) + " paragraph " + str(p) + ". " + "Gradient descent. " * 10
+                                    for p in range(paragraphs)))
+
+
+def test_chunks_are_streamed_with_stable_ids(tmp_path):
+    _write_corpus(tmp_path, lectures=2)
+    (tmp_path / "notes.bin").write_bytes(b"\0")
+
+    chunks = list(iter_chunks(str(tmp_path), chunk_size=300, chunk_overlap=0))
+    assert {metadata["source"] for _, _, metadata in chunks} == {"week0/lecture0.md", "week0/lecture1.md"}
+    assert all(len(text) <= 300 for _, text, _ in chunks)
+    assert [id for id, _, _ in iter_chunks(str(tmp_path), chunk_size=300, chunk_overlap=0)] == [id for id, _, _ in chunks]
+
+
+def test_ingestion_batches_and_only_touches_deltas(tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    _write_corpus(corpus)
+    store = MemoryChunkStore()
+    embeddings = CountingEmbeddings()
+
+    report = ingest_directory(str(corpus), store, embeddings, chunk_size=300, chunk_overlap=0, max_batch_texts=8,
+                              max_batch_tokens=400, workers=3)
+    assert report["sources"] == 6 and report["embedded"] == report["chunks"] == len(store.rows) == 120
+    assert max(embeddings.requests) <= 8 and report["batches"] == store.writes == len(embeddings.requests)
+    assert 1 < embeddings.max_active <= 3
+
+    # re-ingesting an unchanged corpus embeds nothing
+    embeddings.requests.clear()
+    report = ingest_directory(str(corpus), store, embeddings, chunk_size=300, chunk_overlap=0)
+    assert report["unchanged"] == 120 and report["embedded"] == 0 and embeddings.requests == []
+
+    # an edited paragraph is re-embedded and its old chunk deleted; a removed file is only pruned on request
+    lecture = corpus / "week0" / "lecture1.md"
+    lecture.write_text(lecture.read_text().replace("Lecture 1 paragraph 5.", "Lecture 1 paragraph five."))
+    (corpus / "week1" / "lecture5.md").unlink()
+    store.add(["0b6f1c7e-legacy"], ["Lecture 0 paragraph 0."], [[0.0]], [{"source": "/uploads/lecture0.md"}]) # an earlier load
+    report = ingest_directory(str(corpus), store, embeddings, chunk_size=300, chunk_overlap=0)
+    assert (report["embedded"], report["deleted"]) == (1, 1)
+    assert len(store.rows) == 121
+
+    report = ingest_directory(str(corpus), store, embeddings, chunk_size=300, chunk_overlap=0, prune=True)
+    assert (report["embedded"], report["deleted"]) == (0, 21)
+    assert {metadata["source"] for _, _, metadata in store.rows.values()} == {"week0/lecture" + str(i) + ".md" for i in range(3)} | {"week1/lecture3.md", "week1/lecture4.md"}
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import time
+
+import pytest
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.benchmark import FakeRateLimitError, RateLimitedChatModel, SimulatedRateLimit
+    from utils.llm_scheduler import LLMScheduler, TokenBucket, llm_priority, CHAT, QUIZ, GRADING, BACKGROUND
+    from utils.text_generation import generate, agenerate, set_llm_factory, set_llm_scheduler
+else:
+    from .utils.benchmark import FakeRateLimitError, RateLimitedChatModel, SimulatedRateLimit
+    from .utils.llm_scheduler import LLMScheduler, TokenBucket, llm_priority, CHAT, QUIZ, GRADING, BACKGROUND
+    from .utils.text_generation import generate, agenerate, set_llm_factory, set_llm_scheduler
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_higher_priority_calls_go_first():
+    scheduler = LLMScheduler(requests_per_minute=None, tokens_per_minute=None, max_concurrency=1)
+    started, release = [], threading.Event()
+
+    def call(name):
+        started.append(name)
+        if name == "running":
+            release.wait()
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        executor.submit(scheduler.call, lambda: call("running"))
+        _wait_until(lambda: started == ["running"])
+        for name, priority in [("refill", BACKGROUND), ("grading", GRADING), ("quiz", QUIZ), ("chat", CHAT)]:
+            executor.submit(scheduler.call, lambda name=name: call(name), priority)
+            _wait_until(lambda: scheduler.stats()["queued"] == len(started) + ["refill", "grading", "quiz", "chat"].index(name))
+        release.set()
+
+    assert started == ["running", "chat", "quiz", "grading", "refill"]
+    assert scheduler.stats()["completed"] == 5
+
+
+def test_token_buckets_limit_request_and_token_rates():
+    scheduler = LLMScheduler(requests_per_minute=1200, tokens_per_minute=None) # 20 per second, bursts of 20
+    start = time.monotonic()
+    for _ in range(30):
+        scheduler.call(lambda: None)
+    assert 0.4 < time.monotonic() - start < 2
+
+    scheduler = LLMScheduler(requests_per_minute=None, tokens_per_minute=6000) # 100 tokens per second
+    start = time.monotonic()
+    for _ in range(4):
+        scheduler.call(lambda: None, tokens=50)
+    assert 0.8 < time.monotonic() - start < 2
+
+
+def test_calls_larger_than_the_bucket_are_charged_in_full():
+    tokens_per_minute, call_tokens = 40000, 2600 # a docs call reserves more than one second (667 tokens) of the limit
+    bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60)
+    bucket.updated = now = 0.0
+
+    admitted = []
+    while now < 600: # admit calls as fast as the bucket allows for 10 simulated minutes
+        now += bucket.wait_time(call_tokens, now)
+        bucket.take(call_tokens, now)
+        admitted.append(now)
+
+    # beyond the initial one second burst, no more than tokens_per_minute are admitted per minute
+    assert len(admitted) * call_tokens <= 10 * tokens_per_minute + bucket.capacity + call_tokens
+    for minute in range(1, 10):
+        calls = sum(1 for t in admitted if minute * 60 <= t < (minute + 1) * 60)
+        assert calls * call_tokens <= tokens_per_minute + call_tokens
+
+
+def test_backs_off_and_retries_on_rate_limits():
+    rate_limit = SimulatedRateLimit(max_concurrent=3)
+    set_llm_factory(lambda model_name, temperature: RateLimitedChatModel(rate_limit=rate_limit, latency=0.02))
+    try:
+        # without coordination a burst of grading calls is rejected
+        with ThreadPoolExecutor(max_workers=12) as executor:
+            futures = [executor.submit(generate, "Grade this answer.", "grader") for _ in range(24)]
+            errors = [future.exception() for future in futures]
+        assert any(isinstance(error, FakeRateLimitError) for error in errors)
+
+        scheduler = LLMScheduler(requests_per_minute=None, tokens_per_minute=None, max_concurrency=12,
+                                 base_delay=0.01, max_delay=0.05)
+        set_llm_scheduler(scheduler)
+        with ThreadPoolExecutor(max_workers=12) as executor:
+            responses = list(executor.map(lambda i: generate("Grade this answer.", "grader"), range(24)))
+        assert len(responses) == 24
+
+        async def burst():
+            with llm_priority(QUIZ):
+                return await asyncio.gather(*[agenerate("Grade this answer.", "grader") for _ in range(24)])
+        assert len(asyncio.run(burst())) == 24
+    finally:
+        set_llm_scheduler()
+        set_llm_factory()
+
+    stats = scheduler.stats()
+    assert stats["completed"] == 48 and stats["failed"] == 0
+    assert stats["rate_limited"] > 0 and stats["retries"] >= stats["rate_limited"]
+    assert stats["limit"] < 12 and stats["in_flight"] == 0
+    assert rate_limit.peak <= 3
+
+
+def test_streams_retry_only_before_the_first_chunk():
+    scheduler = LLMScheduler(requests_per_minute=None, tokens_per_minute=None, base_delay=0.001, max_delay=0.001)
+    attempts = []
+
+    def chunks(fail_after):
+        attempts.append(fail_after)
+        if len(attempts) == 1:
+            raise FakeRateLimitError()
+        yield "a"
+        if fail_after:
+            raise FakeRateLimitError()
+        yield "b"
+
+    assert list(scheduler.stream(lambda: chunks(False))) == ["a", "b"]
+    assert len(attempts) == 2
+
+    with pytest.raises(FakeRateLimitError):
+        list(scheduler.stream(lambda: chunks(True)))
+    assert len(attempts) == 3
+
+    stats = scheduler.stats()
+    assert (stats["completed"], stats["failed"], stats["retries"], stats["in_flight"]) == (1, 1, 1, 0)
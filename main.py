@@ -1,34 +1,167 @@
 # from datetime import datetime
 # from utils.loaders import load_document
-from better_profanity import profanity
 from datetime import datetime
+import asyncio
 import os
 
 # Fix errors when importing locally versus as submodule
 if __package__ is None or __package__ == '':
     from agent import Agent
-    from utils.vectorstore import load_vectorstore
+    from utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore, get_query_embeddings
+    from utils.answer_cache import SemanticAnswerCache
+    from utils.retrieval_cache import ConversationRetrievalCache
+    from utils.text_generation import set_conversation_cache
+    from utils.session_store import SessionStore, SESSION_STORE_PATH
+    from utils.moderation import censor
+    from utils.tracing import span
 else:
     from .agent import Agent
-    from .utils.vectorstore import load_vectorstore
+    from .utils.vectorstore import get_shared_vectorstore, aget_shared_vectorstore, get_query_embeddings
+    from .utils.answer_cache import SemanticAnswerCache
+    from .utils.retrieval_cache import ConversationRetrievalCache
+    from .utils.text_generation import set_conversation_cache
+    from .utils.session_store import SessionStore, SESSION_STORE_PATH
+    from .utils.moderation import censor
+    from .utils.tracing import span
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+COLLECTION_NAME = "corpus"
+
+# Opt-in semantic answer cache for first-turn questions, see enable_answer_cache()
+answer_cache = None
+
+# Opt-in server-side chat histories, see enable_sessions()
+session_store = None
+
+# Opt-in reuse of a chat's last retrieval on follow-up turns, see enable_retrieval_reuse()
+retrieval_cache = None
+
+
+def enable_answer_cache(max_distance=0.05, max_size=1000, ttl=24 * 60 * 60):
+    """
+    Turns on the semantic answer cache in front of run_chat() and arun_chat(). First-turn questions within max_distance
+    (cosine distance) of an already answered question are served the stored answer without retrieval or generation.
+    Follow-up turns are never cached, since the chat history changes what the question means.
+
+    Parameters:
+    - max_distance (float, optional): Largest cosine distance at which a cached answer is served. Defaults to 0.05.
+    - max_size (int, optional): Maximum number of cached answers. Defaults to 1000.
+    - ttl (float, optional): Seconds an answer stays valid. Defaults to one day.
+
+    Returns:
+    - SemanticAnswerCache: The cache, i.e. for invalidate() after re-indexing the collection or for stats().
+    """
+    global answer_cache
+    answer_cache = SemanticAnswerCache(get_query_embeddings(), max_distance=max_distance, max_size=max_size, ttl=ttl)
+    return answer_cache
+
+
+def disable_answer_cache():
+    global answer_cache
+    answer_cache = None
+
+
+def enable_retrieval_reuse(min_similarity=0.85, min_relevance=0.9, max_chats=1000, ttl=30 * 60):
+    """
+    Turns on per-chat retrieval reuse for run_chat() and friends. A follow-up turn that stays on the topic of the
+    chat's last retrieval is answered from the same documents, without a vector store query; a new search only runs
+    when the topic drifts (see ConversationRetrievalCache).
+
+    Parameters:
+    - min_similarity (float, optional): Smallest cosine similarity to the last retrieval's query at which its documents are reused. Defaults to 0.85.
+    - min_relevance (float, optional): Smallest share of their original relevance the documents must keep for the new query. Defaults to 0.9.
+    - max_chats (int, optional): Maximum number of chats kept. Defaults to 1000.
+    - ttl (float, optional): Seconds a retrieval is reused. Defaults to 30 minutes.
+
+    Returns:
+    - ConversationRetrievalCache: The cache, i.e. for invalidate() after re-indexing the collection or for stats().
+    """
+    global retrieval_cache
+    retrieval_cache = ConversationRetrievalCache(get_query_embeddings(), min_similarity=min_similarity,
+                                                 min_relevance=min_relevance, max_chats=max_chats, ttl=ttl)
+    set_conversation_cache(retrieval_cache)
+    return retrieval_cache
+
+
+def disable_retrieval_reuse():
+    global retrieval_cache
+    retrieval_cache = None
+    set_conversation_cache(None)
+
+
+def enable_sessions(path=SESSION_STORE_PATH, max_sessions=1000):
+    """
+    Turns on server-side chat histories for run_chat() and friends. Requests that leave previous_messages as None are
+    answered with the history stored for (userid, chatid), and every answered turn is appended to it, so clients
+    only send the new message. Requests that still send previous_messages use (and store) the history they send.
+
+    Parameters:
+    - path (str, optional): SQLite file that keeps sessions across restarts, or None for memory only. Defaults to SESSION_STORE_PATH.
+    - max_sessions (int, optional): Maximum number of sessions kept in memory. Defaults to 1000.
+
+    Returns:
+    - SessionStore: The store.
+    """
+    global session_store
+    session_store = SessionStore(path, max_sessions=max_sessions)
+    return session_store
+
+
+def disable_sessions():
+    global session_store
+    session_store = None
+
+
+def _load_history(userid, chatid, previous_messages):
+    if previous_messages is not None:
+        return previous_messages
+    if session_store is None:
+        return []
+    return session_store.get(userid, chatid)
+
+
+def _save_turn(userid, chatid, previous_messages, message, response):
+    if session_store is None:
+        return
+    if previous_messages is None:
+        session_store.append(userid, chatid, message, response)
+    else:
+        session_store.replace(userid, chatid, list(previous_messages) + [message, response])
+
 
 def get_vectorstore():
-    return load_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
-                            collection_name="corpus")
+    return get_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
+                                  collection_name=COLLECTION_NAME)
 
 
 def get_retriever():
     return get_vectorstore().as_retriever()
 
 
+async def aget_retriever():
+    vectorstore = await aget_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
+                                                collection_name=COLLECTION_NAME)
+    return vectorstore.as_retriever()
+
+
+NAME = "Tutor"
+# TODO: Figure out answer in backend first, then begin the helping process
+# TODO: Consider putting description in plain-text config file so it is easier to change
+DESCRIPTION = ("Tutor is a helpful AI assistant. He does his best to help students answer questions. He will say "
+               "\"I don't know.\" when he is unsure. He will not directly answer student questions but instead "
+               "prompt them towards the correct answer. \nIf information about the subject does not exist in the "
+               "CONTEXT, say \"I can't find a resource to help with that.\"")
+USER_NAME = "Student"
+USER_DESCRIPTION = ""  # Potentially abstract "User" into own class and update description overtime
+SYSTEM_PROMPT = ('### Instruction: \n{}\n### Respond in a couple of sentences. Try to keep the conversation going. '
+                 'Refuse to answer inappropriate questions.\n')
+
 # debug = True
 
-def run_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_messages=[], user_data=None, debug=False):
+def run_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_messages=None, user_data=None, debug=False):
     """
     Main function for running the chatbot.
 
@@ -37,37 +170,25 @@ def run_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_message
     - chatid (str): The ID of the chat as identified in the database.
     - message (str): The message/input to generate on/respond to.
     - previous_messages (list): The previous messages in the chat (i.e. chat history). Even indices are user messages and odd indices are AI responses.
+      None uses the history stored for the chat if sessions are enabled (see enable_sessions()), else no history.
     - user_data (dict): The user data as stored in the database. Not used in generation.
     - debug (bool): Whether or not to print verbose debug messages about the request.
 
     Returns:
     - str: The response generated by the chatbot and the current datetime.
     """
-    print(f"Request Data: \nuserid: {userid}, \nchatid: {chatid}, \nmessage: {message}, "
-          f"\nprevious_messages: {previous_messages}, \nuser_data: {user_data}\n\n")
-
-    name = "Tutor"
-    # TODO: Figure out answer in backend first, then begin the helping process
-    # TODO: Consider putting description in plain-text config file so it is easier to change
-    description = ("Tutor is a helpful AI assistant. He does his best to help students answer questions. He will say "
-                   "\"I don't know.\" when he is unsure. He will not directly answer student questions but instead "
-                   "prompt them towards the correct answer. \nIf information about the subject does not exist in the "
-                   "CONTEXT, say \"I can't find a resource to help with that.\"")
-
-    # Load Vector Store
-    retriever = get_retriever()
+    history = _load_history(userid, chatid, previous_messages)
 
-    agent = Agent(name, description)
+    agent = Agent(NAME, DESCRIPTION)
 
-    user_name = "Student"
-    user_description = ""  # Potentially abstract "User" into own class and update description overtime
-
-    system_prompt = ('### Instruction: \n{}\n### Respond in a couple of sentences. Try to keep the conversation going. '
-                     'Refuse to answer inappropriate questions.\n')
-
-    profanity.load_censor_words()
+    user_name = USER_NAME
+    user_description = USER_DESCRIPTION
+    system_prompt = SYSTEM_PROMPT
 
     if debug:
+        # Load Vector Store
+        retriever = get_retriever()
+
         try:
             while True:
                 if debug: print("============Main Loop============")
@@ -75,25 +196,132 @@ def run_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_message
                 # Run agent
                 user_input = input("Enter your question: ")
 
-                censored_input = profanity.censor(user_input)
+                censored_input = censor(user_input)
                 if debug: print(f"============User input============\n{censored_input}\n\n")
 
                 response_docs_and_history = agent.respond_with_docs_and_history(system_prompt, user_name,
                                                                                 user_description,
                                                                                 censored_input, retriever,
-                                                                                previous_messages)
+                                                                                history, chatid=chatid, userid=userid)
 
                 print(f"============Agent Response w/Docs&History============\n{response_docs_and_history}\n\n")
 
         except KeyboardInterrupt:
             print("============Exiting============")
     else:
-        censored_input = profanity.censor(message)
-        response_docs_and_history = agent.respond_with_docs_and_history(system_prompt, user_name, user_description,
-                                                                        censored_input, retriever, previous_messages)
+        with span("chat", history=len(history)) as chat:
+            censored_input = censor(message)
+
+            cache = answer_cache if not history else None
+            if cache is not None:
+                cached_response, embedding = cache.lookup(COLLECTION_NAME, censored_input)
+                if cached_response is not None:
+                    chat.set(cached=1)
+                    _save_turn(userid, chatid, previous_messages, censored_input, cached_response)
+                    return cached_response, datetime.now()
+
+            # Load Vector Store, only needed when the answer is not cached
+            retriever = get_retriever()
+
+            response_docs_and_history = agent.respond_with_docs_and_history(system_prompt, user_name, user_description,
+                                                                            censored_input, retriever, history,
+                                                                            chatid=chatid, userid=userid)
+
+            if cache is not None:
+                cache.store(COLLECTION_NAME, censored_input, response_docs_and_history, embedding)
+            _save_turn(userid, chatid, previous_messages, censored_input, response_docs_and_history)
+
+            return response_docs_and_history, datetime.now()
+
+
+async def arun_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_messages=None, user_data=None):
+    """
+    Awaitable version of run_chat() for serving many chats from one event loop. Has no interactive debug mode.
+
+    Parameters:
+    - userid (str): The ID of the user as identified in the database.
+    - chatid (str): The ID of the chat as identified in the database.
+    - message (str): The message/input to generate on/respond to.
+    - previous_messages (list): The previous messages in the chat (i.e. chat history). Even indices are user messages and odd indices are AI responses.
+      None uses the history stored for the chat if sessions are enabled (see enable_sessions()), else no history.
+    - user_data (dict): The user data as stored in the database. Not used in generation.
+
+    Returns:
+    - str: The response generated by the chatbot and the current datetime.
+    """
+    history = await asyncio.to_thread(_load_history, userid, chatid, previous_messages)
+
+    with span("chat", history=len(history)) as chat:
+        censored_input = censor(message)
+
+        cache = answer_cache if not history else None
+        if cache is not None:
+            cached_response, embedding = await cache.alookup(COLLECTION_NAME, censored_input)
+            if cached_response is not None:
+                chat.set(cached=1)
+                await asyncio.to_thread(_save_turn, userid, chatid, previous_messages, censored_input, cached_response)
+                return cached_response, datetime.now()
+
+        retriever = await aget_retriever()
+        agent = Agent(NAME, DESCRIPTION)
+
+        response_docs_and_history = await agent.arespond_with_docs_and_history(SYSTEM_PROMPT, USER_NAME, USER_DESCRIPTION,
+                                                                               censored_input, retriever, history,
+                                                                               chatid=chatid, userid=userid)
+
+        if cache is not None:
+            await cache.astore(COLLECTION_NAME, censored_input, response_docs_and_history, embedding)
+        await asyncio.to_thread(_save_turn, userid, chatid, previous_messages, censored_input, response_docs_and_history)
+
         return response_docs_and_history, datetime.now()
 
 
+def stream_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_messages=None, user_data=None):
+    """
+    Streaming version of run_chat(). Takes the same parameters (without the interactive debug mode).
+
+    Yields:
+    - dict: {"type": "token", "content": str} for each answer token as it is generated, then a final
+      {"type": "end", "response": str, "datetime": datetime, "sources": list} with the full response, the current
+      datetime and the metadata of the documents retrieved for the answer.
+    """
+    history = _load_history(userid, chatid, previous_messages)
+
+    with span("chat", history=len(history), streamed=1):
+        retriever = get_retriever()
+        agent = Agent(NAME, DESCRIPTION)
+
+        censored_input = censor(message)
+
+        for event in agent.stream_respond_with_docs_and_history(SYSTEM_PROMPT, USER_NAME, USER_DESCRIPTION, censored_input,
+                                                                retriever, history, chatid=chatid, userid=userid):
+            if event["type"] == "end":
+                event["datetime"] = datetime.now()
+                _save_turn(userid, chatid, previous_messages, censored_input, event["response"])
+            yield event
+
+
+async def astream_chat(userid="9999", chatid="9999", message="NOMESSAGE", previous_messages=None, user_data=None):
+    """
+    Async generator version of stream_chat(). Takes the same parameters and yields the same events.
+    """
+    history = await asyncio.to_thread(_load_history, userid, chatid, previous_messages)
+
+    with span("chat", history=len(history), streamed=1):
+        retriever = await aget_retriever()
+        agent = Agent(NAME, DESCRIPTION)
+
+        censored_input = censor(message)
+
+        async for event in agent.astream_respond_with_docs_and_history(SYSTEM_PROMPT, USER_NAME, USER_DESCRIPTION,
+                                                                       censored_input, retriever, history,
+                                                                       chatid=chatid, userid=userid):
+            if event["type"] == "end":
+                event["datetime"] = datetime.now()
+                await asyncio.to_thread(_save_turn, userid, chatid, previous_messages, censored_input, event["response"])
+            yield event
+
+
 if __name__ == '__main__':
     # pMessages = ["What is Deep Learning?", "That is a complex Machine Learning Topic."]
     run_chat(debug=True)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import shutil
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import get_similar
+    from utils import vectorstore
+    from utils.benchmark import FakeEmbeddings, InMemoryVectorStore
+    from utils.mmap_vectorstore import MmapVectorStore, ReadOnlyVectorStoreError, build_ivf_index
+else:
+    from . import get_similar
+    from .utils import vectorstore
+    from .utils.benchmark import FakeEmbeddings, InMemoryVectorStore
+    from .utils.mmap_vectorstore import MmapVectorStore, ReadOnlyVectorStoreError, build_ivf_index
+
+TEXTS = ["Lecture notes on topic " + str(i % 7) + ", part " + str(i) + "." for i in range(300)]
+METADATAS = [{"source": "lecture" + str(i % 7) + ".pdf", "page": i} for i in range(300)]
+
+
+def _stores(tmp_path, **kwargs):
+    embeddings = FakeEmbeddings(latency=0)
+    mmap_store = MmapVectorStore.from_texts(TEXTS, embeddings, METADATAS, path=str(tmp_path / "corpus"), **kwargs)
+    return mmap_store, InMemoryVectorStore.from_texts(TEXTS, embeddings, METADATAS)
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    mmap_store, reference = _stores(tmp_path)
+
+    for query in ["Lecture notes on topic 3, part 10.", "gradient descent", "part 299"]:
+        assert mmap_store.similarity_search(query, k=5) == reference.similarity_search(query, k=5)
+        assert mmap_store.search(query, "mmr", k=4) == reference.max_marginal_relevance_search(query, k=4)
+
+    document, distance = mmap_store.similarity_search_with_score("Lecture notes on topic 3, part 10.", k=1)[0]
+    assert document.metadata == {"source": "lecture3.pdf", "page": 10} and abs(distance) < 1e-5
+    assert mmap_store.as_retriever().get_relevant_documents("part 7")[0].page_content == reference.similarity_search("part 7", k=1)[0].page_content
+
+
+def test_ivf_index(tmp_path):
+    mmap_store, reference = _stores(tmp_path, index="ivf", nlist=16)
+    assert mmap_store.meta["index"] == {"type": "ivf", "nlist": 16}
+
+    # scanning every list is exact, scanning a few finds the exact matches of indexed documents
+    mmap_store.nprobe = 16
+    assert mmap_store.similarity_search("gradient descent", k=10) == reference.similarity_search("gradient descent", k=10)
+    mmap_store.nprobe = 2
+    for i in range(0, 300, 37):
+        assert mmap_store.similarity_search(TEXTS[i], k=1)[0].metadata["page"] == i
+
+    centroids, rows, offsets = build_ivf_index(mmap_store.vectors, nlist=16)
+    assert sorted(rows.tolist()) == list(range(300)) and offsets[-1] == 300
+
+
+def test_shared_mmap_backend_serves_get_similar(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectorstore, "default_index_path", lambda collection_name: str(tmp_path / collection_name))
+    monkeypatch.setattr(vectorstore, "_query_embeddings", FakeEmbeddings(latency=0))
+    MmapVectorStore.from_texts(TEXTS, FakeEmbeddings(latency=0), METADATAS, path=str(tmp_path / "corpus"))
+    monkeypatch.setattr(get_similar, "get_shared_vectorstore",
+                        lambda **kwargs: vectorstore.get_shared_vectorstore(backend="mmap", **kwargs))
+    try:
+        store = get_similar._get_vectorstore()
+        assert isinstance(store, MmapVectorStore) and store is get_similar._get_vectorstore()
+
+        results = get_similar.get_similar(["topic 1", "topic 2"], max_per_topic=3, dedupe=True)
+        assert [len(result[topic]) for result, topic in zip(results, ["topic 1", "topic 2"])] == [3, 3]
+        pages = [metadata["page"] for result in results for metadatas in result.values() for metadata in metadatas]
+        assert len(set(pages)) == 6
+    finally:
+        vectorstore.close_vectorstores()
+
+
+def test_store_is_replaced_atomically(tmp_path):
+    embeddings = FakeEmbeddings(latency=0)
+    old = MmapVectorStore.from_texts(TEXTS[:10], embeddings, path=str(tmp_path / "corpus"))
+    new = MmapVectorStore.from_texts(TEXTS[10:20], embeddings, path=str(tmp_path / "corpus"))
+
+    # the open store still reads the version it mapped
+    assert old.similarity_search(TEXTS[0], k=1)[0].page_content == TEXTS[0]
+    assert len(new) == 10 and new.similarity_search(TEXTS[15], k=1)[0].page_content == TEXTS[15]
+    assert np.allclose(np.linalg.norm(new.vectors, axis=1), 1, atol=1e-5)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["corpus"]
+
+    # versions are switched through the CURRENT pointer; the previous one is kept for readers that just resolved it
+    versions = lambda: sorted(p.name for p in (tmp_path / "corpus").iterdir() if p.name != "CURRENT")
+    assert len(versions()) == 2
+    newest = MmapVectorStore.from_texts(TEXTS[20:25], embeddings, path=str(tmp_path / "corpus"))
+    assert len(newest) == 5 and len(versions()) == 2
+    assert old.similarity_search(TEXTS[0], k=1)[0].page_content == TEXTS[0]
+
+    with pytest.raises(ReadOnlyVectorStoreError):
+        newest.add_texts(["another lecture"])
+
+
+def test_store_written_before_versioning_is_read_and_replaced(tmp_path):
+    embeddings = FakeEmbeddings(latency=0)
+    MmapVectorStore.from_texts(TEXTS[:10], embeddings, path=str(tmp_path / "versioned"))
+    version = (tmp_path / "versioned" / (tmp_path / "versioned" / "CURRENT").read_text())
+    shutil.copytree(version, tmp_path / "corpus")
+
+    assert len(MmapVectorStore(str(tmp_path / "corpus"), embeddings)) == 10
+    assert len(MmapVectorStore.from_texts(TEXTS[:20], embeddings, path=str(tmp_path / "corpus"))) == 20
+    # the old top-level files are kept as the previous version, then removed by the next write
+    assert (tmp_path / "corpus" / "meta.json").exists()
+    MmapVectorStore.from_texts(TEXTS[:30], embeddings, path=str(tmp_path / "corpus"))
+    assert not (tmp_path / "corpus" / "meta.json").exists()
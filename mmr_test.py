@@ -0,0 +1,33 @@
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+import numpy as np
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.mmr import batch_maximal_marginal_relevance
+else:
+    from .utils.mmr import batch_maximal_marginal_relevance
+
+
+def test_batch_mmr_matches_per_query_mmr():
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(6, 16))
+    candidates = [rng.normal(size=(n, 16)) for n in (20, 20, 7, 20, 1, 0)]
+
+    batched = batch_maximal_marginal_relevance(queries, candidates, k=5, lambda_mult=0.5)
+
+    for query, query_candidates, selection in zip(queries, candidates, batched):
+        expected = maximal_marginal_relevance(query, list(query_candidates), lambda_mult=0.5, k=5)
+        assert selection == sorted(expected)
+
+
+def test_batch_mmr_dedupes_across_queries():
+    rng = np.random.default_rng(1)
+    shared = rng.normal(size=(10, 8))
+    queries = [shared[0], shared[0] + 0.01]
+    ids = [list(range(10)), list(range(10))]
+
+    selections = batch_maximal_marginal_relevance(queries, [shared, shared], k=3, candidate_ids=ids)
+
+    assert len(selections[0]) == 3 and len(selections[1]) == 3
+    assert not set(selections[0]) & set(selections[1])
+    assert 0 in selections[0]  # the first query gets the first pick of the shared best match
@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from better_profanity import Profanity
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.moderation import ProfanityFilter, censor, get_profanity_filter
+else:
+    from .utils.moderation import ProfanityFilter, censor, get_profanity_filter
+
+
+def test_censors_whole_words_and_leetspeak():
+    assert censor("a shit ton of data and a sh1t model, you a$$hole?") == "a **** ton of data and a **** model, you ****?"
+    assert censor("SHIT happens") == "**** happens"
+    assert censor("assessment of class") == "assessment of class"
+    assert censor("Explain gradient descent") == "Explain gradient descent"
+
+
+def test_censors_phrases_with_or_without_separators():
+    assert censor("a bull shit answer") == "a **** answer"
+    assert censor("f-u-c-k, f.u.c.k and f u c k") == "****, **** and ****"
+    assert censor("hand job, handjob") == "****, ****"
+
+
+def test_custom_words_and_whitelist():
+    moderation = ProfanityFilter(words=["ponies", "bad word"], whitelist=["ponies"])
+    assert moderation.censor("no ponies, no b4d word") == "no ponies, no ****"
+    assert moderation.contains_profanity("BAD WORD!")
+    assert not moderation.contains_profanity("badword!")
+
+
+def test_shared_filter_is_thread_safe():
+    texts = ["you a$$hole number " + str(i) for i in range(200)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(censor, texts))
+    assert results == ["you **** number " + str(i) for i in range(200)]
+    assert get_profanity_filter() is get_profanity_filter()
+
+
+def test_matches_better_profanity_except_where_it_misses_phrases():
+    reference = Profanity()
+    reference.load_censor_words()
+    for text in ["a shit ton of data", "you a$$hole?", "what the sh!t is this", "sh!t happens", "f-u-c-k you",
+                 "a bull shit answer", "s h i t happens", "assessment of class", "Explain gradient descent"]:
+        assert censor(text) == reference.censor(text)
+
+    # better_profanity leaves a phrase ending in a one character word at the end of the text, and the rest of a
+    # phrase that extends a shorter censored one, uncensored
+    assert (reference.censor("this is sh!t"), censor("this is sh!t")) == ("this is sh!t", "this is ****")
+    assert (reference.censor("f-u-c-k"), censor("f-u-c-k")) == ("f-u-c-k", "****")
+    assert (reference.censor("p.u.s.s.y. ok"), censor("p.u.s.s.y. ok")) == ("****.y. ok", "****. ok")
@@ -0,0 +1,62 @@
+import pytest
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.quiz_parser import QuizStreamParser, QuizFormatError
+    from generate_quizzes_offline_test import fake_quiz
+else:
+    from .utils.quiz_parser import QuizStreamParser, QuizFormatError
+    from .generate_quizzes_offline_test import fake_quiz
+
+
+MC_QUESTION = ("1. In supervised learning, what is the main characteristic of the training data?\nTopic: Supervised learning\n"
+               "Type: MULTIPLE_CHOICE\nA) It is labeled\nB) It is unlabeled\nC) It contains missing values\n"
+               "D) It is not used for training\nAnswer: A) It is labeled\n")
+
+
+def test_emits_each_question_at_its_divider():
+    quiz = fake_quiz(3, "svm") + "------DIVIDER------\n"
+    parser = QuizStreamParser(3, "svm, trees", "TRUE_FALSE")
+
+    emitted = []
+    for i in range(0, len(quiz), 7): # arbitrary token boundaries
+        emitted.append(len(parser.feed(quiz[i:i+7])))
+
+    assert sum(emitted) == 3
+    body = parser.close()
+    assert [question["choices"] for question in body["questions"]] == ["True@False"] * 3
+    assert body["questions"][0]["answer"] == "A) True"
+
+
+def test_last_question_without_divider_is_parsed_on_close():
+    parser = QuizStreamParser(2, "Supervised learning", "MULTIPLE_CHOICE")
+
+    assert parser.feed(MC_QUESTION + "------DIVIDER------\n") != []
+    assert parser.feed(MC_QUESTION.replace("1. ", "2. ")) == []
+
+    body = parser.close()
+    assert len(body["questions"]) == 2
+    assert body["questions"][1]["choices"] == "It is labeled@It is unlabeled@It contains missing values@It is not used for training"
+
+
+def test_raises_at_first_bad_section():
+    parser = QuizStreamParser(4, "svm", "TRUE_FALSE")
+    parser.feed(fake_quiz(1, "svm") + "------DIVIDER------\n")
+
+    with pytest.raises(QuizFormatError):
+        parser.feed(fake_quiz(1, "ponies") + "------DIVIDER------\n")
+
+
+def test_raises_when_question_count_is_wrong():
+    parser = QuizStreamParser(2, "svm", "TRUE_FALSE")
+    parser.feed(fake_quiz(1, "svm"))
+    with pytest.raises(QuizFormatError):
+        parser.close()
+
+    parser = QuizStreamParser(2, "svm", "TRUE_FALSE")
+    with pytest.raises(QuizFormatError): # too many questions is known before the stream ends
+        parser.feed(fake_quiz(3, "svm") + "------DIVIDER------\n")
+
+    parser = QuizStreamParser(2, "svm", "TRUE_FALSE")
+    with pytest.raises(QuizFormatError): # a malformed line is a format error too
+        parser.feed("1.What is a kernel?\nTopic: svm\n------DIVIDER------\n")
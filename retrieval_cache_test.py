@@ -0,0 +1,139 @@
+import asyncio
+
+from langchain_core.embeddings import Embeddings
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import main
+    from agent_test import InMemoryRetriever, _use_fake_llm
+    from utils.retrieval_cache import ConversationRetrievalCache
+    from utils.mmap_vectorstore import MmapVectorStore
+    from utils.text_generation import set_llm_factory
+    from langchain_core.documents import Document
+else:
+    from . import main
+    from .agent_test import InMemoryRetriever, _use_fake_llm
+    from .utils.retrieval_cache import ConversationRetrievalCache
+    from .utils.mmap_vectorstore import MmapVectorStore
+    from .utils.text_generation import set_llm_factory
+    from langchain_core.documents import Document
+
+TOPICS = ["overfitting", "regularization", "convolution", "gradient"]
+
+
+# follow-ups without a topic word, embedded close to the overfitting question they follow
+FOLLOW_UPS = {"Can you explain that more?": [0.95, 0.2, 0.0, 0.0, 0.0], "Why does that happen?": [0.9, 0.0, 0.0, 0.0, 0.3]}
+
+
+class TopicEmbeddings(Embeddings):
+    """One dimension per topic word, so questions about different topics are far apart."""
+
+    def __init__(self):
+        self.queries = 0
+
+    def _embed(self, text):
+        return FOLLOW_UPS.get(text) or [1.0 if topic in text.lower() else 0.0 for topic in TOPICS] + [0.1]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.queries += 1
+        return self._embed(text)
+
+
+class CountingRetriever(InMemoryRetriever):
+    calls: int = 0
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        self.calls += 1
+        return self.documents
+
+
+def test_follow_ups_reuse_documents_until_the_topic_drifts():
+    cache = ConversationRetrievalCache(TopicEmbeddings())
+    retriever = CountingRetriever(documents=[Document(page_content="Overfitting is when a model memorizes noise.")])
+
+    first = cache.retrieve("chat1", "scope", "What is overfitting?", retriever)
+    assert cache.retrieve("chat1", "scope", "Can you explain that more?", retriever) is first
+    assert retriever.calls == 1
+
+    cache.retrieve("chat1", "scope", "And what is a convolution?", retriever) # drifted
+    cache.retrieve("chat2", "scope", "Can you explain that more?", retriever) # other chat
+    cache.retrieve("chat2", "other scope", "Can you explain that more?", retriever) # other collection
+    assert retriever.calls == 4
+    assert cache.stats() == {"hits": 1, "misses": 4, "size": 2}
+
+    cache.forget("chat2")
+    assert cache.stats()["size"] == 1
+
+
+def test_vector_search_keeps_document_embeddings(tmp_path):
+    embeddings = TopicEmbeddings()
+    texts = ["Overfitting is when a model memorizes noise.", "A convolution slides a filter over the input.",
+             "Gradient descent follows the negative gradient."]
+    store = MmapVectorStore.from_texts(texts, embeddings, [{"source": str(i)} for i in range(3)], path=str(tmp_path / "corpus"))
+    cache = ConversationRetrievalCache(embeddings)
+    retriever = store.as_retriever(search_kwargs={"k": 1})
+
+    embeddings.queries = 0
+    documents = asyncio.run(cache.aretrieve("chat1", "scope", "How do overfitting and regularization relate?", retriever))
+    assert [document.metadata["source"] for document in documents] == ["0"]
+    assert embeddings.queries == 1 # the store searched with the cache's query embedding
+
+    # not close to the first question, but the retrieved document is even more relevant to it
+    assert cache.retrieve("chat1", "scope", "Overfitting example?", retriever) is documents
+    assert cache.retrieve("chat1", "scope", "What is gradient descent?", retriever)[0].metadata["source"] == "2"
+    assert cache.stats()["hits"] == 1
+
+
+def test_run_chat_reuses_retrieval_for_follow_ups(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+    retriever = CountingRetriever(documents=[Document(page_content="Overfitting is when a model memorizes noise.")])
+    monkeypatch.setattr(main, "get_retriever", lambda: retriever)
+    monkeypatch.setattr(main, "get_query_embeddings", TopicEmbeddings)
+
+    cache = main.enable_retrieval_reuse()
+    try:
+        history = []
+        for message in ["What is overfitting?", "Can you explain that more?", "Why does that happen?"]:
+            response, _ = main.run_chat(chatid="42", message=message, previous_messages=history)
+            history = history + [message, response]
+        main.run_chat(chatid="43", message="Can you explain that more?", previous_messages=[])
+    finally:
+        main.disable_retrieval_reuse()
+        set_llm_factory()
+
+    assert retriever.calls == 2
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 2}
+
+
+def test_chats_of_different_users_do_not_share_retrievals(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+    retriever = CountingRetriever(documents=[Document(page_content="Overfitting is when a model memorizes noise.")])
+    monkeypatch.setattr(main, "get_retriever", lambda: retriever)
+    monkeypatch.setattr(main, "get_query_embeddings", TopicEmbeddings)
+
+    cache = main.enable_retrieval_reuse()
+    try:
+        main.run_chat(userid="1", chatid="42", message="What is overfitting?", previous_messages=[])
+        main.run_chat(userid="2", chatid="42", message="Can you explain that more?", previous_messages=[])
+    finally:
+        main.disable_retrieval_reuse()
+        set_llm_factory()
+
+    assert retriever.calls == 2
+    assert cache.stats() == {"hits": 0, "misses": 2, "size": 2}
+
+
+def test_retrievers_with_search_settings_besides_k_run_their_own_search(tmp_path):
+    embeddings = TopicEmbeddings()
+    texts = ["Overfitting is when a model memorizes noise.", "A convolution slides a filter over the input."]
+    store = MmapVectorStore.from_texts(texts, embeddings, [{"source": str(i)} for i in range(2)], path=str(tmp_path / "corpus"))
+    cache = ConversationRetrievalCache(embeddings)
+    retriever = store.as_retriever(search_kwargs={"k": 1, "filter": {"source": "0"}})
+
+    embeddings.queries = 0
+    documents = cache.retrieve("chat1", "scope", "What is overfitting?", retriever)
+    assert [document.metadata["source"] for document in documents] == ["0"]
+    assert embeddings.queries == 2 # searched through the retriever, which keeps the filter
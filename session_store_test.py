@@ -0,0 +1,38 @@
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    from utils.session_store import SessionStore
+else:
+    from .utils.session_store import SessionStore
+
+
+def test_append_and_get():
+    store = SessionStore(None)
+    store.append("u1", "c1", "Hi", "Hello!")
+    store.append("u1", "c1", "What is overfitting?", "What do you think?")
+    store.append("u1", "c2", "Other chat", "Sure.")
+
+    assert store.get("u1", "c1") == ["Hi", "Hello!", "What is overfitting?", "What do you think?"]
+    assert store.get("u2", "c1") == []
+
+
+def test_sessions_survive_restart_and_eviction(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SessionStore(path, max_sessions=1)
+    store.append("u1", "c1", "Hi", "Hello!")
+    store.append("u1", "c2", "Hey", "Hi there!") # evicts c1 from memory
+    store.append("u1", "c1", "Again", "Yes?")
+
+    assert store.get("u1", "c1") == ["Hi", "Hello!", "Again", "Yes?"]
+    store.close()
+
+    restarted = SessionStore(path)
+    assert restarted.get("u1", "c1") == ["Hi", "Hello!", "Again", "Yes?"]
+    assert restarted.get("u1", "c2") == ["Hey", "Hi there!"]
+
+    restarted.replace("u1", "c2", ["Edited", "Ok."])
+    restarted.delete("u1", "c1")
+    restarted.close()
+
+    restarted = SessionStore(path)
+    assert restarted.get("u1", "c2") == ["Edited", "Ok."]
+    assert restarted.get("u1", "c1") == []
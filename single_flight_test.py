@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import time
+
+import pytest
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import generate_quizzes
+    import get_similar
+    from utils.benchmark import offline
+    from utils.single_flight import SingleFlight
+else:
+    from . import generate_quizzes
+    from . import get_similar
+    from .utils.benchmark import offline
+    from .utils.single_flight import SingleFlight
+
+
+def test_concurrent_thread_calls_share_one_execution():
+    flights = SingleFlight("test")
+    runs = []
+
+    def compute():
+        runs.append(1)
+        time.sleep(0.1)
+        return {"questions": [1, 2]}
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: flights.do("key", compute), range(8)))
+
+    assert len(runs) == 1 and all(result == {"questions": [1, 2]} for result in results)
+    results[0]["questions"].append(3) # every caller got its own copy
+    assert results[1] == {"questions": [1, 2]}
+    assert flights.stats() == {"calls": 8, "executions": 1, "collapsed": 7, "in_flight": 0}
+
+    flights.do("key", compute) # nothing is cached once a flight lands
+    assert len(runs) == 2
+
+
+def test_errors_reach_every_caller():
+    flights = SingleFlight("test")
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError("no quiz")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flights.do, "key", fail) for _ in range(4)]
+    assert all(isinstance(future.exception(), ValueError) for future in futures)
+    assert flights.stats()["executions"] == 1
+
+
+def test_async_and_thread_callers_share_flights():
+    flights = SingleFlight("test")
+    runs = []
+
+    async def compute():
+        runs.append(1)
+        await asyncio.sleep(0.1)
+        return [1]
+
+    async def main():
+        leader = asyncio.ensure_future(flights.ado("key", compute))
+        await asyncio.sleep(0.01)
+        thread_result = asyncio.to_thread(flights.do, "key", lambda: runs.append("thread"))
+        followers = asyncio.gather(*[flights.ado("key", compute) for _ in range(5)])
+        leader.cancel() # the caller that started the flight leaves, the others still get the result
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await thread_result, await followers
+
+    thread_result, results = asyncio.run(main())
+    assert runs == [1] and thread_result == [1] and results == [[1]] * 5
+    assert flights.stats() == {"calls": 7, "executions": 1, "collapsed": 6, "in_flight": 0}
+
+
+def test_identical_quiz_and_similar_requests_are_coalesced():
+    start = threading.Barrier(6)
+
+    def request(i):
+        start.wait()
+        if i % 2:
+            return get_similar.get_similar(["Overfitting", "clustering"] if i < 3 else ["overfitting ", "Clustering"])
+        return generate_quizzes.generate_quiz(4, "TRUE_FALSE, MULTIPLE_CHOICE", "overfitting, clustering" if i else "Clustering,overfitting")
+
+    quiz_flights, similar_flights = generate_quizzes.quiz_flights, get_similar.similar_flights
+    generate_quizzes.quiz_flights, get_similar.similar_flights = SingleFlight("quiz"), SingleFlight("similar")
+    try:
+        with offline(llm_latency=0.2, embedding_latency=0.2):
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                results = list(executor.map(request, range(6)))
+        stats = generate_quizzes.quiz_flights.stats(), get_similar.similar_flights.stats()
+    finally:
+        generate_quizzes.quiz_flights, get_similar.similar_flights = quiz_flights, similar_flights
+
+    quizzes, searches = results[0::2], results[1::2]
+    assert quizzes[0] == quizzes[1] == quizzes[2] and len(quizzes[0]["questions"]) == 4
+    assert [list(result) for result in searches[2]] == [["overfitting "], ["Clustering"]]
+    assert [list(result.values()) for result in searches[2]] == [list(result.values()) for result in searches[0]]
+    assert stats == ({"calls": 3, "executions": 1, "collapsed": 2, "in_flight": 0},
+                     {"calls": 3, "executions": 1, "collapsed": 2, "in_flight": 0})
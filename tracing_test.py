@@ -0,0 +1,77 @@
+import asyncio
+import json
+import io
+
+# fix errors when importing locally versus as submodule
+if __package__ is None or __package__ == '':
+    import main
+    import generate_quizzes
+    from agent_test import _use_fake_llm, _retriever
+    from generate_quizzes_offline_test import _setup, _use_grading_model, fake_quiz, GRADED_QUESTIONS
+    from utils.code_runner import CodeRunnerClient, StubCodeRunner
+    from utils.tracing import span, enable_tracing, disable_tracing, chain_config, JsonLinesSink
+else:
+    from . import main
+    from . import generate_quizzes
+    from .agent_test import _use_fake_llm, _retriever
+    from .generate_quizzes_offline_test import _setup, _use_grading_model, fake_quiz, GRADED_QUESTIONS
+    from .utils.code_runner import CodeRunnerClient, StubCodeRunner
+    from .utils.tracing import span, enable_tracing, disable_tracing, chain_config, JsonLinesSink
+
+
+def test_spans_are_noops_while_disabled():
+    disable_tracing()
+    with span("parse", questions=3) as s:
+        s.set(retries=1)
+    assert not s
+    assert chain_config() is None
+
+
+def test_quiz_generation_and_grading_stages(monkeypatch):
+    _setup(monkeypatch, fail_once=["a"])
+    sink = enable_tracing()
+    try:
+        assert len(generate_quizzes.generate_quiz(4, "TRUE_FALSE", "a")["questions"]) == 4
+
+        _use_grading_model(monkeypatch)
+        with StubCodeRunner() as runner:
+            monkeypatch.setattr(generate_quizzes, "code_runner", CodeRunnerClient(runner.url))
+            generate_quizzes.grade_quiz(GRADED_QUESTIONS)
+    finally:
+        disable_tracing()
+
+    stages = sink.snapshot()
+    assert stages["profanity"]["count"] == 1
+    assert stages["quiz_attempt"]["count"] == 2 and stages["quiz_attempt"]["errors"] == 1
+    assert stages["quiz_chunk"]["retries"] == 1 and stages["quiz_chunk"]["failed"] == 0
+    assert stages["retrieval"]["documents"] == 2
+    assert stages["grade_quiz"]["count"] == 1 and stages["grading"]["count"] == 2
+    assert stages["code_run"]["ran"] == 0 # the CODING answer has a syntax error
+    # 2 generation attempts, rubric extraction, the scoring samples and the code syntax check
+    assert stages["llm"]["count"] == 2 + 1 + generate_quizzes.GRADING_SAMPLES + 1
+    assert stages["llm"]["prompt_tokens"] > 0 and stages["llm"]["completion_tokens"] > 0
+
+    metrics = sink.render()
+    assert 'main_agent_stage_total{stage="quiz_attempt",status="error"} 1' in metrics
+    assert 'main_agent_stage_seconds_bucket{stage="llm",le="+Inf"} 7' in metrics
+    assert 'main_agent_retries_total{stage="quiz_chunk"} 1' in metrics
+
+
+def test_chat_stages_to_json_lines(monkeypatch):
+    _use_fake_llm(["Think about the training error."])
+
+    async def fake_aget_retriever():
+        return _retriever()
+    monkeypatch.setattr(main, "aget_retriever", fake_aget_retriever)
+    output = io.StringIO()
+    enable_tracing(JsonLinesSink(output))
+    try:
+        asyncio.run(main.arun_chat(message="What is overfitting?", previous_messages=["Hi", "Hello!"]))
+        assert generate_quizzes._parse_quiz(fake_quiz(2, "a", type="ESSAY"), 2, "a", "TRUE_FALSE") == False
+    finally:
+        disable_tracing()
+
+    spans = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [s["stage"] for s in spans] == ["profanity", "retrieval", "context_packing", "llm", "chat", "parse"]
+    assert spans[4]["history"] == 2 and spans[4]["error"] is None
+    assert spans[5]["error"] == "QuizFormatError"
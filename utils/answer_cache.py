@@ -0,0 +1,136 @@
+import numpy as np
+import threading
+import asyncio
+import time
+
+
+class _CollectionIndex:
+    """Normalized question embeddings of one collection, one row per cached answer."""
+
+    def __init__(self, dimensions):
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.entries = []  # (question, answer, created)
+        self.last_used = np.zeros(0)
+
+    def remove(self, row):
+        self.vectors = np.delete(self.vectors, row, axis=0)
+        self.last_used = np.delete(self.last_used, row)
+        del self.entries[row]
+
+
+class SemanticAnswerCache:
+    """
+    Response cache that serves a stored answer when a new question is semantically close to one answered before.
+
+    Questions are embedded and compared by cosine distance against a small in-memory index per collection. The least
+    recently used entry is evicted once the cache is full, and invalidate() drops a collection's answers (i.e. after
+    the collection is re-indexed). Only cache answers whose meaning does not depend on chat history.
+    """
+
+    def __init__(self, embeddings, max_distance=0.05, max_size=1000, ttl=24 * 60 * 60):
+        """
+        Parameters:
+        - embeddings (Embeddings): The embeddings function used for questions.
+        - max_distance (float, optional): Largest cosine distance at which a cached answer is served. Defaults to 0.05.
+        - max_size (int, optional): Maximum number of answers cached across all collections. Defaults to 1000.
+        - ttl (float, optional): Seconds an answer stays valid. None never expires. Defaults to one day.
+        """
+        self.embeddings = embeddings
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.array(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _size(self):
+        return sum(len(index.entries) for index in self._indexes.values())
+
+    def _match(self, collection, vector):
+        now = time.time()
+        with self._lock:
+            index = self._indexes.get(collection)
+            if index is not None and index.entries:
+                distances = 1.0 - index.vectors @ vector
+                row = int(np.argmin(distances))
+                question, answer, created = index.entries[row]
+                if self.ttl is not None and now - created > self.ttl:
+                    index.remove(row)
+                elif distances[row] <= self.max_distance:
+                    index.last_used[row] = now
+                    self.hits += 1
+                    return answer
+            self.misses += 1
+            return None
+
+    def lookup(self, collection, question):
+        """
+        Parameters:
+        - collection (str): The collection the answer was generated from.
+        - question (str): The new question.
+
+        Returns:
+        - tuple: The cached answer (or None on a miss) and the question's embedding, to pass on to store().
+        """
+        embedding = self.embeddings.embed_query(question)
+        return self._match(collection, self._normalize(embedding)), embedding
+
+    async def alookup(self, collection, question):
+        """Awaitable version of lookup()."""
+        embedding = await self.embeddings.aembed_query(question)
+        return self._match(collection, self._normalize(embedding)), embedding
+
+    def store(self, collection, question, answer, embedding=None):
+        """
+        Caches an answer, evicting the least recently used answer if the cache is full.
+
+        Parameters:
+        - collection (str): The collection the answer was generated from.
+        - question (str): The question that was answered.
+        - answer (str): The answer to serve for close questions.
+        - embedding (list, optional): The question's embedding as returned by lookup(). Embedded again if None.
+        """
+        vector = self._normalize(embedding if embedding is not None else self.embeddings.embed_query(question))
+        now = time.time()
+        with self._lock:
+            index = self._indexes.get(collection)
+            if index is None:
+                index = self._indexes[collection] = _CollectionIndex(len(vector))
+            index.vectors = np.vstack([index.vectors, vector[None, :]])
+            index.entries.append((question, answer, now))
+            index.last_used = np.append(index.last_used, now)
+
+            while self._size() > self.max_size:
+                oldest = min((index.last_used.min(), name) for name, index in self._indexes.items() if index.entries)[1]
+                self._indexes[oldest].remove(int(np.argmin(self._indexes[oldest].last_used)))
+
+    async def astore(self, collection, question, answer, embedding=None):
+        """Awaitable version of store()."""
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(question)
+        await asyncio.to_thread(self.store, collection, question, answer, embedding)
+
+    def invalidate(self, collection=None):
+        """Drops every cached answer of a collection, or of all collections if collection is None."""
+        with self._lock:
+            if collection is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(collection, None)
+
+    def stats(self):
+        """
+        Returns:
+        - dict: Hit/miss counters and the number of cached answers.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._size()}
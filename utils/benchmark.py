@@ -0,0 +1,406 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from collections import deque
+import itertools
+import threading
+import hashlib
+import math
+import json
+import time
+import sys
+import os
+import re
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.vectorstores import VectorStore
+
+from .text_generation import set_llm_factory
+from .mmr import batch_maximal_marginal_relevance
+from .quiz_parser import DIVIDER
+
+SCENARIOS = ["run_chat", "generate_quiz", "_parse_quiz", "grade_quiz", "get_similar"]
+CONCURRENCY_LEVELS = [1, 4, 16]
+
+LLM_LATENCY = 0.05 # seconds per fake chat model call
+TOKEN_LATENCY = 0.0 # extra seconds per streamed line of the fake chat model
+EMBEDDING_LATENCY = 0.01 # seconds per fake embeddings request
+EMBEDDING_SIZE = 256
+
+TOPICS = ["overfitting", "regularization", "gradient descent", "decision trees", "neural networks", "clustering"]
+
+CHAT_RESPONSE = "What do you think happens to the training error as the model gets more complex?"
+
+
+def _fake_section(number, topic, type, batch):
+    question = str(number) + ". Question " + str(batch) + "-" + str(number) + " about " + topic + "?\nTopic: " + topic + "\nType: " + type + "\n"
+    if type == "TRUE_FALSE":
+        return question + "A) True\nB) False\nAnswer: A) True\n"
+    if type == "MULTIPLE_CHOICE":
+        return question + "A) One\nB) Two\nC) Three\nD) Four\nAnswer: A) One\n"
+    if type == "CODING":
+        return question + "Answer: '''def f(x):\n    return x'''\n"
+    return question + "Answer: " + topic + " trades bias for variance. It is controlled by the model capacity.\n"
+
+
+class FakeChatModel(SimpleChatModel):
+    """
+    Deterministic chat model for benchmarks. Answers quiz prompts with a well-formed quiz of the requested size,
+    topics and types, grading prompts with answer points and "yes, no" scores, and everything else (chat turns,
+    history summaries) with CHAT_RESPONSE. Every call sleeps for latency seconds, and streamed calls for token_latency
+    more per line, to stand in for the API round trip without using the CPU.
+    """
+
+    latency: float = LLM_LATENCY
+    token_latency: float = TOKEN_LATENCY
+    batches: itertools.count = itertools.count(1) # keeps generated question texts unique
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark-chat-model"
+
+    def _respond(self, prompt):
+        quiz = re.search(r"exactly (\d+)questions on the following question topics: (.*?), and only using the "
+                         r"following types of questions: (.*?)\. ", prompt)
+        if quiz:
+            topics = [topic.strip() for topic in quiz.group(2).split(",")]
+            types = [type.strip() for type in quiz.group(3).split(",")]
+            batch = next(self.batches)
+            return DIVIDER.join(_fake_section(i + 1, topics[i % len(topics)], types[i % len(types)], batch)
+                                for i in range(int(quiz.group(1))))
+        if "split it up into its logical points" in prompt:
+            return "- point 1\n- point 2"
+        if "Score the user-supplied code" in prompt:
+            return "0.5"
+        if "pieces of information are mentioned" in prompt:
+            return "yes, no"
+        return CHAT_RESPONSE
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return self._respond(messages[-1].content)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for line in self._respond(messages[-1].content).splitlines(keepends=True):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=line))
+
+
+class FakeRateLimitError(Exception):
+    """Rate limit error of the simulated API, shaped like openai.RateLimitError (status_code 429)."""
+
+    status_code = 429
+
+
+class SimulatedRateLimit:
+    """
+    The rate limits of a simulated API: calls beyond max_concurrent in flight, or beyond requests_per_second over
+    the last second, are rejected with FakeRateLimitError. Thread-safe, shared by every model using it.
+    """
+
+    def __init__(self, max_concurrent=4, requests_per_second=None):
+        self.max_concurrent = max_concurrent
+        self.requests_per_second = requests_per_second
+        self.in_flight = 0
+        self.peak = 0 # most calls in flight at once
+        self.accepted = 0
+        self.rejected = 0
+        self._recent = deque() # start times of the calls of the last second
+        self._lock = threading.Lock()
+
+    def enter(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 1:
+                self._recent.popleft()
+            if self.in_flight >= self.max_concurrent or (self.requests_per_second is not None and
+                                                         len(self._recent) >= self.requests_per_second):
+                self.rejected += 1
+                raise FakeRateLimitError("Rate limit reached, please try again later.")
+            self.accepted += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            self._recent.append(now)
+
+    def exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class RateLimitedChatModel(FakeChatModel):
+    """FakeChatModel behind a SimulatedRateLimit, for testing how callers cope with 429s."""
+
+    rate_limit: SimulatedRateLimit
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        self.rate_limit.enter()
+        try:
+            return super()._call(messages, stop, run_manager, **kwargs)
+        finally:
+            self.rate_limit.exit()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.rate_limit.enter()
+        try:
+            yield from super()._stream(messages, stop, run_manager, **kwargs)
+        finally:
+            self.rate_limit.exit()
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings: each text maps to a unit vector seeded by its hash. Each request sleeps for latency seconds."""
+
+    def __init__(self, size=EMBEDDING_SIZE, latency=EMBEDDING_LATENCY):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).normal(size=self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class InMemoryVectorStore(VectorStore):
+    """Brute-force cosine similarity vector store kept in a NumPy matrix, for benchmarks and tests without Postgres."""
+
+    def __init__(self, embedding):
+        self.embedding = embedding
+        self.documents = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = np.array(self.embedding.embed_documents(texts), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        ids = [str(len(self.documents) + i) for i in range(len(texts))]
+        self.documents.extend(Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas))
+        self.vectors = vectors if len(self.vectors) == 0 else np.vstack([self.vectors, vectors])
+        return ids
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        vectorstore = cls(embedding)
+        vectorstore.add_texts(texts, metadatas)
+        return vectorstore
+
+    def _nearest(self, embedding, k):
+        similarity = self.vectors @ np.asarray(embedding, dtype=np.float32)
+        order = np.argsort(-similarity)[:k]
+        return [(int(i), float(similarity[i])) for i in order]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return [(self.documents[i], 1 - similarity) for i, similarity in self._nearest(self.embedding.embed_query(query), k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        embedding = self.embedding.embed_query(query)
+        candidates = [i for i, _ in self._nearest(embedding, fetch_k)]
+        selection = batch_maximal_marginal_relevance([embedding], [self.vectors[candidates]], k=k,
+                                                     lambda_mult=lambda_mult)[0]
+        return [self.documents[candidates[i]] for i in selection]
+
+
+def build_corpus(embeddings, num_documents=500):
+    """Builds an InMemoryVectorStore of num_documents fake lecture chunks spread over TOPICS."""
+
+    texts = ["Lecture notes on " + TOPICS[i % len(TOPICS)] + ", part " + str(i) + "." for i in range(num_documents)]
+    metadatas = [{"source": "lecture" + str(i % 20) + ".pdf", "page": i} for i in range(num_documents)]
+    return InMemoryVectorStore.from_texts(texts, embeddings, metadatas)
+
+
+@contextmanager
+def offline(llm_latency=LLM_LATENCY, embedding_latency=EMBEDDING_LATENCY, token_latency=TOKEN_LATENCY,
+            num_documents=500):
+    """
+    Swaps in a FakeChatModel, FakeEmbeddings, an InMemoryVectorStore corpus, an in-memory rubric cache and a local stub
+    code runner for main, generate_quizzes and get_similar, and restores everything on exit. Opt-in caches (answer
+    cache, quiz bank, sessions) are left as they are, so they are off unless enabled.
+
+    Yields:
+    - InMemoryVectorStore: The corpus every entry point searches.
+    """
+    # imported here so the fake environment is in place before anything connects
+    from .rubric_cache import RubricCache
+    from .code_runner import CodeRunnerClient, StubCodeRunner
+    if __package__ in (None, "", "utils"):
+        import main, generate_quizzes, get_similar
+    else:
+        from .. import main, generate_quizzes, get_similar
+
+    model = FakeChatModel(latency=llm_latency, token_latency=token_latency)
+    vectorstore = build_corpus(FakeEmbeddings(latency=embedding_latency), num_documents)
+
+    def shared_vectorstore(**kwargs):
+        return vectorstore
+
+    async def ashared_vectorstore(**kwargs):
+        return vectorstore
+
+    with StubCodeRunner() as runner:
+        patches = [(module, name, value) for module in (main, generate_quizzes, get_similar)
+                   for name, value in (("get_shared_vectorstore", shared_vectorstore),
+                                       ("aget_shared_vectorstore", ashared_vectorstore))]
+        patches += [(generate_quizzes, "rubric_cache", RubricCache(":memory:")),
+                    (generate_quizzes, "code_runner", CodeRunnerClient(runner.url))]
+        saved = [(module, name, getattr(module, name)) for module, name, _ in patches]
+        for module, name, value in patches:
+            setattr(module, name, value)
+        set_llm_factory(lambda model_name, temperature: model)
+        try:
+            yield vectorstore
+        finally:
+            set_llm_factory(None)
+            generate_quizzes.code_runner.close()
+            generate_quizzes.rubric_cache.close()
+            for module, name, value in saved:
+                setattr(module, name, value)
+
+
+def _scenario(name, request):
+    """Returns a function running one request (numbered request) of the named scenario."""
+
+    if __package__ in (None, "", "utils"):
+        import main, generate_quizzes, get_similar
+    else:
+        from .. import main, generate_quizzes, get_similar
+
+    topics = TOPICS[request % len(TOPICS)] + ", " + TOPICS[(request + 1) % len(TOPICS)]
+    if name == "run_chat":
+        history = ["What is " + TOPICS[request % len(TOPICS)] + "?", CHAT_RESPONSE]
+        return lambda: main.run_chat(userid=str(request), chatid=str(request), message="Why does that happen?",
+                                     previous_messages=history)
+    if name == "generate_quiz":
+        return lambda: generate_quizzes.generate_quiz(10, "MULTIPLE_CHOICE, TRUE_FALSE, SHORT_ANSWER", topics)
+    if name == "_parse_quiz":
+        quiz = FakeChatModel(latency=0)._respond(generate_quizzes._quiz_prompt(10, "MULTIPLE_CHOICE, TRUE_FALSE, SHORT_ANSWER, CODING", topics))
+        return lambda: generate_quizzes._parse_quiz(quiz, 10, topics, "MULTIPLE_CHOICE, TRUE_FALSE, SHORT_ANSWER, CODING")
+    if name == "grade_quiz":
+        questions = [
+            {"question": "Explain " + TOPICS[request % len(TOPICS)] + ".", "type": "SHORT_ANSWER",
+             "answers": "It trades bias for variance. It is controlled by the model capacity.", "user_answer": "It trades bias for variance."},
+            {"question": "Is Lasso L1?", "type": "TRUE_FALSE", "answers": "True", "user_answer": "True"},
+            {"question": "Write relu.", "type": "CODING", "answers": "def relu(x): return max(0, x)",
+             "user_answer": "def relu(x):\n    return max(0, x + " + str(request) + ")"},
+            {"question": "Pick one.", "type": "MULTIPLE_CHOICE", "answers": "A", "user_answer": "B"},
+        ]
+        return lambda: generate_quizzes.grade_quiz(questions)
+    if name == "get_similar":
+        return lambda: get_similar.get_similar(topics.split(", "), max_per_topic=5)
+    raise ValueError("unknown scenario: " + name)
+
+
+def _percentile(latencies, percent):
+    # nearest-rank percentile of sorted latencies
+    return latencies[max(0, math.ceil(percent / 100 * len(latencies)) - 1)]
+
+
+def measure(scenario, concurrency, requests):
+    """
+    Runs requests requests of a scenario from concurrency threads and times each one.
+
+    Parameters:
+    - scenario (str): One of SCENARIOS.
+    - concurrency (int): Number of requests in flight at once.
+    - requests (int): Total number of requests.
+
+    Returns:
+    - dict: {"scenario", "concurrency", "requests", "errors", "seconds", "throughput" (requests per second),
+      "mean", "p50", "p95", "p99" (latencies in seconds)}.
+    """
+    calls = [_scenario(scenario, i) for i in range(requests)]
+
+    def timed(call):
+        start = time.perf_counter()
+        try:
+            ok = call() not in (False, None)
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, calls))
+    seconds = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": sum(not ok for _, ok in results),
+        "seconds": seconds,
+        "throughput": requests / seconds,
+        "mean": sum(latencies) / len(latencies),
+        "p50": _percentile(latencies, 50),
+        "p95": _percentile(latencies, 95),
+        "p99": _percentile(latencies, 99),
+    }
+
+
+def run_benchmark(scenarios=SCENARIOS, concurrency_levels=CONCURRENCY_LEVELS, requests=None, llm_latency=LLM_LATENCY,
+                  embedding_latency=EMBEDDING_LATENCY, token_latency=TOKEN_LATENCY):
+    """
+    Runs every scenario at every concurrency level in the offline environment (see offline()), after one unmeasured
+    warm-up request per scenario. The entry points' own request logging is discarded.
+
+    Parameters:
+    - scenarios (list, optional): Scenarios to run. Defaults to SCENARIOS.
+    - concurrency_levels (list, optional): Concurrency levels to run each scenario at. Defaults to CONCURRENCY_LEVELS.
+    - requests (int, optional): Requests per measurement. Defaults to 4 times the concurrency level.
+    - llm_latency, embedding_latency, token_latency (float, optional): Latencies of the fakes, in seconds.
+
+    Returns:
+    - list: One measure() result per (scenario, concurrency level), tagged with the fake latencies.
+    """
+    results = []
+    with offline(llm_latency, embedding_latency, token_latency), open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for scenario in scenarios:
+            _scenario(scenario, 0)() # warm up: builds the chains and imports on first use outside the measurements
+            for concurrency in concurrency_levels:
+                result = measure(scenario, concurrency, requests or 4 * concurrency)
+                result.update(llm_latency=llm_latency, embedding_latency=embedding_latency, token_latency=token_latency)
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark, one JSON object per line.")
+    parser.add_argument("scenarios", nargs="*", default=SCENARIOS, help="any of " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=CONCURRENCY_LEVELS)
+    parser.add_argument("--requests", type=int, default=None, help="requests per measurement (default 4x concurrency)")
+    parser.add_argument("--llm-latency", type=float, default=LLM_LATENCY)
+    parser.add_argument("--embedding-latency", type=float, default=EMBEDDING_LATENCY)
+    parser.add_argument("--token-latency", type=float, default=TOKEN_LATENCY)
+    parser.add_argument("--output", default=None, help="also append the results to this file, i.e. bench_output.txt")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.scenarios, args.concurrency, args.requests, args.llm_latency, args.embedding_latency,
+                            args.token_latency)
+    lines = [json.dumps(result) for result in results]
+    print("\n".join(lines))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write("\n".join(lines) + "\n")
+    sys.exit(0 if all(result["errors"] == 0 for result in results) else 1)
@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import threading
+import hashlib
+
+from .text_generation import generate, agenerate, DEFAULT_MODEL
+from .llm_scheduler import llm_priority, CHAT
+from .tracing import span
+
+HISTORY_TOKEN_BUDGET = 1500 # tokens of recent messages sent verbatim, older messages are summarized
+MESSAGE_TOKEN_OVERHEAD = 4 # tokens the chat format adds around every message
+MAX_CACHED_SUMMARIES = 1000
+
+SUMMARY_SYSTEM_PROMPT = ("You summarize tutoring conversations between a student and an AI tutor. Keep the topics covered, "
+                         "what the student understood or struggled with, and anything the tutor promised to follow up on. "
+                         "Respond with the summary only, in at most 150 words.")
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    # the tiktoken encoding for DEFAULT_MODEL, or False if it cannot be loaded
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
+            except Exception as e:
+                print("WARNING: could not load tiktoken encoding, estimating token counts: " + str(e))
+                _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Counts the tokens of text with tiktoken, for DEFAULT_MODEL. Falls back to an estimate of 4 characters per token if
+    the tiktoken encoding cannot be loaded (i.e. it is not cached and there is no network).
+    """
+    encoding = _get_encoding()
+    if encoding is False:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Returns the longest prefix of text that is at most max_tokens tokens, counted like count_tokens()."""
+    encoding = _get_encoding()
+    if encoding is False:
+        return text[:max(max_tokens - 1, 0) * 4]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def _summary_input(summary, messages):
+    lines = [("Student: " if i % 2 == 0 else "Tutor: ") + message for i, message in enumerate(messages)]
+    previous = "Summary of the conversation so far:\n" + summary + "\n\n" if summary else ""
+    return previous + "Continue the summary with these messages:\n" + "\n".join(lines)
+
+
+def summarize_messages(summary, messages):
+    """
+    Folds messages into an existing conversation summary with the LLM.
+
+    Parameters:
+    - summary (str): The summary of the conversation before messages, or "".
+    - messages (list): Messages to add to the summary, starting with a user message.
+
+    Returns:
+    - str: The updated summary.
+    """
+    # summaries are made while a chat turn waits for them
+    with span("summarize", messages=len(messages)), llm_priority(CHAT):
+        return generate(_summary_input(summary, messages), SUMMARY_SYSTEM_PROMPT, temperature=0)
+
+
+async def asummarize_messages(summary, messages):
+    """Awaitable version of summarize_messages()."""
+    with span("summarize", messages=len(messages)), llm_priority(CHAT):
+        return await agenerate(_summary_input(summary, messages), SUMMARY_SYSTEM_PROMPT, temperature=0)
+
+
+class HistoryManager:
+    """
+    Keeps the chat history sent to the model within a token budget. The most recent turns are kept verbatim, and
+    older turns are folded into a rolling summary that is cached per chat and only extended when more turns fall
+    out of the budget.
+    """
+
+    def __init__(self, token_budget=HISTORY_TOKEN_BUDGET, summarize=summarize_messages, asummarize=asummarize_messages,
+                 count_tokens=count_tokens, max_chats=MAX_CACHED_SUMMARIES):
+        """
+        Parameters:
+        - token_budget (int, optional): Tokens of recent messages kept verbatim. Defaults to HISTORY_TOKEN_BUDGET.
+        - summarize (func, optional): Called as summarize(summary, messages), returns the extended summary.
+        - asummarize (func, optional): Awaitable version of summarize, used by abuild().
+        - count_tokens (func, optional): Returns the token count of a str. Defaults to tiktoken for DEFAULT_MODEL.
+        - max_chats (int, optional): Maximum number of chats whose summaries are cached. Defaults to MAX_CACHED_SUMMARIES.
+        """
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.asummarize = asummarize
+        self.count_tokens = count_tokens
+        self.max_chats = max_chats
+
+        self._summaries = OrderedDict() # chat -> (number of summarized messages, hash of them, summary)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(messages):
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(message.encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def _cut(self, messages, budget):
+        # Smallest even index (a user message) from which the remaining messages fit in budget
+        total = 0
+        cut = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            total += self.count_tokens(messages[i]) + MESSAGE_TOKEN_OVERHEAD
+            if total > budget:
+                break
+            if i % 2 == 0:
+                cut = i
+        return cut
+
+    def _plan(self, chat, messages):
+        """Returns (summary, summarized, cut): the cached summary of messages[:summarized], and the index up to which
+        messages must be summarized now. cut == summarized means the cached summary can be used as is."""
+        with self._lock:
+            entry = self._summaries.get(chat) if chat is not None else None
+            if entry is not None:
+                self._summaries.move_to_end(chat)
+        summarized, summary = 0, ""
+        if entry is not None and entry[0] <= len(messages) and entry[1] == self._hash(messages[:entry[0]]):
+            summarized, summary = entry[0], entry[2]
+
+        if self._cut(messages[summarized:], self.token_budget) == 0:
+            return summary, summarized, summarized
+        # Fold down to half the budget, so the summary is only extended every few turns instead of every turn
+        return summary, summarized, summarized + self._cut(messages[summarized:], self.token_budget // 2)
+
+    def _remember(self, chat, messages, cut, summary):
+        if chat is None:
+            return
+        with self._lock:
+            self._summaries[chat] = (cut, self._hash(messages[:cut]), summary)
+            self._summaries.move_to_end(chat)
+            while len(self._summaries) > self.max_chats:
+                self._summaries.popitem(last=False)
+
+    def build(self, chat, messages):
+        """
+        Splits a chat history into a summary of the older turns and the recent turns that fit in the token budget.
+
+        Parameters:
+        - chat (hashable): Identifies the chat, i.e. (userid, chatid), used to cache its summary. None disables caching.
+        - messages (list): The chat history. Even indices are user messages and odd indices are AI responses.
+
+        Returns:
+        - tuple: (summary, recent messages). summary is "" while the whole history fits in the budget.
+        """
+        summary, summarized, cut = self._plan(chat, messages)
+        if cut > summarized:
+            summary = self.summarize(summary, messages[summarized:cut])
+            self._remember(chat, messages, cut, summary)
+        return summary, messages[cut:]
+
+    async def abuild(self, chat, messages):
+        """Awaitable version of build()."""
+        summary, summarized, cut = self._plan(chat, messages)
+        if cut > summarized:
+            summary = await self.asummarize(summary, messages[summarized:cut])
+            self._remember(chat, messages, cut, summary)
+        return summary, messages[cut:]
+
+    def forget(self, chat):
+        with self._lock:
+            self._summaries.pop(chat, None)
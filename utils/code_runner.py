@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+import threading
+import requests
+import hashlib
+import json
+import time
+
+
+class CodeRunnerError(Exception):
+    '''Raised when the code runner service could not be reached or kept failing after all retries.'''
+    pass
+
+
+class CodeRunnerClient:
+    """
+    Client for the code runner service (POST {"code": ...} -> {"ran", "errors", "status_code"}). Requests share a
+    pooled session, have timeouts and are retried with exponential backoff on connection errors and 5xx responses.
+    Results are cached by a hash of the code, and identical submissions in flight share one request.
+    """
+
+    def __init__(self, url, timeout=(3.05, 30), retries=2, backoff=0.5, pool_size=8, cache_size=1024):
+        """
+        Parameters:
+        - url (str): The runcode endpoint, i.e. "http://localhost:5002/runcode".
+        - timeout (float or tuple, optional): requests timeout, (connect, read) seconds. Defaults to (3.05, 30).
+        - retries (int, optional): Retries after the first attempt. Defaults to 2.
+        - backoff (float, optional): Seconds before the first retry, doubled for every following retry. Defaults to 0.5.
+        - pool_size (int, optional): Pooled connections and max concurrent submissions. Defaults to 8.
+        - cache_size (int, optional): Maximum number of cached results. Defaults to 1024.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._cache = OrderedDict() # code hash -> result
+        self._in_flight = {} # code hash -> future
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(code):
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+    def _post(self, code):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.post(self.url, json={"code": code}, timeout=self.timeout)
+                if response.status_code < 500: # the runner reports failing code in the body, i.e. with HTTP 400
+                    return response.json()
+                error = "HTTP " + str(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise CodeRunnerError("code runner failed after " + str(self.retries + 1) + " attempts: " + error)
+
+    def _run(self, key, code):
+        try:
+            result = self._post(code)
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def submit(self, code):
+        """
+        Starts running the code in the background, unless its result is cached or already being fetched.
+
+        Parameters:
+        - code (str): The code to run.
+
+        Returns:
+        - Future: Resolves to the runner's result dict, or raises CodeRunnerError.
+        """
+        key = self.key(code)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(dict(self._cache[key]))
+            elif key in self._in_flight:
+                future = self._in_flight[key]
+            else:
+                future = self._in_flight[key] = self._executor.submit(self._run, key, code)
+        return future
+
+    def submit_many(self, codes):
+        """Batch version of submit(): starts all codes at once and returns their futures in order."""
+        return [self.submit(code) for code in codes]
+
+    def run(self, code):
+        """Runs the code and returns the runner's result dict. Raises CodeRunnerError if the runner keeps failing."""
+        return self.submit(code).result()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
+
+
+class StubCodeRunner:
+    """
+    Local stand-in for the code runner service, for tests. Serves the runcode API on a free localhost port from a
+    background thread; code is only compiled (never executed), and syntax errors are reported as the run errors.
+    Use as a context manager; requests lists every code received.
+    """
+
+    def __init__(self, mirror_status=False):
+        """
+        Parameters:
+        - mirror_status (bool, optional): Reply with the result's status_code as the HTTP status (i.e. 400 for code
+          that does not compile) instead of always 200. Defaults to False.
+        """
+        self.requests = []
+        self.mirror_status = mirror_status
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                code = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["code"]
+                stub.requests.append(code)
+                try:
+                    compile(code, "<answer>", "exec")
+                    result = {"ran": True, "errors": "", "status_code": 200}
+                except SyntaxError as e:
+                    result = {"ran": False, "errors": "SyntaxError: " + str(e), "status_code": 400}
+                body = json.dumps(result).encode("utf-8")
+                self.send_response(result["status_code"] if stub.mirror_status else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self._server.server_address[1]) + "/runcode"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
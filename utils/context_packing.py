@@ -0,0 +1,119 @@
+from dotenv import load_dotenv
+import os
+
+from .embeddings_cache import normalize_text
+from .tracing import span
+
+# Load environment variables from .env file
+load_dotenv()
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000")) # tokens of retrieved documents per prompt
+MIN_TRUNCATED_TOKENS = 64 # a document is truncated to fit the budget only if at least this much of it fits
+MIN_OVERLAP_CHARS = 50 # shorter shared text between two chunks is not treated as chunk overlap
+
+# Token budget applied by pack_context(), see set_token_budget()
+token_budget = CONTEXT_TOKEN_BUDGET
+
+
+def set_token_budget(budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Sets the token budget for the retrieved documents of every retrieval chain.
+
+    Parameters:
+    - budget (int, optional): Maximum tokens of documents per prompt. None sends every document whole. Defaults to
+      CONTEXT_TOKEN_BUDGET (the CONTEXT_TOKEN_BUDGET environment variable, or 2000).
+    """
+    global token_budget
+    token_budget = budget
+
+
+def _overlap(previous, text):
+    # length of the longest suffix of previous that is a prefix of text, i.e. the chunk overlap of consecutive chunks
+    if len(text) < MIN_OVERLAP_CHARS:
+        return 0
+    head = text[:MIN_OVERLAP_CHARS]
+    position = previous.find(head, max(len(previous) - len(text), 0))
+    while position != -1:
+        if text.startswith(previous[position:]):
+            return len(previous) - position
+        position = previous.find(head, position + 1)
+    return 0
+
+
+def _without_overlaps(text, kept):
+    # strips the text that text shares with the start or end of an already kept chunk
+    original = text
+    for other in kept:
+        text = text[_overlap(other, text):]
+        overlap = _overlap(text, other)
+        if overlap:
+            text = text[:len(text) - overlap]
+    return text if text == original else text.strip()
+
+
+def pack_documents(documents, budget):
+    """
+    Fits retrieved documents into a token budget. Documents are taken in the retriever's order (most relevant first);
+    documents whose text is already contained in a more relevant one are dropped, text shared with a more relevant
+    chunk (i.e. the overlap of consecutive chunks) is cut, and the first document that does not fit is truncated to the
+    remaining budget. Less relevant documents are dropped once the budget is used.
+
+    Parameters:
+    - documents (list): Documents, most relevant first.
+    - budget (int): Maximum tokens of document text.
+
+    Returns:
+    - tuple: (packed documents, report), with report {"documents", "kept", "duplicates", "truncated", "tokens_in",
+      "tokens_out", "tokens_saved"}.
+    """
+    from langchain_core.documents import Document
+    from .chat_history import count_tokens, truncate_tokens
+
+    packed, kept, normalized = [], [], []
+    report = {"documents": len(documents), "kept": 0, "duplicates": 0, "truncated": 0, "tokens_in": 0, "tokens_out": 0}
+    for document in documents:
+        tokens = count_tokens(document.page_content)
+        report["tokens_in"] += tokens
+        remaining = budget - report["tokens_out"]
+        if remaining <= 0:
+            continue
+
+        text = document.page_content
+        normal = normalize_text(text)
+        if not normal or any(normal in other for other in normalized):
+            report["duplicates"] += 1
+            continue
+        text = _without_overlaps(text, kept)
+        if not text:
+            report["duplicates"] += 1
+            continue
+        if text != document.page_content:
+            tokens = count_tokens(text)
+        if tokens > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS and packed:
+                continue
+            text = truncate_tokens(text, remaining)
+            tokens = count_tokens(text)
+            report["truncated"] += 1
+
+        kept.append(text)
+        normalized.append(normal)
+        packed.append(document if text == document.page_content else Document(page_content=text, metadata=document.metadata))
+        report["tokens_out"] += tokens
+    report["kept"] = len(packed)
+    report["tokens_saved"] = report["tokens_in"] - report["tokens_out"]
+    return packed, report
+
+
+def pack_context(documents):
+    """
+    Packs the documents of one request into token_budget, recording a "context_packing" span with the report of
+    pack_documents(). Runs between the retriever and the stuff documents chain of every retrieval chain.
+    """
+    budget = token_budget
+    if budget is None:
+        return documents
+    with span("context_packing") as s:
+        packed, report = pack_documents(documents, budget)
+        s.set(**report)
+    return packed
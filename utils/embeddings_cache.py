@@ -0,0 +1,195 @@
+from langchain_core.embeddings import Embeddings
+from collections import OrderedDict
+import unicodedata
+import threading
+import hashlib
+import sqlite3
+import asyncio
+import array
+import time
+import os
+
+from .tracing import span
+
+EMBEDDINGS_CACHE_DIR = os.getenv("EMBEDDINGS_CACHE_DIR",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "embeddings"))
+
+
+def normalize_text(text):
+    """Normalization applied before hashing, so trivially different strings ("Backpropagation ", "backpropagation") share an entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches vectors by a hash of the normalized text. Lookups go to an in-memory LRU first, then
+    to an on-disk SQLite store, and only then to the wrapped embeddings model. Usable anywhere an embeddings function
+    is expected, i.e. as embeddings_function in utils.vectorstore.load_vectorstore_helper.
+    """
+
+    def __init__(self, embeddings, namespace=None, max_size=10000, ttl=7 * 24 * 60 * 60, cache_dir=EMBEDDINGS_CACHE_DIR,
+                 persist=True):
+        """
+        Parameters:
+        - embeddings (Embeddings): The embeddings model to wrap.
+        - namespace (str, optional): Keeps vectors from different models apart. Defaults to the wrapped model's name.
+        - max_size (int, optional): Maximum number of vectors kept in memory. Defaults to 10000.
+        - ttl (float, optional): Seconds before a cached vector expires, in memory and on disk. None never expires.
+          Defaults to one week.
+        - cache_dir (str, optional): Directory of the on-disk store. Defaults to EMBEDDINGS_CACHE_DIR.
+        - persist (bool, optional): Whether to use the on-disk store at all. Defaults to True.
+        """
+        self.embeddings = embeddings
+        self.namespace = namespace or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()  # key -> (created, vector)
+        self._lock = threading.Lock()
+        self._db = None
+        if persist:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(cache_dir, "embeddings.sqlite3"), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL, vector BLOB)")
+            self._db.commit()
+
+    def _key(self, text):
+        return hashlib.sha256((self.namespace + "\0" + normalize_text(text)).encode("utf-8")).hexdigest()
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key, created, vector):
+        # caller holds self._lock
+        self._memory[key] = (created, vector)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """Returns {key: vector} for every key found in memory or on disk, counting hits."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is not None and not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    found[key] = entry[1]
+                    self.hits += 1
+
+            missing = [key for key in keys if key not in found]
+            rows = []
+            for start in range(0, len(missing) if self._db is not None else 0, 500):  # stay under SQLite's variable limit
+                chunk = missing[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows += self._db.execute("SELECT key, created, vector FROM embeddings WHERE key IN (" + placeholders + ")",
+                                         chunk).fetchall()
+            if rows:
+                for key, created, blob in rows:
+                    if self._expired(created, now):
+                        continue
+                    vector = array.array("d", blob).tolist()
+                    self._remember(key, created, vector)
+                    found[key] = vector
+                    self.disk_hits += 1
+
+        return found
+
+    def _store(self, new):
+        now = time.time()
+        with self._lock:
+            for key, vector in new.items():
+                self._remember(key, now, vector)
+            if self._db is not None and new:
+                self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                     [(key, now, array.array("d", vector).tobytes()) for key, vector in new.items()])
+                self._db.commit()
+
+    def _plan(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+        # embed each distinct missing text once, even if it appears several times in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        with self._lock:
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts):
+        with span("embedding", texts=len(texts)) as s:
+            keys, found, missing = self._plan(texts)
+            s.set(misses=len(missing))
+            if missing:
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+                new = dict(zip(missing.keys(), vectors))
+                self._store(new)
+                found.update(new)
+            return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        with span("embedding", texts=1) as s:
+            keys, found, missing = self._plan([text])
+            s.set(misses=len(missing))
+            if missing:
+                new = {keys[0]: self.embeddings.embed_query(text)}
+                self._store(new)
+                found.update(new)
+            return found[keys[0]]
+
+    async def aembed_documents(self, texts):
+        with span("embedding", texts=len(texts)) as s:
+            keys, found, missing = await asyncio.to_thread(self._plan, texts)
+            s.set(misses=len(missing))
+            if missing:
+                vectors = await self.embeddings.aembed_documents(list(missing.values()))
+                new = dict(zip(missing.keys(), vectors))
+                await asyncio.to_thread(self._store, new)
+                found.update(new)
+            return [found[key] for key in keys]
+
+    async def aembed_query(self, text):
+        with span("embedding", texts=1) as s:
+            keys, found, missing = await asyncio.to_thread(self._plan, [text])
+            s.set(misses=len(missing))
+            if missing:
+                new = {keys[0]: await self.embeddings.aembed_query(text)}
+                await asyncio.to_thread(self._store, new)
+                found.update(new)
+            return found[keys[0]]
+
+    def stats(self):
+        """
+        Returns:
+        - dict: Hit/miss counters. "hits" are memory hits, "disk_hits" are on-disk hits and "misses" are texts that had
+          to be sent to the embeddings model.
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_size": len(self._memory),
+            }
+
+    def prune(self):
+        """Deletes expired vectors from the on-disk store."""
+        if self._db is None or self.ttl is None:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,72 @@
+import subprocess
+import statistics
+import json
+import sys
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point modules of the package, imported the way the workers import them
+MODULES = ["main", "get_similar", "generate_quizzes", "agent"]
+
+# Modules that take seconds to import and must only be loaded on first use, never by importing an entry point
+HEAVY_MODULES = ["langchain_openai", "openai", "langchain.chains", "langchain_community", "sqlalchemy", "pgvector",
+                 "tiktoken"]
+
+_PROBE = ("import sys, time, json\n"
+          "start = time.perf_counter()\n"
+          "import {module}\n"
+          "seconds = time.perf_counter() - start\n"
+          "heavy = [name for name in {heavy!r} if name in sys.modules]\n"
+          "print(json.dumps({{'seconds': seconds, 'heavy': heavy}}))\n")
+
+
+def measure_import(module, repeats=3):
+    """
+    Imports a module in fresh interpreters (so nothing is cached in sys.modules) and times the import.
+
+    Parameters:
+    - module (str): The module to import, i.e. "main".
+    - repeats (int, optional): Number of fresh interpreters to time. Defaults to 3.
+
+    Returns:
+    - dict: {"module", "min", "median" (seconds), "heavy" (HEAVY_MODULES loaded by the import)}.
+    """
+    env = dict(os.environ)
+    env.pop("OPENAI_API_KEY", None) # importing must not need credentials
+    runs = []
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)], cwd=REPO_DIR,
+                                env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "module": module,
+        "min": min(run["seconds"] for run in runs),
+        "median": statistics.median(run["seconds"] for run in runs),
+        "heavy": runs[0]["heavy"],
+    }
+
+
+def run_benchmark(modules=MODULES, repeats=3, max_seconds=None):
+    """
+    Measures the cold import time of every module. Returns (results, ok), where ok is False if a module loaded a
+    heavy module or (with max_seconds) took longer than max_seconds at best.
+    """
+    results = [measure_import(module, repeats) for module in modules]
+    ok = all(not result["heavy"] and (max_seconds is None or result["min"] <= max_seconds) for result in results)
+    return results, ok
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cold start import time per module, one JSON object per line.")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=None, help="fail if a module takes longer to import")
+    args = parser.parse_args()
+
+    results, ok = run_benchmark(args.modules, args.repeats, args.max_seconds)
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,278 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import hashlib
+import uuid
+import time
+import csv
+import io
+import os
+
+from .embeddings_cache import normalize_text
+
+CHUNK_SIZE = 1000 # characters per chunk
+CHUNK_OVERLAP = 200 # characters shared by consecutive chunks of a page
+MAX_BATCH_TEXTS = 256 # chunks per embeddings request
+MAX_BATCH_TOKENS = 100000 # estimated tokens per embeddings request, well under the API's per-request limit
+EMBEDDING_WORKERS = 4 # embeddings requests in flight at once
+DELETE_BATCH_SIZE = 1000
+
+TEXT_EXTENSIONS = (".txt", ".md")
+PDF_EXTENSIONS = (".pdf",)
+
+
+def _estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def chunk_id(source, text):
+    """Content hash identifying a chunk: unchanged chunks of a re-ingested file keep their id and are not re-embedded."""
+    return hashlib.sha256((source + "\0" + normalize_text(text)).encode("utf-8")).hexdigest()
+
+
+def iter_pages(directory, extensions=TEXT_EXTENSIONS + PDF_EXTENSIONS):
+    """
+    Lazily reads the files under directory, in path order, one page at a time.
+
+    Yields:
+    - tuple: (source, page, text), where source is the path relative to directory and page is the 0-based PDF page
+      (None for text files).
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            extension = os.path.splitext(name)[1].lower()
+            if extension not in extensions:
+                continue
+            path = os.path.join(root, name)
+            source = os.path.relpath(path, directory).replace(os.sep, "/")
+            if extension in PDF_EXTENSIONS:
+                try:
+                    from pypdf import PdfReader
+                except ImportError:
+                    print("WARNING: skipping " + source + ", install pypdf to ingest PDF files")
+                    continue
+                for page, pdf_page in enumerate(PdfReader(path).pages):
+                    yield source, page, pdf_page.extract_text() or ""
+            else:
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    yield source, None, f.read()
+
+
+def iter_chunks(directory, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, extensions=TEXT_EXTENSIONS + PDF_EXTENSIONS):
+    """
+    Lazily splits the files under directory into chunks, page by page, so a corpus is never held in memory at once.
+
+    Yields:
+    - tuple: (id, text, metadata), with metadata {"source", "page" (PDFs only)}. Repeated chunks of a source are
+      yielded once.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    seen_source, seen = None, set()
+    for source, page, text in iter_pages(directory, extensions):
+        if source != seen_source:
+            seen_source, seen = source, set()
+        for chunk in splitter.split_text(text):
+            id = chunk_id(source, chunk)
+            if id in seen:
+                continue
+            seen.add(id)
+            yield id, chunk, {"source": source} if page is None else {"source": source, "page": page}
+
+
+def _batches(chunks, max_texts, max_tokens):
+    # groups chunks into embeddings requests of at most max_texts chunks and max_tokens estimated tokens
+    batch, tokens = [], 0
+    for chunk in chunks:
+        chunk_tokens = _estimate_tokens(chunk[1])
+        if batch and (len(batch) == max_texts or tokens + chunk_tokens > max_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(chunk)
+        tokens += chunk_tokens
+    if batch:
+        yield batch
+
+
+class MemoryChunkStore:
+    """Chunk store kept in a dict, for tests and local runs. Same interface as PGVectorChunkStore."""
+
+    def __init__(self):
+        self.rows = {} # id -> (text, embedding, metadata)
+        self.writes = 0 # bulk add() calls
+
+    def existing(self):
+        return {id: metadata.get("source") for id, (_, _, metadata) in self.rows.items()}
+
+    def add(self, ids, texts, embeddings, metadatas):
+        self.writes += 1
+        for id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas):
+            self.rows[id] = (text, embedding, metadata)
+
+    def delete(self, ids):
+        for id in ids:
+            self.rows.pop(id, None)
+
+
+class PGVectorChunkStore:
+    """
+    Writes chunks to a PGVector collection, keyed by chunk id in the custom_id column. Each batch is one COPY (with the
+    psycopg2 driver) or one multi-row INSERT, instead of an ORM object per row.
+    """
+
+    def __init__(self, vectorstore):
+        """
+        Parameters:
+        - vectorstore (PGVector): The collection to write to, i.e. from load_vectorstore(), which creates it.
+        """
+        from sqlalchemy.orm import Session
+
+        self.vectorstore = vectorstore
+        self.store = vectorstore.EmbeddingStore
+        with Session(vectorstore._bind) as session:
+            collection = vectorstore.get_collection(session)
+            if not collection:
+                raise ValueError("Collection not found")
+            self.collection_id = collection.uuid
+
+    def existing(self):
+        from sqlalchemy.orm import Session
+
+        with Session(self.vectorstore._bind) as session:
+            rows = session.query(self.store.custom_id, self.store.cmetadata).filter(
+                self.store.collection_id == self.collection_id)
+            return {custom_id: (metadata or {}).get("source") for custom_id, metadata in rows}
+
+    def add(self, ids, texts, embeddings, metadatas):
+        import json
+
+        engine = getattr(self.vectorstore._bind, "engine", self.vectorstore._bind)
+        if engine.dialect.driver == "psycopg2":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas):
+                writer.writerow([str(uuid.uuid4()), str(self.collection_id),
+                                 "[" + ",".join(repr(float(x)) for x in embedding) + "]", text, json.dumps(metadata), id])
+            buffer.seek(0)
+            connection = engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert("COPY " + self.store.__tablename__ + " (uuid, collection_id, embedding, document, "
+                                       "cmetadata, custom_id) FROM STDIN WITH (FORMAT csv)", buffer)
+                connection.commit()
+            finally:
+                connection.close()
+        else:
+            import sqlalchemy
+
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.insert(self.store.__table__), [
+                    {"uuid": uuid.uuid4(), "collection_id": self.collection_id, "embedding": embedding,
+                     "document": text, "cmetadata": metadata, "custom_id": id}
+                    for id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas)])
+
+    def delete(self, ids):
+        from sqlalchemy.orm import Session
+
+        ids = list(ids)
+        with Session(self.vectorstore._bind) as session:
+            if None in ids: # rows loaded without a custom_id
+                ids.remove(None)
+                session.query(self.store).filter(self.store.collection_id == self.collection_id,
+                                                 self.store.custom_id.is_(None)).delete(synchronize_session=False)
+            for start in range(0, len(ids), DELETE_BATCH_SIZE):
+                session.query(self.store).filter(self.store.collection_id == self.collection_id,
+                                                 self.store.custom_id.in_(ids[start:start + DELETE_BATCH_SIZE])
+                                                 ).delete(synchronize_session=False)
+            session.commit()
+
+
+def ingest_directory(directory, store, embeddings, prune=False, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                     max_batch_texts=MAX_BATCH_TEXTS, max_batch_tokens=MAX_BATCH_TOKENS, workers=EMBEDDING_WORKERS):
+    """
+    Incrementally ingests the files under directory into a chunk store. Files are read and chunked lazily; only chunks
+    whose content hash is not in the store yet are embedded, in size-limited batches with at most workers requests in
+    flight, and each embedded batch is written with one bulk insert. Chunks that disappeared from an ingested file are
+    deleted, so re-indexing a course after edits only touches what changed.
+
+    Without prune, only rows of the sources found in directory are ever deleted. Rows from loads outside this function
+    (other source metadata, or ids that are not chunk hashes) are left in place next to the ingested chunks, so run the
+    first ingestion into an existing collection with prune=True to replace them.
+
+    Parameters:
+    - directory (str): The corpus directory (.txt, .md and, with pypdf installed, .pdf files).
+    - store (PGVectorChunkStore or MemoryChunkStore): Where chunks are written.
+    - embeddings (Embeddings): The embeddings model, i.e. OpenAIEmbeddings().
+    - prune (bool, optional): Delete every row of the store that is not a chunk of directory, i.e. the chunks of
+      deleted files and rows from earlier loads. Defaults to False.
+    - chunk_size, chunk_overlap (int, optional): Chunking in characters. Defaults to CHUNK_SIZE and CHUNK_OVERLAP.
+    - max_batch_texts, max_batch_tokens (int, optional): Limits per embeddings request. Defaults to MAX_BATCH_TEXTS and MAX_BATCH_TOKENS.
+    - workers (int, optional): Embeddings requests in flight at once. Defaults to EMBEDDING_WORKERS.
+
+    Returns:
+    - dict: {"sources", "chunks", "unchanged", "embedded", "deleted", "batches", "seconds"}.
+    """
+    start = time.perf_counter()
+    existing = store.existing()
+    report = {"sources": 0, "chunks": 0, "unchanged": 0, "embedded": 0, "deleted": 0, "batches": 0}
+    current = set() # ids of every chunk in directory
+    sources = set()
+
+    def new_chunks():
+        for chunk in iter_chunks(directory, chunk_size, chunk_overlap):
+            id, _, metadata = chunk
+            current.add(id)
+            sources.add(metadata["source"])
+            report["chunks"] += 1
+            if id in existing:
+                report["unchanged"] += 1
+                continue
+            yield chunk
+
+    def write(batch, vectors):
+        store.add([id for id, _, _ in batch], [text for _, text, _ in batch], vectors,
+                  [metadata for _, _, metadata in batch])
+        report["embedded"] += len(batch)
+        report["batches"] += 1
+
+    # embed up to workers batches concurrently, writing them in order; the queue bounds how far chunking runs ahead
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for batch in _batches(new_chunks(), max_batch_texts, max_batch_tokens):
+            in_flight.append((batch, executor.submit(embeddings.embed_documents, [text for _, text, _ in batch])))
+            if len(in_flight) >= workers:
+                batch, future = in_flight.popleft()
+                write(batch, future.result())
+        while in_flight:
+            batch, future = in_flight.popleft()
+            write(batch, future.result())
+
+    stale = [id for id, source in existing.items() if id not in current and (prune or source in sources)]
+    if stale:
+        store.delete(stale)
+    report["deleted"] = len(stale)
+    report["sources"] = len(sources)
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    from langchain_openai import OpenAIEmbeddings
+    from .vectorstore import load_vectorstore
+
+    parser = argparse.ArgumentParser(description="Incrementally ingests a directory of course files into a PGVector collection.")
+    parser.add_argument("directory")
+    parser.add_argument("--collection", default="corpus")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete every row that is not a chunk of directory (deleted files, earlier loads)")
+    parser.add_argument("--workers", type=int, default=EMBEDDING_WORKERS)
+    args = parser.parse_args()
+
+    vectorstore = load_vectorstore(password=os.getenv("POSTGRESQL_PASSWORD"), collection_name=args.collection)
+    report = ingest_directory(args.directory, PGVectorChunkStore(vectorstore), OpenAIEmbeddings(), prune=args.prune,
+                              workers=args.workers)
+    print(json.dumps(report))
@@ -0,0 +1,406 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import asyncio
+import random
+import heapq
+import time
+
+from .tracing import record
+
+# Priority classes, lower runs first
+CHAT = 0 # interactive chat turns and their history summaries
+QUIZ = 1 # quiz generation
+GRADING = 2 # quiz grading
+BACKGROUND = 3 # quiz bank refills and rubric extraction
+
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 160000
+MAX_CONCURRENCY = 32
+MIN_CONCURRENCY = 1
+MAX_RETRIES = 5
+BASE_DELAY = 0.5 # seconds, doubled per retry up to MAX_DELAY, with full jitter
+MAX_DELAY = 20.0
+LATENCY_SPIKE_FACTOR = 3.0 # a call this many times slower than the recent average counts as a latency spike
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError", "Timeout")
+
+_priority = contextvars.ContextVar("llm_priority", default=None)
+
+
+@contextmanager
+def llm_priority(priority):
+    """Runs the LLM calls made inside the with block (in this thread or task) with the given priority class."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority(default=CHAT):
+    """Returns the priority class set with llm_priority(), or default if none is set."""
+    priority = _priority.get()
+    return default if priority is None else priority
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_rate_limit(error):
+    return _status_code(error) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_retryable(error):
+    return _status_code(error) in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERRORS
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate per second up to capacity. Not thread-safe, LLMScheduler locks it.
+
+    An amount above capacity waits for a full bucket and is then charged in full, leaving the level negative: the debt
+    is paid back before the next take, so the long-run rate never exceeds rate however large single amounts are.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount can be taken (amounts above capacity only wait for a full bucket)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def drain(self, now):
+        self._refill(now)
+        self.level = min(self.level, 0)
+
+
+class _Waiter:
+    __slots__ = ("tokens", "event", "loop", "future", "granted", "cancelled")
+
+    def __init__(self, tokens, event=None, loop=None, future=None):
+        self.tokens = tokens
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+        self.cancelled = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMScheduler:
+    """
+    Shared gate for outbound LLM calls from every thread and event loop of the process.
+
+    Calls wait in a priority queue (CHAT before QUIZ before GRADING before BACKGROUND, first come first served within
+    a class) until a concurrency slot is free and the request and token buckets allow them. The concurrency limit
+    adapts: it grows by one per limit successful calls, is halved on a rate limit error (429) and shrinks on latency
+    spikes. Rate limited and transient errors are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_concurrency=MAX_CONCURRENCY, min_concurrency=MIN_CONCURRENCY, max_retries=MAX_RETRIES,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY, latency_spike_factor=LATENCY_SPIKE_FACTOR):
+        """
+        Parameters:
+        - requests_per_minute, tokens_per_minute (float, optional): Sustained rates, i.e. the account's rate limits.
+          Bursts of up to a second's worth are allowed. None does not limit. Default to REQUESTS_PER_MINUTE and TOKENS_PER_MINUTE.
+        - max_concurrency, min_concurrency (int, optional): Bounds of the adaptive concurrency limit, which starts at max_concurrency.
+        - max_retries (int, optional): Retries of a rate limited or transiently failing call. Defaults to MAX_RETRIES.
+        - base_delay, max_delay (float, optional): Backoff before retry n is uniform in [0, min(max_delay, base_delay * 2**n)].
+        - latency_spike_factor (float, optional): See LATENCY_SPIKE_FACTOR.
+        """
+        self.requests = TokenBucket(requests_per_minute / 60, max(requests_per_minute / 60, 1)) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute / 60, max(tokens_per_minute / 60, 1)) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_spike_factor = latency_spike_factor
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.latency = None # moving average of successful call latencies
+        self.counts = {"completed": 0, "failed": 0, "retries": 0, "rate_limited": 0, "latency_spikes": 0}
+
+        self._queue = [] # (priority, sequence, waiter)
+        self._sequence = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    # Admission
+
+    def _wait_time(self, tokens, now):
+        wait = 0.0
+        if self.requests is not None:
+            wait = self.requests.wait_time(1, now)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def _dispatch(self):
+        # grants slots to the head of the queue while the limits allow; called with the lock held
+        while self._queue:
+            waiter = self._queue[0][2]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if self.in_flight >= max(int(self.limit), self.min_concurrency):
+                return
+            now = time.monotonic()
+            wait = self._wait_time(waiter.tokens, now)
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            if self.requests is not None:
+                self.requests.take(1, now)
+            if self.tokens is not None:
+                self.tokens.take(waiter.tokens, now)
+            heapq.heappop(self._queue)
+            self.in_flight += 1
+            waiter.granted = True
+            if waiter.event is not None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _enqueue(self, priority, waiter):
+        with self._lock:
+            heapq.heappush(self._queue, (priority, self._sequence, waiter))
+            self._sequence += 1
+            self._dispatch()
+
+    def acquire(self, priority=CHAT, tokens=1):
+        """Blocks until a call of the given priority class and estimated tokens may start. Pair with release()."""
+        start = time.perf_counter()
+        waiter = _Waiter(tokens, event=threading.Event())
+        self._enqueue(priority, waiter)
+        waiter.event.wait()
+        record("llm_queue", time.perf_counter() - start)
+
+    async def aacquire(self, priority=CHAT, tokens=1):
+        """Awaitable version of acquire()."""
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(tokens, loop=loop, future=loop.create_future())
+        self._enqueue(priority, waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiter.cancelled = True
+                granted = waiter.granted
+            if granted:
+                self.release()
+            raise
+        record("llm_queue", time.perf_counter() - start)
+
+    def release(self, latency=None, rate_limited=False):
+        """
+        Frees the slot of a finished call and adapts the concurrency limit.
+
+        Parameters:
+        - latency (float, optional): Seconds the call took (to its first token when streaming), if it succeeded.
+        - rate_limited (bool, optional): Whether the call failed with a rate limit error.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if rate_limited:
+                self.counts["rate_limited"] += 1
+                self.limit = max(float(self.min_concurrency), self.limit / 2)
+                if self.requests is not None:
+                    self.requests.drain(time.monotonic()) # pause new calls until the bucket refills
+            elif latency is not None:
+                if self.latency is not None and latency > self.latency_spike_factor * self.latency:
+                    self.counts["latency_spikes"] += 1
+                    self.limit = max(float(self.min_concurrency), self.limit * 0.8)
+                else:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / max(self.limit, 1))
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            self._dispatch()
+
+    # Calls
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _failed(self, error, attempt):
+        # counts a failed attempt; returns True if it should be retried
+        with self._lock:
+            if attempt < self.max_retries and is_retryable(error):
+                self.counts["retries"] += 1
+                return True
+            self.counts["failed"] += 1
+            return False
+
+    def _completed(self):
+        with self._lock:
+            self.counts["completed"] += 1
+
+    def call(self, func, priority=None, tokens=1):
+        """
+        Runs func() once the scheduler admits it, retrying rate limited and transient failures.
+
+        Parameters:
+        - func (func): Makes the LLM call.
+        - priority (int, optional): Priority class. Defaults to the one set with llm_priority(), else CHAT.
+        - tokens (int, optional): Estimated prompt and completion tokens of the call. Defaults to 1.
+
+        Returns:
+        - The result of func().
+        """
+        priority = current_priority() if priority is None else priority
+        attempt = 0
+        while True:
+            self.acquire(priority, tokens)
+            start = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                self.release(rate_limited=is_rate_limit(e))
+                if not self._failed(e, attempt):
+                    raise
+                time.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            self.release(time.perf_counter() - start)
+            self._completed()
+            return result
+
+    async def acall(self, func, priority=None, tokens=1):
+        """Awaitable version of call(). func() returns an awaitable."""
+        priority = current_priority() if priority is None else priority
+        attempt = 0
+        while True:
+            await self.aacquire(priority, tokens)
+            start = time.perf_counter()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                self.release()
+                raise
+            except Exception as e:
+                self.release(rate_limited=is_rate_limit(e))
+                if not self._failed(e, attempt):
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            self.release(time.perf_counter() - start)
+            self._completed()
+            return result
+
+    def stream(self, func, priority=None, tokens=1):
+        """
+        Streaming version of call(): yields the chunks of the iterator func() returns, holding a slot until it ends.
+        A failed call is only retried before its first chunk.
+        """
+        priority = current_priority() if priority is None else priority
+        attempt = 0
+        while True:
+            self.acquire(priority, tokens)
+            start = time.perf_counter()
+            latency, released = None, False
+            try:
+                chunks = iter(func())
+                try:
+                    first = next(chunks)
+                except StopIteration:
+                    latency = time.perf_counter() - start
+                    break
+                latency = time.perf_counter() - start
+                yield first
+                yield from chunks
+                break
+            except Exception as e:
+                if latency is not None:
+                    with self._lock:
+                        self.counts["failed"] += 1
+                    raise
+                released = True
+                self.release(rate_limited=is_rate_limit(e))
+                if not self._failed(e, attempt):
+                    raise
+                time.sleep(self._delay(attempt))
+                attempt += 1
+            finally:
+                if not released:
+                    self.release(latency)
+        self._completed()
+
+    async def astream(self, func, priority=None, tokens=1):
+        """Async generator version of stream(). func() returns an async iterator."""
+        priority = current_priority() if priority is None else priority
+        attempt = 0
+        while True:
+            await self.aacquire(priority, tokens)
+            start = time.perf_counter()
+            latency, released = None, False
+            try:
+                chunks = func().__aiter__()
+                try:
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    latency = time.perf_counter() - start
+                    break
+                latency = time.perf_counter() - start
+                yield first
+                async for chunk in chunks:
+                    yield chunk
+                break
+            except Exception as e:
+                if latency is not None:
+                    with self._lock:
+                        self.counts["failed"] += 1
+                    raise
+                released = True
+                self.release(rate_limited=is_rate_limit(e))
+                if not self._failed(e, attempt):
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+            finally:
+                if not released:
+                    self.release(latency)
+        self._completed()
+
+    def stats(self):
+        """
+        Returns:
+        - dict: The current concurrency limit, calls in flight and queued, and counters of completed, failed, retried
+          and rate limited calls and of latency spikes.
+        """
+        with self._lock:
+            queued = sum(1 for _, _, waiter in self._queue if not waiter.cancelled)
+            return dict(self.counts, limit=self.limit, in_flight=self.in_flight, queued=queued)
@@ -0,0 +1,413 @@
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+import numpy as np
+import shutil
+import json
+import math
+import mmap
+import time
+import os
+
+from .mmr import batch_maximal_marginal_relevance
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR",
+                             os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "vector_index"))
+
+EXACT_SEARCH_MAX_ROWS = 20000 # stores up to this size get no ANN index by default, exact search is fast enough
+DEFAULT_NPROBE = 8 # IVF lists scanned per query
+WRITE_BATCH_SIZE = 1000 # texts embedded per request by MmapVectorStore.from_texts
+
+# A store directory holds one subdirectory per written version and a CURRENT file naming the version to read, which a
+# writer switches with a single os.replace(). Stores written before versioning keep the version files at the top level.
+CURRENT_FILE = "CURRENT"
+VERSION_PREFIX = "v-"
+
+# Files of a store version. Embeddings are a raw row-major float32 matrix of unit vectors; documents are JSON lines
+# ({"id", "page_content", "metadata"}) located through offsets.npy, so both are read through the page cache on demand.
+META_FILE = "meta.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+DOCUMENTS_FILE = "documents.jsonl"
+OFFSETS_FILE = "offsets.npy"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_ROWS_FILE = "ivf_rows.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+
+
+def default_index_path(collection_name):
+    """Directory of the memory-mapped store of a collection under VECTOR_INDEX_DIR."""
+    return os.path.join(VECTOR_INDEX_DIR, collection_name)
+
+
+def current_version_path(path):
+    """Directory of the version of the store at path that readers should open."""
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return path # written before stores were versioned
+
+
+class ReadOnlyVectorStoreError(Exception):
+    """Raised when documents are added to a MmapVectorStore, which can only be rebuilt by exporting its collection."""
+    pass
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    # indices of the k highest scores, best first
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def build_ivf_index(vectors, nlist=None, iterations=10, seed=0, batch_size=65536):
+    """
+    Builds an IVF (inverted file) index: spherical k-means centroids, and the rows of vectors grouped by their nearest
+    centroid. A query then only scores the rows in the lists of its nprobe nearest centroids.
+
+    Parameters:
+    - vectors (np.ndarray): Unit vectors, one per row. May be a memmap; it is read in batches.
+    - nlist (int, optional): Number of lists. Defaults to 4 * sqrt(number of rows).
+    - iterations (int, optional): k-means iterations, run on a sample of at most 64 rows per list. Defaults to 10.
+    - seed (int, optional): Seed of the sample and the initial centroids. Defaults to 0.
+    - batch_size (int, optional): Rows assigned to lists at a time. Defaults to 65536.
+
+    Returns:
+    - tuple: (centroids (nlist, d), rows grouped by list, list offsets into rows (nlist + 1)).
+    """
+    n = len(vectors)
+    nlist = max(1, min(n, nlist or int(4 * math.sqrt(n))))
+    rng = np.random.default_rng(seed)
+
+    sample = np.asarray(vectors[np.sort(rng.choice(n, size=min(n, 64 * nlist), replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        nonempty = np.flatnonzero(counts)
+        sums[nonempty] = np.add.reduceat(sample[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty])
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))] # reseed empty lists
+        centroids = _normalize(sums)
+
+    assignment = np.concatenate([np.argmax(np.asarray(vectors[i:i + batch_size]) @ centroids.T, axis=1)
+                                 for i in range(0, n, batch_size)])
+    rows = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+    return centroids.astype(np.float32), rows, offsets
+
+
+class MmapVectorStoreWriter:
+    """
+    Writes a MmapVectorStore directory incrementally, so collections larger than memory can be exported batch by batch.
+    Files are written to a new version directory inside the store, which close() publishes by atomically replacing the
+    store's CURRENT file: a reader opening the store at any moment finds either the previous or the new version. Workers
+    that already mapped the previous version keep reading it until they reload. One writer per store at a time.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+        - path (str): Directory of the store. Its current version is replaced by close() if it exists.
+        """
+        self.path = os.path.abspath(path)
+        self.count = 0
+        self.dimension = None
+        self.version = VERSION_PREFIX + str(time.time_ns()) + "-" + str(os.getpid())
+        self._tmp = os.path.join(self.path, self.version)
+        os.makedirs(self._tmp)
+        self._embeddings = open(os.path.join(self._tmp, EMBEDDINGS_FILE), "wb")
+        self._documents = open(os.path.join(self._tmp, DOCUMENTS_FILE), "wb")
+        self._offsets = [0]
+
+    def add(self, texts, embeddings, metadatas=None, ids=None):
+        """Appends documents with their embeddings. ids default to the row numbers."""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if len(texts) == 0:
+            return
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError("Expected one embedding per text")
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+        elif vectors.shape[1] != self.dimension:
+            raise ValueError("Embedding dimension " + str(vectors.shape[1]) + " does not match " + str(self.dimension))
+
+        self._embeddings.write(np.ascontiguousarray(_normalize(vectors)).tobytes())
+        for i, text in enumerate(texts):
+            record = {"id": str(ids[i]) if ids is not None else str(self.count + i), "page_content": text,
+                      "metadata": metadatas[i] if metadatas is not None else {}}
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            self._documents.write(line)
+            self._offsets.append(self._offsets[-1] + len(line))
+        self.count += len(texts)
+
+    def close(self, index="auto", nlist=None):
+        """
+        Finishes the store and swaps it in at path.
+
+        Parameters:
+        - index (str, optional): "ivf" to build an IVF index, None for exact search only, or "auto" for an IVF index
+          only above EXACT_SEARCH_MAX_ROWS rows. Defaults to "auto".
+        - nlist (int, optional): Number of IVF lists, see build_ivf_index().
+
+        Returns:
+        - str: The path of the store.
+        """
+        self._embeddings.close()
+        self._documents.close()
+        np.save(os.path.join(self._tmp, OFFSETS_FILE), np.array(self._offsets, dtype=np.int64))
+
+        meta = {"count": self.count, "dimension": self.dimension or 0, "distance": "cosine", "index": None}
+        if self.count and (index == "ivf" or (index == "auto" and self.count > EXACT_SEARCH_MAX_ROWS)):
+            vectors = np.memmap(os.path.join(self._tmp, EMBEDDINGS_FILE), dtype=np.float32, mode="r",
+                                shape=(self.count, self.dimension))
+            centroids, rows, offsets = build_ivf_index(vectors, nlist)
+            np.save(os.path.join(self._tmp, IVF_CENTROIDS_FILE), centroids)
+            np.save(os.path.join(self._tmp, IVF_ROWS_FILE), rows)
+            np.save(os.path.join(self._tmp, IVF_OFFSETS_FILE), offsets)
+            meta["index"] = {"type": "ivf", "nlist": len(centroids)}
+            del vectors
+        with open(os.path.join(self._tmp, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        previous = current_version_path(self.path)
+        pointer = os.path.join(self.path, CURRENT_FILE + ".tmp-" + str(os.getpid()))
+        with open(pointer, "w") as f:
+            f.write(self.version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer, os.path.join(self.path, CURRENT_FILE))
+        self._remove_old_versions(previous)
+        return self.path
+
+    def _remove_old_versions(self, previous):
+        # the previous version is kept, so a reader that resolved CURRENT just before the switch can still open it
+        if previous != self.path:
+            for name in (META_FILE, EMBEDDINGS_FILE, DOCUMENTS_FILE, OFFSETS_FILE, IVF_CENTROIDS_FILE, IVF_ROWS_FILE,
+                         IVF_OFFSETS_FILE):
+                if os.path.isfile(os.path.join(self.path, name)): # files of a store written before versioning
+                    os.remove(os.path.join(self.path, name))
+        for name in os.listdir(self.path):
+            if name.startswith(VERSION_PREFIX) and name not in (self.version, os.path.basename(previous)):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+class MmapVectorStore(VectorStore):
+    """
+    Read-only vector store over a memory-mapped embedding matrix and document sidecar (see MmapVectorStoreWriter).
+    Nothing is loaded up front: every worker process on a host maps the same files, so they share one page-cached
+    copy. Queries are answered in process by exact cosine search, or by an IVF index when the store has one.
+
+    Supports the same search(), as_retriever() and MMR interface as PGVector. Scores are cosine distances, as with
+    PGVector's default distance strategy.
+    """
+
+    def __init__(self, path, embedding, nprobe=DEFAULT_NPROBE):
+        """
+        Parameters:
+        - path (str): Directory of the store. Its current version is opened.
+        - embedding (Embeddings): Embeds queries. Must be the model the store was built with.
+        - nprobe (int, optional): IVF lists scanned per query; more is slower but closer to exact. Defaults to DEFAULT_NPROBE.
+        """
+        self.path = path
+        self.embedding = embedding
+        self.nprobe = nprobe
+        path = current_version_path(path) # resolved once, so every file comes from the same version
+
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        count, dimension = self.meta["count"], self.meta["dimension"]
+        if count:
+            self.vectors = np.memmap(os.path.join(path, EMBEDDINGS_FILE), dtype=np.float32, mode="r",
+                                     shape=(count, dimension))
+        else:
+            self.vectors = np.zeros((0, dimension), dtype=np.float32)
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self._documents_file = open(os.path.join(path, DOCUMENTS_FILE), "rb")
+        self._documents = mmap.mmap(self._documents_file.fileno(), 0, access=mmap.ACCESS_READ) if count else b""
+
+        self._ivf = None
+        if self.meta["index"] is not None and self.meta["index"]["type"] == "ivf":
+            self._ivf = (np.load(os.path.join(path, IVF_CENTROIDS_FILE)),
+                         np.load(os.path.join(path, IVF_ROWS_FILE), mmap_mode="r"),
+                         np.load(os.path.join(path, IVF_OFFSETS_FILE)))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def _record(self, row):
+        return json.loads(self._documents[self._offsets[row]:self._offsets[row + 1]])
+
+    def get_document(self, row):
+        record = self._record(row)
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def _nearest(self, queries, k):
+        """For each query embedding, (rows, cosine similarities) of its k nearest rows, best first."""
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if self._ivf is None or self.nprobe >= len(self._ivf[0]):
+            scores = self.vectors @ queries.T
+            results = []
+            for t in range(len(queries)):
+                top = _top_k(scores[:, t], k)
+                results.append((top, scores[top, t]))
+            return results
+
+        centroids, ivf_rows, ivf_offsets = self._ivf
+        centroid_scores = queries @ centroids.T
+        results = []
+        for t, query in enumerate(queries):
+            lists = _top_k(centroid_scores[t], self.nprobe)
+            rows = np.sort(np.concatenate([ivf_rows[ivf_offsets[l]:ivf_offsets[l + 1]] for l in lists]))
+            scores = self.vectors[rows] @ query
+            top = _top_k(scores, k)
+            results.append((rows[top], scores[top]))
+        return results
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        rows, similarities = self._nearest([embedding], k)[0]
+        return [(self.get_document(row), 1 - float(similarity)) for row, similarity in zip(rows, similarities)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        rows, _ = self._nearest([embedding], fetch_k)[0]
+        selection = batch_maximal_marginal_relevance([embedding], [self.vectors[rows]], k=k, lambda_mult=lambda_mult)[0]
+        return [self.get_document(rows[i]) for i in selection]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(self.embedding.embed_query(query), k, fetch_k, lambda_mult)
+
+    def search_candidates_by_vectors(self, embeddings, fetch_k=20):
+        """Same as utils.vectorstore.search_candidates_by_vectors() for this store: for each query embedding, its
+        nearest fetch_k (Document, embedding, id) tuples ordered by distance."""
+        if len(embeddings) == 0:
+            return []
+        results = []
+        for rows, _ in self._nearest(embeddings, fetch_k):
+            candidates = []
+            for row in rows:
+                record = self._record(row)
+                candidates.append((Document(page_content=record["page_content"], metadata=record["metadata"]),
+                                   self.vectors[row], record["id"]))
+            results.append(candidates)
+        return results
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise ReadOnlyVectorStoreError("MmapVectorStore is read-only: add the documents to the PGVector collection (i.e. with "
+                                       "python -m utils.ingest) and re-export it with python -m utils.mmap_vectorstore "
+                                       "--collection <name>, or build a new store with MmapVectorStore.from_texts()")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, path=None, ids=None, index="auto", nlist=None, **kwargs):
+        """
+        Embeds texts in batches of WRITE_BATCH_SIZE, writes them to a new store at path and opens it.
+
+        Parameters:
+        - texts (list): The documents' text.
+        - embedding (Embeddings): The embeddings model.
+        - metadatas (list, optional): One metadata dict per text.
+        - path (str): Directory of the store.
+        - ids (list, optional): One id per text. Defaults to the row numbers.
+        - index, nlist (optional): See MmapVectorStoreWriter.close().
+
+        Returns:
+        - MmapVectorStore: The new store.
+        """
+        if path is None:
+            raise ValueError("MmapVectorStore.from_texts needs a path to write the store to")
+        texts = list(texts)
+        writer = MmapVectorStoreWriter(path)
+        for start in range(0, len(texts), WRITE_BATCH_SIZE):
+            batch = texts[start:start + WRITE_BATCH_SIZE]
+            writer.add(batch, embedding.embed_documents(batch),
+                       metadatas[start:start + WRITE_BATCH_SIZE] if metadatas is not None else None,
+                       ids[start:start + WRITE_BATCH_SIZE] if ids is not None else None)
+        return cls(writer.close(index, nlist), embedding, **kwargs)
+
+    def close(self):
+        if isinstance(self._documents, mmap.mmap):
+            self._documents.close()
+        self._documents_file.close()
+
+
+def export_pgvector(vectorstore, path, batch_size=5000, index="auto", nlist=None):
+    """
+    Exports a PGVector collection, with its stored embeddings (nothing is re-embedded), to a MmapVectorStore directory.
+    Rows are streamed from the database batch_size at a time.
+
+    Parameters:
+    - vectorstore (PGVector): The collection to export.
+    - path (str): Directory of the store, i.e. default_index_path(collection_name).
+    - batch_size (int, optional): Rows fetched per round trip. Defaults to 5000.
+    - index, nlist (optional): See MmapVectorStoreWriter.close().
+
+    Returns:
+    - int: Number of exported documents.
+    """
+    from sqlalchemy.orm import Session
+
+    store = vectorstore.EmbeddingStore
+    writer = MmapVectorStoreWriter(path)
+    with Session(vectorstore._bind) as session:
+        collection = vectorstore.get_collection(session)
+        if not collection:
+            raise ValueError("Collection not found")
+        query = (session.query(store.uuid, store.document, store.cmetadata, store.embedding)
+                 .filter(store.collection_id == collection.uuid)
+                 .order_by(store.uuid)
+                 .yield_per(batch_size))
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.add([r.document for r in batch], [r.embedding for r in batch], [r.cmetadata for r in batch],
+                           [r.uuid for r in batch])
+                batch = []
+        if batch:
+            writer.add([r.document for r in batch], [r.embedding for r in batch], [r.cmetadata for r in batch],
+                       [r.uuid for r in batch])
+    writer.close(index, nlist)
+    return writer.count
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .vectorstore import get_shared_vectorstore
+
+    parser = argparse.ArgumentParser(description="Exports a PGVector collection to a memory-mapped vector store.")
+    parser.add_argument("--collection", default="corpus")
+    parser.add_argument("--path", default=None, help="store directory (default: VECTOR_INDEX_DIR/<collection>)")
+    parser.add_argument("--index", default="auto", choices=["auto", "ivf", "none"])
+    parser.add_argument("--nlist", type=int, default=None)
+    args = parser.parse_args()
+
+    vectorstore = get_shared_vectorstore(database="postgres", password=os.getenv("POSTGRESQL_PASSWORD"),
+                                         collection_name=args.collection, backend="pgvector")
+    count = export_pgvector(vectorstore, args.path or default_index_path(args.collection),
+                            index=None if args.index == "none" else args.index, nlist=args.nlist)
+    print("Exported " + str(count) + " documents")
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def batch_maximal_marginal_relevance(query_embeddings, candidate_embeddings, k=4, lambda_mult=0.5, candidate_ids=None):
+    """
+    Maximal marginal relevance for several queries at once. Gives the same selections as running langchain's
+    maximal_marginal_relevance() once per query, but scores every query in one vectorized NumPy pass per step.
+
+    Parameters:
+    - query_embeddings (list): One embedding per query.
+    - candidate_embeddings (list): For each query, the list of its candidate embeddings (lists may differ in length).
+    - k (int, optional): Number of candidates to select per query. Defaults to 4.
+    - lambda_mult (float, optional): 0 for maximum diversity, 1 for minimum diversity. Defaults to 0.5.
+    - candidate_ids (list, optional): For each query, an id per candidate. When given, a candidate id selected for one
+      query is not selected again for another query (queries take turns picking, in order). Defaults to None.
+
+    Returns:
+    - list: For each query, the indices of the selected candidates, in candidate order.
+    """
+    num_queries = len(query_embeddings)
+    max_candidates = max([len(candidates) for candidates in candidate_embeddings], default=0)
+    if num_queries == 0 or max_candidates == 0 or k <= 0:
+        return [[] for _ in range(num_queries)]
+
+    queries = _normalize(np.array(query_embeddings, dtype=np.float32))
+
+    # pad every query's candidates to the same length so all queries are scored together
+    candidates = np.zeros((num_queries, max_candidates, queries.shape[1]), dtype=np.float32)
+    valid = np.zeros((num_queries, max_candidates), dtype=bool)
+    for t, embeddings in enumerate(candidate_embeddings):
+        if len(embeddings):
+            candidates[t, :len(embeddings)] = np.array(embeddings, dtype=np.float32)
+            valid[t, :len(embeddings)] = True
+    candidates = _normalize(candidates)
+
+    query_similarity = np.einsum("td,tfd->tf", queries, candidates)
+    pairwise_similarity = np.einsum("tfd,tgd->tfg", candidates, candidates)
+
+    rows = np.arange(num_queries)
+    selected = np.zeros((num_queries, max_candidates), dtype=bool)
+    redundancy = np.full((num_queries, max_candidates), -np.inf, dtype=np.float32)
+    taken_ids = set()
+
+    for step in range(min(k, max_candidates)):
+        if step == 0:
+            scores = query_similarity.copy()
+        else:
+            scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[~valid | selected] = -np.inf
+
+        if candidate_ids is None:
+            picks = np.argmax(scores, axis=1)
+            picked = np.isfinite(scores[rows, picks])
+        else:
+            picks = np.zeros(num_queries, dtype=int)
+            picked = np.zeros(num_queries, dtype=bool)
+            for t in range(num_queries):
+                for index in np.argsort(-scores[t], kind="stable"):
+                    if not np.isfinite(scores[t, index]):
+                        break
+                    if candidate_ids[t][index] not in taken_ids:
+                        picks[t], picked[t] = index, True
+                        taken_ids.add(candidate_ids[t][index])
+                        break
+
+        if not picked.any():
+            break
+        selected[rows[picked], picks[picked]] = True
+        redundancy[picked] = np.maximum(redundancy[picked], pairwise_similarity[rows[picked], picks[picked]])
+
+    return [list(np.flatnonzero(selected[t])) for t in range(num_queries)]
@@ -0,0 +1,92 @@
+from langchain_core.load import dumps, loads
+import threading
+import warnings
+import os
+
+# Prompts shipped with the repo, used when nothing newer has been pulled into the local cache
+VENDORED_PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# Prompts pulled from the LangChain hub by refresh_prompt()
+PROMPT_CACHE_DIR = os.getenv("PROMPT_CACHE_DIR",
+                             os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "prompts"))
+
+_prompts = {}
+_prompts_lock = threading.Lock()
+
+
+def _prompt_filename(name):
+    return name.replace("/", "__") + ".json"
+
+
+def _load_prompt_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        with warnings.catch_warnings():  # loads() is marked beta
+            warnings.simplefilter("ignore")
+            return loads(f.read())
+
+
+def get_prompt(name):
+    """
+    Returns a hub prompt (i.e. "langchain-ai/retrieval-qa-chat") without touching the network.
+
+    Looks in memory, then in the local prompt cache (PROMPT_CACHE_DIR), then in the prompts vendored with the repo.
+    Use refresh_prompt() outside of request handling to pick up a newer version from the hub.
+
+    Parameters:
+    - name (str): The hub name of the prompt, "owner/repo".
+
+    Returns:
+    - The prompt template.
+    """
+    prompt = _prompts.get(name)
+    if prompt is not None:
+        return prompt
+
+    with _prompts_lock:
+        prompt = _prompts.get(name)
+        if prompt is None:
+            for directory in (PROMPT_CACHE_DIR, VENDORED_PROMPT_DIR):
+                path = os.path.join(directory, _prompt_filename(name))
+                if os.path.exists(path):
+                    prompt = _load_prompt_file(path)
+                    break
+            if prompt is None:
+                raise Exception("ERROR: prompt not found in local registry: " + name)
+            _prompts[name] = prompt
+
+    return prompt
+
+
+def refresh_prompt(name):
+    """
+    Pulls a prompt from the LangChain hub and stores it in the local prompt cache. Meant to be run at deploy time or
+    from a maintenance job, never on the request path.
+
+    Parameters:
+    - name (str): The hub name of the prompt, "owner/repo".
+
+    Returns:
+    - The pulled prompt template.
+    """
+    from langchain import hub
+
+    prompt = hub.pull(name)
+
+    os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(PROMPT_CACHE_DIR, _prompt_filename(name))
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(dumps(prompt, pretty=True))
+    os.replace(path + ".tmp", path)
+
+    with _prompts_lock:
+        _prompts[name] = prompt
+
+    return prompt
+
+
+if __name__ == '__main__':
+    import sys
+
+    for prompt_name in sys.argv[1:] or ["langchain-ai/retrieval-qa-chat"]:
+        refresh_prompt(prompt_name)
+        print("Refreshed " + prompt_name)
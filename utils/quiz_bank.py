@@ -0,0 +1,125 @@
+import threading
+import sqlite3
+import time
+import os
+
+QUIZ_BANK_PATH = os.getenv("QUIZ_BANK_PATH",
+                           os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "quiz_bank.sqlite3"))
+
+
+class QuizBank:
+    """
+    Local SQLite store of pre-generated, already validated quiz questions, indexed by (topic, type). Questions are
+    served to each user without repetition.
+
+    Questions use the same dict format as generate_quizzes._parse_quiz: {"type", "question", "topics", "choices", "answer"}.
+    """
+
+    def __init__(self, path=QUIZ_BANK_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY,
+                    topic_key TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    question TEXT NOT NULL UNIQUE,
+                    topic TEXT NOT NULL,
+                    choices TEXT,
+                    answer TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS questions_topic_type ON questions (topic_key, type);
+                CREATE TABLE IF NOT EXISTS served (
+                    userid TEXT NOT NULL,
+                    question_id INTEGER NOT NULL,
+                    PRIMARY KEY (userid, question_id)
+                );
+            """)
+            self._db.commit()
+
+    @staticmethod
+    def topic_key(topic):
+        return topic.strip().lower()
+
+    @staticmethod
+    def type_key(type):
+        # types are stored the way the quiz parser writes them, i.e. "SHORT_ANSWER"
+        return type.strip().upper()
+
+    def add(self, questions, userid=None):
+        """
+        Adds parsed questions to the bank, skipping questions already in it.
+
+        Parameters:
+        - questions (list): Parsed question dicts.
+        - userid (str, optional): If given, the questions are also marked as served to this user.
+
+        Returns:
+        - int: The number of new questions.
+        """
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO questions (topic_key, type, question, topic, choices, answer, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.topic_key(q["topics"]), self.type_key(q["type"]), q["question"], q["topics"], q["choices"], q["answer"], now)
+                 for q in questions])
+            added = self._db.total_changes - before
+            if userid is not None:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO served (userid, question_id) SELECT ?, id FROM questions WHERE question = ?",
+                    [(str(userid), q["question"]) for q in questions])
+            self._db.commit()
+        return added
+
+    def count(self, topic, type):
+        """Returns the number of questions in the bank for a (topic, type) pair."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM questions WHERE topic_key = ? AND type = ?",
+                                    (self.topic_key(topic), self.type_key(type))).fetchone()[0]
+
+    def sample(self, userid, numQs, topics, types, mark_served=True):
+        """
+        Draws up to numQs random questions on the given topics and types that have not been served to the user yet,
+        spread evenly across topics, and marks them as served.
+
+        Parameters:
+        - userid (str): The user the quiz is for.
+        - numQs (int): Number of questions wanted.
+        - topics (list[str]): Allowed topics.
+        - types (list[str]): Allowed question types, in any case.
+        - mark_served (bool, optional): Mark the drawn questions as served. Pass False if the quiz may still fail, and
+          mark them with add(questions, userid) once it is served. Defaults to True.
+
+        Returns:
+        - list: Up to numQs parsed question dicts (fewer if the bank is short).
+        """
+        topic_keys = [self.topic_key(topic) for topic in topics]
+        topic_placeholders = ",".join("?" * len(topic_keys))
+        type_keys = [self.type_key(type) for type in types]
+        type_placeholders = ",".join("?" * len(type_keys))
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, type, question, topic, choices, answer FROM ("
+                "  SELECT *, ROW_NUMBER() OVER (PARTITION BY topic_key ORDER BY RANDOM()) AS turn FROM questions"
+                "  WHERE topic_key IN (" + topic_placeholders + ") AND type IN (" + type_placeholders + ")"
+                "  AND id NOT IN (SELECT question_id FROM served WHERE userid = ?)"
+                ") ORDER BY turn, RANDOM() LIMIT ?",
+                topic_keys + type_keys + [str(userid), numQs]).fetchall()
+            if mark_served:
+                self._db.executemany("INSERT OR IGNORE INTO served (userid, question_id) VALUES (?, ?)",
+                                     [(str(userid), row[0]) for row in rows])
+                self._db.commit()
+
+        return [{"type": type, "question": question, "topics": topic, "choices": choices, "answer": answer}
+                for _, type, question, topic, choices, answer in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,130 @@
+import re
+
+DIVIDER = "------DIVIDER------\n"
+QUESTION_TYPES = ("MULTIPLE_CHOICE", "SHORT_ANSWER", "CODING", "TRUE_FALSE")
+
+# compiled once instead of for every line
+QUESTION_PATTERN = re.compile(r'\d+\.')
+TOPIC_PATTERN = re.compile(r'Topic: ')
+TYPE_PATTERN = re.compile(r'Type: ')
+ANSWER_PATTERN = re.compile(r'Answer: ')
+CHOICES_PATTERN = re.compile(r'[A-D]\) ') # for MC questions specifically
+
+
+class QuizFormatError(Exception):
+    '''Raised as soon as a generated quiz is known to be unusable.'''
+    pass
+
+
+def _valid_topics(topics):
+    valid = set()
+    for topic_split in topics.split(","):
+        topic_split = topic_split[1:] if topic_split[0] == " " else topic_split # remove leading space if present
+        valid.add(topic_split.lower()) # .lower to be case insensitive
+    return valid
+
+
+def parse_section(section, valid_topics):
+    '''Parses the text of one question (between dividers) and returns it as a question dict, or raises QuizFormatError.'''
+
+    question = ""
+    topic = ""
+    type = ""
+    choices = ""
+    answer = ""
+
+    # traverse each line
+    within_answer = False # flag for handling multi-line answers (for coding questions)
+    for line in section.split("\n"):
+
+        # search each line for applicable patterns
+        if within_answer: # for handling multi-line answers (for coding questions)
+            answer += line
+        if QUESTION_PATTERN.search(line):
+            question = line.split(". ")[1]
+        elif TOPIC_PATTERN.search(line):
+            topic = line.split(": ")[1]
+        elif TYPE_PATTERN.search(line):
+            type = line.split(": ")[1]
+        elif ANSWER_PATTERN.search(line):
+            within_answer = True
+            answer += line.split(": ")[1]
+        elif CHOICES_PATTERN.search(line):
+            choices += line.split(") ")[1] + "@"
+
+    # check question-specific conditions of incorrect quiz format:
+    # if question is MULTIPLE_CHOICE but does not have exactly 4 answer choices
+    if type == "MULTIPLE_CHOICE" and len(choices[:-2].split("@")) != 4:
+        raise QuizFormatError('mc question does not have exactly 4 choices\nCHOICES: ' + choices)
+    # if question is TRUE_FALSE but does not have exactly 2 answer choices
+    if type == "TRUE_FALSE" and len(choices[:-2].split("@")) != 2: # -2 to remove comma at end
+        raise QuizFormatError('tf question does not have exactly 2 choices\nCHOICES: ' + choices)
+    # if question is not a valid type
+    if type not in QUESTION_TYPES:
+        raise QuizFormatError('question type is not valid\nTYPE: ' + type)
+    # if question topic is not one of the specified topics
+    if topic.lower() not in valid_topics:
+        raise QuizFormatError('question topic is not one of the requested topics\nTOPIC: ' + topic)
+
+    return {
+        "type": type,
+        "question": question,
+        "topics": topic,
+        "choices": choices[:-1] if type == "MULTIPLE_CHOICE" or type == "TRUE_FALSE" else None, # -1 to remove '@' at end
+        "answer": answer
+    }
+
+
+class QuizStreamParser:
+    '''Single-pass incremental parser for a generated quiz. Text is fed in as it streams from the model; each question
+    is validated and returned as soon as its divider arrives, and QuizFormatError is raised at the first section that
+    cannot be used, so the caller can cancel the generation and retry right away.'''
+
+    def __init__(self, numQs, topics, types):
+        self.numQs = numQs
+        self.types = types
+        self.valid_topics = _valid_topics(topics)
+        self.questions = []
+        self.raw = ""
+        self._buffer = ""
+
+    def _add_section(self, section):
+        # skip blank question sections (i.e. if divider is at end of quiz)
+        if section.strip() == "":
+            return None
+        try:
+            question = parse_section(section, self.valid_topics)
+        except IndexError: # a malformed line, i.e. "Topic:" without a topic
+            raise QuizFormatError('question section has a malformed line\nSECTION: ' + section)
+        self.questions.append(question)
+        if len(self.questions) > self.numQs:
+            raise QuizFormatError('generated num of questions exceeds expected num\nEXPECTED: ' + str(self.numQs))
+        return question
+
+    def feed(self, text):
+        '''Consumes the next piece of the completion and returns the list of questions completed by it.'''
+
+        if self.raw == "":
+            text = text.lstrip()
+        self.raw += text
+        self._buffer += text
+
+        completed = []
+        while DIVIDER in self._buffer:
+            section, self._buffer = self._buffer.split(DIVIDER, 1)
+            question = self._add_section(section)
+            if question is not None:
+                completed.append(question)
+        return completed
+
+    def close(self):
+        '''Parses whatever follows the last divider and returns the full quiz body, or raises QuizFormatError.'''
+
+        self._add_section(self._buffer)
+        self._buffer = ""
+
+        # if number of questions does not match number asked for in quiz generation
+        if len(self.questions) != self.numQs:
+            raise QuizFormatError('generated num of questions does not match expected num\nEXPECTED: ' + str(self.numQs) +
+                                  '\nGENERATED: ' + str(len(self.questions)))
+        return {"questions": self.questions}
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import numpy as np
+import threading
+import asyncio
+import time
+
+from .tracing import span
+
+
+class _Retrieval:
+    """The documents last retrieved for a chat, with the query they were retrieved for."""
+
+    __slots__ = ("scope", "query_vector", "documents", "document_vectors", "relevance", "created")
+
+    def __init__(self, scope, query_vector, documents, document_vectors):
+        self.scope = scope
+        self.query_vector = query_vector
+        self.documents = documents
+        self.document_vectors = document_vectors # normalized, one row per document, or None if the store has no vectors
+        self.relevance = float((document_vectors @ query_vector).max()) if document_vectors is not None else None
+        self.created = time.time()
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector, axis=-1, keepdims=True)
+    return vector / np.where(norm == 0, 1, norm)
+
+
+class ConversationRetrievalCache:
+    """
+    Per-chat retrieval cache. Keeps the documents (and their embeddings) last retrieved for every chat and serves them
+    again while the conversation stays on the same topic, i.e. for follow-ups like "can you explain that more?".
+
+    A new query reuses the cached documents if it is within min_similarity (cosine) of the query they were retrieved
+    for, or if the cached documents are still at least min_relevance times as relevant to it as they were to that
+    query. Otherwise the topic drifted and a new search runs. Queries are embedded once; a new search reuses the
+    embedding instead of having the vector store embed the query again.
+    """
+
+    def __init__(self, embeddings, min_similarity=0.85, min_relevance=0.9, max_chats=1000, ttl=30 * 60):
+        """
+        Parameters:
+        - embeddings (Embeddings): The embeddings function of the vector store, used for queries.
+        - min_similarity (float, optional): Smallest cosine similarity to the cached query at which documents are reused. Defaults to 0.85.
+        - min_relevance (float, optional): Smallest ratio of the best cached document's similarity to the new query over
+          its similarity to the cached query at which documents are reused. Defaults to 0.9.
+        - max_chats (int, optional): Maximum number of chats kept, least recently used are evicted. Defaults to 1000.
+        - ttl (float, optional): Seconds cached documents are reused. None never expires. Defaults to 30 minutes.
+        """
+        self.embeddings = embeddings
+        self.min_similarity = min_similarity
+        self.min_relevance = min_relevance
+        self.max_chats = max_chats
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._retrievals = OrderedDict() # chat -> _Retrieval
+        self._lock = threading.Lock()
+
+    def _match(self, chat, scope, vector):
+        now = time.time()
+        with self._lock:
+            retrieval = self._retrievals.get(chat)
+            if retrieval is not None and retrieval.scope == scope and (self.ttl is None or now - retrieval.created <= self.ttl):
+                close = float(retrieval.query_vector @ vector) >= self.min_similarity
+                if not close and retrieval.relevance:
+                    close = float((retrieval.document_vectors @ vector).max()) >= self.min_relevance * retrieval.relevance
+                if close:
+                    self._retrievals.move_to_end(chat)
+                    self.hits += 1
+                    return retrieval.documents
+            self.misses += 1
+            return None
+
+    def _store(self, chat, scope, vector, documents, document_vectors):
+        if document_vectors is not None and len(document_vectors):
+            document_vectors = _normalize(np.vstack(document_vectors))
+        else:
+            document_vectors = None
+        with self._lock:
+            self._retrievals[chat] = _Retrieval(scope, vector, documents, document_vectors)
+            self._retrievals.move_to_end(chat)
+            while len(self._retrievals) > self.max_chats:
+                self._retrievals.popitem(last=False)
+
+    @staticmethod
+    def _vector_search(retriever, embedding):
+        # searches with the query embedding when the store can return the document embeddings in the same round trip;
+        # retrievers with search settings besides k (filter, score_threshold, ...) run their own search instead
+        from .vectorstore import search_candidates_by_vectors, supports_batch_search
+
+        vectorstore = getattr(retriever, "vectorstore", None)
+        if vectorstore is None or retriever.search_type != "similarity" or set(retriever.search_kwargs) - {"k"}:
+            return None
+        if not supports_batch_search(vectorstore):
+            return None
+        with span("retrieval") as s:
+            rows = search_candidates_by_vectors(vectorstore, [embedding], retriever.search_kwargs.get("k", 4))[0]
+            s.set(documents=len(rows))
+        return [document for document, _, _ in rows], [vector for _, vector, _ in rows]
+
+    def retrieve(self, chat, scope, query, retriever, config=None):
+        """
+        Returns the documents for a chat's new query, reusing the chat's last retrieval if the topic did not drift.
+
+        Parameters:
+        - chat (hashable): Identifies the chat, i.e. (userid, chatid), since chat IDs are only unique per user.
+        - scope: Identifies the collection and search settings; documents are only reused for the same scope.
+        - query (str): The new query.
+        - retriever (BaseRetriever): Runs the search on a miss.
+        - config (dict, optional): Runnable config passed to the retriever (i.e. tracing callbacks).
+
+        Returns:
+        - list: The documents.
+        """
+        with span("conversation_retrieval", reused=0) as s:
+            vector = _normalize(self.embeddings.embed_query(query))
+            documents = self._match(chat, scope, vector)
+            if documents is not None:
+                s.set(reused=1)
+                return documents
+
+            found = self._vector_search(retriever, vector.tolist())
+            documents, document_vectors = found if found is not None else (retriever.invoke(query, config), None)
+            self._store(chat, scope, vector, documents, document_vectors)
+            return documents
+
+    async def aretrieve(self, chat, scope, query, retriever, config=None):
+        """Awaitable version of retrieve()."""
+        with span("conversation_retrieval", reused=0) as s:
+            vector = _normalize(await self.embeddings.aembed_query(query))
+            documents = self._match(chat, scope, vector)
+            if documents is not None:
+                s.set(reused=1)
+                return documents
+
+            found = await asyncio.to_thread(self._vector_search, retriever, vector.tolist())
+            if found is not None:
+                documents, document_vectors = found
+            else:
+                documents, document_vectors = await retriever.ainvoke(query, config), None
+            self._store(chat, scope, vector, documents, document_vectors)
+            return documents
+
+    def forget(self, chat):
+        """Drops the cached documents of a chat, i.e. when the chat is deleted."""
+        with self._lock:
+            self._retrievals.pop(chat, None)
+
+    def invalidate(self):
+        """Drops the cached documents of every chat, i.e. after the collection is re-indexed."""
+        with self._lock:
+            self._retrievals.clear()
+
+    def stats(self):
+        """
+        Returns:
+        - dict: Hit/miss counters and the number of chats with cached documents.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._retrievals)}
@@ -0,0 +1,90 @@
+import threading
+import hashlib
+import sqlite3
+import asyncio
+import time
+import os
+
+from .embeddings_cache import normalize_text
+from .single_flight import SingleFlight
+
+RUBRIC_CACHE_PATH = os.getenv("RUBRIC_CACHE_PATH",
+                              os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "rubrics.sqlite3"))
+
+
+class RubricCache:
+    """
+    Persistent store of the answer points (grading rubric) extracted from a question's optimal answer, keyed by a
+    hash of the normalized (question, answer) pair, so each question's rubric is extracted once no matter how many
+    submissions are graded against it.
+    """
+
+    def __init__(self, path=RUBRIC_CACHE_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._extractions = SingleFlight("rubric_extraction", copy_results=False) # one extraction per key at a time
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS rubrics (key TEXT PRIMARY KEY, points TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def key(question, answer):
+        return hashlib.sha256((normalize_text(question) + "\0" + normalize_text(answer)).encode("utf-8")).hexdigest()
+
+    def get(self, question, answer):
+        """Returns the cached answer points for the (question, answer) pair, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT points FROM rubrics WHERE key = ?", (self.key(question, answer),)).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, question, answer, points):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO rubrics (key, points, created) VALUES (?, ?, ?)",
+                             (self.key(question, answer), points, time.time()))
+            self._db.commit()
+
+    def _extract(self, question, answer, extract):
+        # a concurrent extraction for the pair may have landed between the caller's miss and its flight
+        points = self.get(question, answer)
+        if points is None:
+            points = extract()
+            self.set(question, answer, points)
+        return points
+
+    async def _aextract(self, question, answer, extract):
+        points = await asyncio.to_thread(self.get, question, answer)
+        if points is None:
+            points = await extract()
+            await asyncio.to_thread(self.set, question, answer, points)
+        return points
+
+    def get_or_extract(self, question, answer, extract):
+        """
+        Returns the cached answer points for the (question, answer) pair, calling extract() to produce and cache them on
+        a miss. Concurrent callers for the same pair, sync or async (see aget_or_extract), wait for a single extraction.
+
+        Parameters:
+        - question (str): The question text.
+        - answer (str): The optimal answer to the question.
+        - extract (func): Called with no arguments on a miss, returns the answer points as a str.
+
+        Returns:
+        - str: The answer points.
+        """
+        points = self.get(question, answer)
+        if points is not None:
+            return points
+        return self._extractions.do(self.key(question, answer), lambda: self._extract(question, answer, extract))
+
+    async def aget_or_extract(self, question, answer, extract):
+        """Awaitable version of get_or_extract(). extract() returns an awaitable."""
+        points = await asyncio.to_thread(self.get, question, answer)
+        if points is not None:
+            return points
+        return await self._extractions.ado(self.key(question, answer), lambda: self._aextract(question, answer, extract))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
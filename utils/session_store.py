@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import threading
+import sqlite3
+import time
+import os
+
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH",
+                               os.path.join(os.path.expanduser("~"), ".cache", "main_agent", "sessions.sqlite3"))
+
+
+class SessionStore:
+    """
+    Server-side chat histories keyed by (userid, chatid), so clients only send the new message. Recent sessions are
+    kept in an in-memory LRU; with a path, every message is also written to SQLite so sessions survive a restart and
+    sessions evicted from memory are loaded back on demand.
+
+    Messages use the same format as previous_messages in main.run_chat: even indices are user messages and odd
+    indices are AI responses.
+    """
+
+    def __init__(self, path=SESSION_STORE_PATH, max_sessions=1000):
+        """
+        Parameters:
+        - path (str, optional): SQLite file of the persistence tier, or None to keep sessions in memory only.
+          Defaults to SESSION_STORE_PATH.
+        - max_sessions (int, optional): Maximum number of sessions kept in memory. Defaults to 1000.
+        """
+        self.max_sessions = max_sessions
+        self._memory = OrderedDict() # (userid, chatid) -> list of messages
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS messages (userid TEXT NOT NULL, chatid TEXT NOT NULL, "
+                             "seq INTEGER NOT NULL, content TEXT NOT NULL, created REAL NOT NULL, "
+                             "PRIMARY KEY (userid, chatid, seq))")
+            self._db.commit()
+
+    @staticmethod
+    def _key(userid, chatid):
+        return str(userid), str(chatid)
+
+    def _session(self, key):
+        # caller holds self._lock; returns the session's message list, loading it from disk on a memory miss
+        messages = self._memory.get(key)
+        if messages is None:
+            messages = []
+            if self._db is not None:
+                messages = [row[0] for row in self._db.execute(
+                    "SELECT content FROM messages WHERE userid = ? AND chatid = ? ORDER BY seq", key)]
+            self._memory[key] = messages
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_sessions:
+            self._memory.popitem(last=False)
+        return messages
+
+    def get(self, userid, chatid):
+        """Returns a copy of the session's messages ([] for a new session)."""
+        with self._lock:
+            return list(self._session(self._key(userid, chatid)))
+
+    def append(self, userid, chatid, *messages):
+        """Appends messages (i.e. a user message and the AI response) to the session."""
+        key = self._key(userid, chatid)
+        with self._lock:
+            session = self._session(key)
+            if self._db is not None:
+                now = time.time()
+                self._db.executemany("INSERT INTO messages (userid, chatid, seq, content, created) VALUES (?, ?, ?, ?, ?)",
+                                     [key + (len(session) + i, message, now) for i, message in enumerate(messages)])
+                self._db.commit()
+            session.extend(messages)
+
+    def replace(self, userid, chatid, messages):
+        """Replaces the session's messages, i.e. with a full history sent by a client."""
+        key = self._key(userid, chatid)
+        with self._lock:
+            if self._db is not None:
+                now = time.time()
+                self._db.execute("DELETE FROM messages WHERE userid = ? AND chatid = ?", key)
+                self._db.executemany("INSERT INTO messages (userid, chatid, seq, content, created) VALUES (?, ?, ?, ?, ?)",
+                                     [key + (i, message, now) for i, message in enumerate(messages)])
+                self._db.commit()
+            self._memory[key] = list(messages)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_sessions:
+                self._memory.popitem(last=False)
+
+    def delete(self, userid, chatid):
+        key = self._key(userid, chatid)
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM messages WHERE userid = ? AND chatid = ?", key)
+                self._db.commit()
+            self._memory.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
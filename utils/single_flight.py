@@ -0,0 +1,114 @@
+from concurrent.futures import Future
+import threading
+import asyncio
+import copy
+import time
+
+from .tracing import record
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight, later calls for the same key wait for it
+    and receive its result (or exception) instead of repeating the work. Thread callers (do()) and asyncio callers
+    (ado()) share flights, so an async request can join a computation a worker thread started and the other way round.
+    Nothing is cached: once a flight lands, the next call for its key runs again.
+    """
+
+    def __init__(self, name, copy_results=True):
+        """
+        Parameters:
+        - name (str): Tracing stage under which every call is recorded with collapsed=0 (ran) or 1 (joined a flight).
+        - copy_results (bool, optional): Give every caller that joined a flight its own deep copy of the result, so
+          callers can modify what they get. Defaults to True.
+        """
+        self.name = name
+        self.copy_results = copy_results
+
+        self.calls = 0
+        self.executions = 0
+        self.collapsed = 0
+
+        self._flights = {} # key -> (Future, [number of callers that joined])
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        # returns (flight, True if the caller runs it)
+        with self._lock:
+            self.calls += 1
+            entry = self._flights.get(key)
+            if entry is not None:
+                entry[1][0] += 1
+                self.collapsed += 1
+                return entry[0], False
+            flight = Future()
+            self._flights[key] = (flight, [0])
+            self.executions += 1
+            return flight, True
+
+    def _land(self, key, flight, result=None, error=None):
+        with self._lock:
+            joined = self._flights.pop(key)[1][0]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            # the leader keeps the original, callers that joined copy from a snapshot it cannot modify
+            flight.set_result(copy.deepcopy(result) if joined and self.copy_results else result)
+
+    def _shared(self, result, start):
+        record(self.name, time.perf_counter() - start, collapsed=1)
+        return copy.deepcopy(result) if self.copy_results else result
+
+    def do(self, key, func):
+        """
+        Returns func(), or the result of the call already in flight for key.
+
+        Parameters:
+        - key (hashable): Identifies identical calls, i.e. their normalized arguments.
+        - func (func): Computes the result.
+        """
+        start = time.perf_counter()
+        flight, leader = self._join(key)
+        if not leader:
+            return self._shared(flight.result(), start)
+        try:
+            result = func()
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, result)
+        record(self.name, time.perf_counter() - start, collapsed=0)
+        return result
+
+    async def ado(self, key, func):
+        """
+        Awaitable version of do(). func() returns an awaitable. The computation runs as its own task, so it finishes
+        for the callers that joined it even if the caller that started it is cancelled.
+        """
+        start = time.perf_counter()
+        flight, leader = self._join(key)
+        if not leader:
+            return self._shared(await asyncio.shield(asyncio.wrap_future(flight)), start)
+
+        def land(task):
+            if task.cancelled():
+                self._land(key, flight, error=asyncio.CancelledError())
+            elif task.exception() is not None:
+                self._land(key, flight, error=task.exception())
+            else:
+                self._land(key, flight, task.result())
+
+        task = asyncio.ensure_future(func())
+        task.add_done_callback(land)
+        result = await asyncio.shield(task)
+        record(self.name, time.perf_counter() - start, collapsed=0)
+        return result
+
+    def stats(self):
+        """
+        Returns:
+        - dict: Calls, executions (calls that ran), collapsed (calls that joined a flight) and flights in flight.
+        """
+        with self._lock:
+            return {"calls": self.calls, "executions": self.executions, "collapsed": self.collapsed,
+                    "in_flight": len(self._flights)}
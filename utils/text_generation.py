@@ -1,20 +1,239 @@
 # from langchain.chat_models import ChatOpenAI
 # from langchain_community.chat_models import ChatOpenAI
-from langchain_openai import ChatOpenAI
-from langchain.chains import LLMChain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain.chains import create_retrieval_chain
-from langchain import hub
+# langchain_openai and langchain.chains are imported on first use, they take seconds to import
+from collections import OrderedDict
 from dotenv import load_dotenv
+from functools import partial
+import threading
 import re
 
+from . import context_packing
+from .context_packing import pack_context
+from .llm_scheduler import current_priority, CHAT, QUIZ, GRADING
+from .prompt_registry import get_prompt
+from .tracing import chain_config
+
 # Load environment variables from .env file
 load_dotenv()
 
+DEFAULT_MODEL = "gpt-3.5-turbo"
+RETRIEVAL_QA_CHAT_PROMPT = "langchain-ai/retrieval-qa-chat"
+MAX_CACHED_CHAINS = 64
+COMPLETION_TOKENS_ESTIMATE = 300 # completion tokens assumed per call when reserving rate limit budget
+
+# Default priority class of each chain mode when none is set with llm_priority(): chat turns use the history modes,
+# quiz generation retrieves documents without history, and grading prompts the model directly.
+MODE_PRIORITIES = {"history": CHAT, "docs_and_history": CHAT, "docs": QUIZ, "base": GRADING}
+
+_llm_factory = None
+_conversation_cache = None
+_llm_scheduler = None
+_llms = {}
+_chains = OrderedDict()  # LRU of built chains, keyed by (mode, model, temperature, retriever)
+_cache_lock = threading.Lock()
+
+
+def set_llm_factory(factory=None):
+    """
+    Overrides how chat models are built, i.e. to plug in a fake model for tests. Clears all cached models and chains.
+
+    Parameters:
+    - factory (func, optional): Called as factory(model_name, temperature) and returns a chat model. None restores ChatOpenAI.
+    """
+    global _llm_factory
+    with _cache_lock:
+        _llm_factory = factory
+        _llms.clear()
+        _chains.clear()
+
+
+def set_conversation_cache(cache=None):
+    """
+    Sets the per-chat retrieval cache used by the "docs_and_history" chains when a chatid is given.
+
+    Parameters:
+    - cache (ConversationRetrievalCache, optional): The cache. None retrieves on every turn.
+    """
+    global _conversation_cache
+    _conversation_cache = cache
+
+
+def set_llm_scheduler(scheduler=None):
+    """
+    Routes every chain call through a shared LLMScheduler (rate limits, adaptive concurrency, priorities and retries).
+    Clears all cached models and chains, since OpenAI models then leave retries to the scheduler.
+
+    Parameters:
+    - scheduler (LLMScheduler, optional): The scheduler. None calls the models directly.
+    """
+    global _llm_scheduler
+    with _cache_lock:
+        _llm_scheduler = scheduler
+        _llms.clear()
+        _chains.clear()
+
+
+def get_llm(model_name=DEFAULT_MODEL, temperature=0.7):
+    """
+    Returns the shared chat model for a model name and temperature, building it on first use.
+    """
+    key = (model_name, temperature)
+    with _cache_lock:
+        llm = _llms.get(key)
+        if llm is None:
+            if _llm_factory is not None:
+                llm = _llm_factory(model_name, temperature)
+            else:
+                from langchain_openai import ChatOpenAI
+                if _llm_scheduler is not None:
+                    # surface rate limit errors to the scheduler instead of retrying inside the client
+                    llm = ChatOpenAI(model_name=model_name, temperature=temperature, max_retries=0)
+                else:
+                    llm = ChatOpenAI(model_name=model_name, temperature=temperature)
+            _llms[key] = llm
+    return llm
+
+
+def _retriever_key(retriever):
+    # Retrievers made by separate as_retriever() calls on the same store are interchangeable, so key them by store
+    # and search settings rather than by object identity.
+    if retriever is None:
+        return None
+    vectorstore = getattr(retriever, "vectorstore", None)
+    if vectorstore is not None:
+        return (id(vectorstore), retriever.search_type, repr(sorted(retriever.search_kwargs.items())))
+    return id(retriever)
+
+
+def _retrieve(retriever, inputs, config=None):
+    # the retrieval step of the "docs" chains: reuses the chat's last documents while the topic stays the same
+    cache = _conversation_cache
+    if cache is None or inputs.get("chatid") is None:
+        return retriever.invoke(inputs["input"], config)
+    return cache.retrieve((inputs.get("userid"), inputs["chatid"]), _retriever_key(retriever), inputs["input"],
+                          retriever, config)
+
+
+async def _aretrieve(retriever, inputs, config=None):
+    cache = _conversation_cache
+    if cache is None or inputs.get("chatid") is None:
+        return await retriever.ainvoke(inputs["input"], config)
+    return await cache.aretrieve((inputs.get("userid"), inputs["chatid"]), _retriever_key(retriever), inputs["input"],
+                                 retriever, config)
+
+
+def _build_chain(mode, retriever, llm):
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    from langchain.chains import LLMChain, create_retrieval_chain
+    from langchain_core.runnables import RunnableLambda
+
+    if mode in ("base", "history"):
+        prompt = ChatPromptTemplate.from_messages([("system", "{system_prompt}"),
+                                                   MessagesPlaceholder(variable_name="history"),
+                                                   ("human", "{input}")])
+        return LLMChain(prompt=prompt, llm=llm)
+    elif mode in ("docs", "docs_and_history"):
+        combine_docs_chain = create_stuff_documents_chain(llm, get_prompt(RETRIEVAL_QA_CHAT_PROMPT))
+        # retrieved documents are packed into the context token budget before they are stuffed into the prompt
+        retrieval_docs = (RunnableLambda(partial(_retrieve, retriever), afunc=partial(_aretrieve, retriever))
+                          | RunnableLambda(pack_context))
+        return create_retrieval_chain(retrieval_docs, combine_docs_chain)
+    raise ValueError("Unknown chain mode: " + str(mode))
+
+
+def get_chain(mode, retriever=None, model_name=DEFAULT_MODEL, temperature=0.7):
+    """
+    Returns the chain for a generation mode, building it once per (mode, model, temperature, retriever) and reusing it.
+
+    Parameters:
+    - mode (str): One of "base", "history", "docs" or "docs_and_history".
+    - retriever (optional): Retriever for the "docs" modes. Default is None.
+    - model_name (str, optional): The OpenAI chat model. Default is DEFAULT_MODEL.
+    - temperature (float, optional): Parameter controlling the randomness of the response generation. Default is 0.7.
+
+    Returns:
+    - The chain. The system prompt and chat history are passed as inputs, so the chain is shared between requests.
+    """
+    key = (mode, model_name, temperature, _retriever_key(retriever))
+    with _cache_lock:
+        entry = _chains.get(key)
+        if entry is not None:
+            _chains.move_to_end(key)
+            return entry[0]
+
+    chain = _build_chain(mode, retriever, get_llm(model_name, temperature))
+
+    with _cache_lock:
+        if key not in _chains:
+            # keep a reference to the retriever so its id() cannot be reused while the chain is cached
+            _chains[key] = (chain, retriever)
+            if len(_chains) > MAX_CACHED_CHAINS:
+                _chains.popitem(last=False)
+        return _chains[key][0]
+
+
+def _history_messages(chat_history_func):
+    return chat_history_func().messages
+
+
+def _estimate_tokens(mode, inputs):
+    # prompt and completion tokens a call reserves from the scheduler's token bucket
+    from .chat_history import count_tokens
+
+    tokens = COMPLETION_TOKENS_ESTIMATE
+    for value in inputs.values():
+        if isinstance(value, str):
+            tokens += count_tokens(value)
+        elif isinstance(value, list):
+            tokens += sum(count_tokens(str(message.content)) for message in value)
+    if mode in ("docs", "docs_and_history"):
+        tokens += context_packing.token_budget or context_packing.CONTEXT_TOKEN_BUDGET
+    return tokens
+
+
+def _scheduled(mode, inputs):
+    # (scheduler, priority, tokens) for a chain call, or None while no scheduler is set
+    scheduler = _llm_scheduler
+    if scheduler is None:
+        return None
+    return scheduler, current_priority(MODE_PRIORITIES[mode]), _estimate_tokens(mode, inputs)
+
+
+def _invoke(mode, chain, inputs):
+    scheduled = _scheduled(mode, inputs)
+    if scheduled is None:
+        return chain.invoke(inputs, config=chain_config())
+    scheduler, priority, tokens = scheduled
+    return scheduler.call(lambda: chain.invoke(inputs, config=chain_config()), priority, tokens)
+
+
+async def _ainvoke(mode, chain, inputs):
+    scheduled = _scheduled(mode, inputs)
+    if scheduled is None:
+        return await chain.ainvoke(inputs, config=chain_config())
+    scheduler, priority, tokens = scheduled
+    return await scheduler.acall(lambda: chain.ainvoke(inputs, config=chain_config()), priority, tokens)
+
+
+def _stream(mode, chain, inputs):
+    scheduled = _scheduled(mode, inputs)
+    if scheduled is None:
+        return chain.stream(inputs, config=chain_config())
+    scheduler, priority, tokens = scheduled
+    return scheduler.stream(lambda: chain.stream(inputs, config=chain_config()), priority, tokens)
 
-def generate(input_str, system_prompt=None, chat_history_func=None, retriever=None, temperature=0.7):
+
+def _astream(mode, chain, inputs):
+    scheduled = _scheduled(mode, inputs)
+    if scheduled is None:
+        return chain.astream(inputs, config=chain_config())
+    scheduler, priority, tokens = scheduled
+    return scheduler.astream(lambda: chain.astream(inputs, config=chain_config()), priority, tokens)
+
+
+def generate(input_str, system_prompt=None, chat_history_func=None, retriever=None, temperature=0.7, chatid=None,
+             userid=None):
     """
     A function that routes the text generation process based on the provided parameters.
 
@@ -24,12 +243,15 @@ def generate(input_str, system_prompt=None, chat_history_func=None, retriever=No
     - chat_history_func (func, optional): Function to provide chat history. Default is None.
     - retriever (optional): Retriever for Retrival Augmented Generation (RAG). Default is None.
     - temperature (float, optional): Parameter controlling the randomness of the response generation. Default is 0.7.
+    - chatid (str, optional): The ID of the chat, to reuse its last retrieval (see set_conversation_cache()). Default is None.
+    - userid (str, optional): The ID of the user the chat belongs to; retrievals are reused per (userid, chatid). Default is None.
 
     Returns:
     - The generated text based on the input and optional parameters.
     """
     if chat_history_func and retriever:
-        return generate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=temperature)
+        return generate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=temperature,
+                                              chatid=chatid, userid=userid)
     elif chat_history_func:
         return generate_with_history(input_str, system_prompt, chat_history_func, temperature=temperature)
     elif retriever:
@@ -42,12 +264,8 @@ def generate_base(input_str, system_prompt, temperature=0.7):
     """
     Internal Function, used by generate() function. You likely want to use generate() instead.
     """
-    prompt = ChatPromptTemplate.from_messages([("system", system_prompt),
-                                               MessagesPlaceholder(variable_name="history"),
-                                               ("human", "{input}")])
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=temperature)
-    chain = LLMChain(prompt=prompt, llm=llm)
-    message = chain.invoke({"input": input_str, "history": []})
+    chain = get_chain("base", temperature=temperature)
+    message = _invoke("base", chain, {"input": input_str, "system_prompt": system_prompt, "history": []})
     return message["text"].strip()
 
 
@@ -55,11 +273,8 @@ def generate_with_docs(input_str, system_prompt, retriever, temperature=0.7):
     """
     Internal Function, used by generate() function. You likely want to use generate() instead.
     """
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=temperature)
-    retrieval_qa_chat_prompt = hub.pull("langchain-ai/retrieval-qa-chat")
-    combine_docs_chain = create_stuff_documents_chain(llm, retrieval_qa_chat_prompt)
-    retrieval_chain = create_retrieval_chain(retriever, combine_docs_chain)
-    message = retrieval_chain.invoke({"input": input_str, "context": system_prompt})
+    retrieval_chain = get_chain("docs", retriever, temperature=temperature)
+    message = _invoke("docs", retrieval_chain, {"input": input_str, "context": system_prompt})
     return message['answer'].strip()
 
 
@@ -67,28 +282,139 @@ def generate_with_history(input_str, system_prompt, chat_history_func, temperatu
     """
     Internal Function, used by generate() function. You likely want to use generate() instead.
     """
-    prompt = ChatPromptTemplate.from_messages([("system", system_prompt),
-                                               MessagesPlaceholder(variable_name="history"),
-                                               ("human", "{input}")])
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=temperature)
-    chain = LLMChain(prompt=prompt, llm=llm)
-    with_message_history = RunnableWithMessageHistory(chain, chat_history_func, input_messages_key='input',
-                                                      history_messages_key='history', output_messages_key='text')
-    message = with_message_history.invoke({"input": input_str}, config={'configurable': {'session_id': 'test'}})
+    chain = get_chain("history", temperature=temperature)
+    message = _invoke("history", chain, {"input": input_str, "system_prompt": system_prompt,
+                                         "history": _history_messages(chat_history_func)})
     return message['text'].strip()
 
 
-def generate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=0.7):
+def generate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=0.7, chatid=None,
+                                   userid=None):
     """
     Internal Function, used by generate() function. You likely want to use generate() instead.
     """
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=temperature)
-    retrieval_qa_chat_prompt = hub.pull("langchain-ai/retrieval-qa-chat")
-    combine_docs_chain = create_stuff_documents_chain(llm, retrieval_qa_chat_prompt)
-    retrieval_chain = create_retrieval_chain(retriever, combine_docs_chain)
-    with_message_history = RunnableWithMessageHistory(retrieval_chain, chat_history_func, input_messages_key='input',
-                                                      history_messages_key='chat_history', output_messages_key='answer')
-    message = with_message_history.invoke({"input": input_str, "context": system_prompt},
-                                          config={'configurable': {'session_id': 'test'}})
+    retrieval_chain = get_chain("docs_and_history", retriever, temperature=temperature)
+    message = _invoke("docs_and_history", retrieval_chain, {"input": input_str, "context": system_prompt,
+                                                            "chat_history": _history_messages(chat_history_func),
+                                                            "chatid": chatid, "userid": userid})
+    return message['answer'].strip()
+
+
+async def agenerate(input_str, system_prompt=None, chat_history_func=None, retriever=None, temperature=0.7, chatid=None,
+                    userid=None):
+    """
+    Awaitable version of generate(). Routes the text generation process based on the provided parameters.
+
+    Parameters:
+    - input_str: The input string to generate text from.
+    - system_prompt (str, optional): System prompt for text generation. Default is None.
+    - chat_history_func (func, optional): Function to provide chat history. Default is None.
+    - retriever (optional): Retriever for Retrival Augmented Generation (RAG). Default is None.
+    - temperature (float, optional): Parameter controlling the randomness of the response generation. Default is 0.7.
+    - chatid (str, optional): The ID of the chat, to reuse its last retrieval (see set_conversation_cache()). Default is None.
+    - userid (str, optional): The ID of the user the chat belongs to; retrievals are reused per (userid, chatid). Default is None.
+
+    Returns:
+    - The generated text based on the input and optional parameters.
+    """
+    if chat_history_func and retriever:
+        return await agenerate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func,
+                                                     temperature=temperature, chatid=chatid, userid=userid)
+    elif chat_history_func:
+        return await agenerate_with_history(input_str, system_prompt, chat_history_func, temperature=temperature)
+    elif retriever:
+        return await agenerate_with_docs(input_str, system_prompt, retriever, temperature=temperature)
+    else:
+        return await agenerate_base(input_str, '' if system_prompt is None else system_prompt, temperature=temperature)
+
+
+async def agenerate_base(input_str, system_prompt, temperature=0.7):
+    """
+    Internal Function, used by agenerate() function. You likely want to use agenerate() instead.
+    """
+    chain = get_chain("base", temperature=temperature)
+    message = await _ainvoke("base", chain, {"input": input_str, "system_prompt": system_prompt, "history": []})
+    return message["text"].strip()
+
+
+async def agenerate_with_docs(input_str, system_prompt, retriever, temperature=0.7):
+    """
+    Internal Function, used by agenerate() function. You likely want to use agenerate() instead.
+    """
+    retrieval_chain = get_chain("docs", retriever, temperature=temperature)
+    message = await _ainvoke("docs", retrieval_chain, {"input": input_str, "context": system_prompt})
     return message['answer'].strip()
 
+
+async def agenerate_with_history(input_str, system_prompt, chat_history_func, temperature=0.7):
+    """
+    Internal Function, used by agenerate() function. You likely want to use agenerate() instead.
+    """
+    chain = get_chain("history", temperature=temperature)
+    message = await _ainvoke("history", chain, {"input": input_str, "system_prompt": system_prompt,
+                                                "history": _history_messages(chat_history_func)})
+    return message['text'].strip()
+
+
+async def agenerate_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=0.7, chatid=None,
+                                          userid=None):
+    """
+    Internal Function, used by agenerate() function. You likely want to use agenerate() instead.
+    """
+    retrieval_chain = get_chain("docs_and_history", retriever, temperature=temperature)
+    message = await _ainvoke("docs_and_history", retrieval_chain, {"input": input_str, "context": system_prompt,
+                                                                   "chat_history": _history_messages(chat_history_func),
+                                                                   "chatid": chatid, "userid": userid})
+    return message['answer'].strip()
+
+
+def stream_with_docs(input_str, system_prompt, retriever, temperature=0.7):
+    """
+    Streaming version of generate_with_docs().
+
+    Yields:
+    - dict: {"context": [Document, ...]} once the documents are retrieved, then {"answer": str} for every answer token.
+    """
+    retrieval_chain = get_chain("docs", retriever, temperature=temperature)
+    for chunk in _stream("docs", retrieval_chain, {"input": input_str, "context": system_prompt}):
+        if "context" in chunk or "answer" in chunk:
+            yield chunk
+
+
+async def astream_with_docs(input_str, system_prompt, retriever, temperature=0.7):
+    """
+    Async streaming version of generate_with_docs(). Yields the same chunks as stream_with_docs().
+    """
+    retrieval_chain = get_chain("docs", retriever, temperature=temperature)
+    async for chunk in _astream("docs", retrieval_chain, {"input": input_str, "context": system_prompt}):
+        if "context" in chunk or "answer" in chunk:
+            yield chunk
+
+
+def stream_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=0.7, chatid=None,
+                                 userid=None):
+    """
+    Streaming version of generate_with_docs_and_history().
+
+    Yields:
+    - dict: {"context": [Document, ...]} once the documents are retrieved, then {"answer": str} for every answer token.
+    """
+    retrieval_chain = get_chain("docs_and_history", retriever, temperature=temperature)
+    for chunk in _stream("docs_and_history", retrieval_chain, {"input": input_str, "context": system_prompt,
+                                                               "chat_history": _history_messages(chat_history_func),
+                                                               "chatid": chatid, "userid": userid}):
+        if "context" in chunk or "answer" in chunk:
+            yield chunk
+
+
+async def astream_with_docs_and_history(input_str, system_prompt, retriever, chat_history_func, temperature=0.7, chatid=None,
+                                        userid=None):
+    """
+    Async streaming version of generate_with_docs_and_history(). Yields the same chunks as stream_with_docs_and_history().
+    """
+    retrieval_chain = get_chain("docs_and_history", retriever, temperature=temperature)
+    async for chunk in _astream("docs_and_history", retrieval_chain, {"input": input_str, "context": system_prompt,
+                                                                      "chat_history": _history_messages(chat_history_func),
+                                                                      "chatid": chatid, "userid": userid}):
+        if "context" in chunk or "answer" in chunk:
+            yield chunk
@@ -0,0 +1,279 @@
+from langchain_core.callbacks import BaseCallbackHandler
+import threading
+import json
+import time
+import sys
+
+# Request stages instrumented across the package: "chat" (one run_chat turn), "profanity", "embedding", "retrieval",
+# "conversation_retrieval", "llm", "context_packing", "summarize", "parse", "quiz_attempt", "quiz_chunk", "grade_quiz",
+# "grading", "code_run", "llm_queue" (time waiting for the LLM scheduler), and "coalesce_generate_quiz",
+# "coalesce_get_similar" and "rubric_extraction" (collapsed=1 for requests that joined an identical request in flight).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # histogram buckets, in seconds
+METRIC_PREFIX = "main_agent"
+
+# Opt-in span sink, see enable_tracing(). While it is None every span is a shared no-op.
+sink = None
+
+
+class Span:
+    """
+    A timed request stage. Used as a context manager (see span()); on exit it records its duration, the exception
+    type if the stage failed, and its attributes (i.e. token or retry counts) to the sink it was created for.
+    """
+
+    __slots__ = ("stage", "attributes", "start", "duration", "error", "_sink")
+
+    def __init__(self, stage, attributes, sink):
+        self.stage = stage
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.error = None
+        self._sink = sink
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self._sink.record(self)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, value=1):
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+
+class _NoopSpan:
+    # Returned by span() while tracing is disabled. Falsy, so callers can skip computing expensive attributes.
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, value=1):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(stage, **attributes):
+    """
+    Returns a context manager timing one stage of a request, i.e. `with span("parse", questions=10) as s:`.
+    While tracing is disabled this is a shared no-op object, so instrumentation costs one function call.
+
+    Parameters:
+    - stage (str): The stage name.
+    - **attributes: Initial attributes. Numeric attributes are summed per stage by PrometheusSink.
+
+    Returns:
+    - Span: The span (falsy if tracing is disabled). Add attributes with .set(name=value) or .add(name, value).
+    """
+    current = sink
+    if current is None:
+        return _NOOP_SPAN
+    return Span(stage, attributes, current)
+
+
+def record(stage, duration, error=None, **attributes):
+    """Records a stage that was timed elsewhere (i.e. by a callback). Does nothing while tracing is disabled."""
+    current = sink
+    if current is None:
+        return
+    finished = Span(stage, attributes, current)
+    finished.duration = duration
+    finished.error = error
+    current.record(finished)
+
+
+class PrometheusSink:
+    """
+    Aggregates spans into Prometheus-style metrics: a <prefix>_stage_total{stage, status} counter, a
+    <prefix>_stage_seconds{stage} histogram, and a <prefix>_<attribute>_total{stage} counter per numeric attribute.
+    render() returns them in the Prometheus text exposition format, i.e. for a /metrics endpoint.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix=METRIC_PREFIX):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counts = {} # (stage, status) -> count
+        self._histograms = {} # stage -> [count per bucket, sum, count]
+        self._totals = {} # (stage, attribute) -> sum
+
+    def record(self, span):
+        with self._lock:
+            status = "ok" if span.error is None else "error"
+            self._counts[(span.stage, status)] = self._counts.get((span.stage, status), 0) + 1
+
+            histogram = self._histograms.get(span.stage)
+            if histogram is None:
+                histogram = self._histograms[span.stage] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += span.duration
+            histogram[2] += 1
+
+            for name, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._totals[(span.stage, name)] = self._totals.get((span.stage, name), 0) + value
+
+    def snapshot(self):
+        """
+        Returns:
+        - dict: stage -> {"count", "errors", "seconds" (total), and the total of every numeric attribute}.
+        """
+        with self._lock:
+            stages = {}
+            for (stage, status), count in self._counts.items():
+                stats = stages.setdefault(stage, {"count": 0, "errors": 0, "seconds": self._histograms[stage][1]})
+                stats["count"] += count
+                if status == "error":
+                    stats["errors"] += count
+            for (stage, name), total in self._totals.items():
+                stages[stage][name] = total
+            return stages
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            lines = ["# TYPE " + self.prefix + "_stage_total counter"]
+            for (stage, status), count in sorted(self._counts.items()):
+                lines.append(self.prefix + '_stage_total{stage="' + stage + '",status="' + status + '"} ' + str(count))
+
+            lines.append("# TYPE " + self.prefix + "_stage_seconds histogram")
+            for stage, (bucket_counts, total, count) in sorted(self._histograms.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(self.prefix + '_stage_seconds_bucket{stage="' + stage + '",le="' + str(bound) + '"} ' + str(bucket_count))
+                lines.append(self.prefix + '_stage_seconds_bucket{stage="' + stage + '",le="+Inf"} ' + str(count))
+                lines.append(self.prefix + '_stage_seconds_sum{stage="' + stage + '"} ' + repr(total))
+                lines.append(self.prefix + '_stage_seconds_count{stage="' + stage + '"} ' + str(count))
+
+            for name in sorted({name for _, name in self._totals}):
+                lines.append("# TYPE " + self.prefix + "_" + name + "_total counter")
+                for (stage, attribute), total in sorted(self._totals.items()):
+                    if attribute == name:
+                        lines.append(self.prefix + "_" + name + '_total{stage="' + stage + '"} ' + str(total))
+            return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._histograms.clear()
+            self._totals.clear()
+
+
+class JsonLinesSink:
+    """Writes every span as one JSON object per line ({"stage", "seconds", "error", and its attributes}), i.e. to a log file."""
+
+    def __init__(self, stream=None):
+        """
+        Parameters:
+        - stream (file, optional): Text stream to write to. Defaults to sys.stderr.
+        """
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        line = json.dumps(dict(span.attributes, stage=span.stage, seconds=span.duration, error=span.error), default=str)
+        with self._lock:
+            (self.stream or sys.stderr).write(line + "\n")
+
+
+def enable_tracing(new_sink=None):
+    """
+    Turns on span recording for every instrumented stage.
+
+    Parameters:
+    - new_sink (optional): Any object with a record(span) method. Defaults to a new PrometheusSink.
+
+    Returns:
+    - The sink.
+    """
+    global sink
+    sink = new_sink if new_sink is not None else PrometheusSink()
+    return sink
+
+
+def disable_tracing():
+    global sink
+    sink = None
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler that records the retrieval and LLM calls made inside chains as "retrieval" and "llm"
+    spans. LLM spans carry prompt_tokens and completion_tokens from the API's token usage, or estimated with
+    utils.chat_history.count_tokens when the model does not report usage (i.e. when streaming).
+    """
+
+    run_inline = True # record in the caller's thread/event loop, not in an executor
+
+    def __init__(self):
+        self._runs = {} # run_id -> (start, prompt text)
+
+    def _start(self, run_id, prompt=""):
+        self._runs[run_id] = (time.perf_counter(), prompt)
+
+    def _finish(self, run_id):
+        start, prompt = self._runs.pop(run_id, (None, ""))
+        return (time.perf_counter() - start if start is not None else 0.0), prompt
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        record("retrieval", self._finish(run_id)[0], documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        record("retrieval", self._finish(run_id)[0], error=type(error).__name__)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "\n".join(str(message.content) for batch in messages for message in batch))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "\n".join(prompts))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        duration, prompt = self._finish(run_id)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if "prompt_tokens" in usage:
+            prompt_tokens, completion_tokens = usage["prompt_tokens"], usage.get("completion_tokens", 0)
+        else:
+            from .chat_history import count_tokens
+            completion = "".join(generation.text for generations in response.generations for generation in generations)
+            prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(completion)
+        record("llm", duration, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        record("llm", self._finish(run_id)[0], error=type(error).__name__)
+
+
+_callback_handler = TracingCallbackHandler()
+
+
+def chain_config():
+    """Returns the config to pass to a chain's invoke()/stream() so its retrieval and LLM calls are traced, or None while tracing is disabled."""
+    if sink is None:
+        return None
+    return {"callbacks": [_callback_handler]}
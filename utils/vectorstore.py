@@ -1,23 +1,270 @@
-from langchain_community.vectorstores.pgvector import PGVector
-from langchain_openai import OpenAIEmbeddings
+# PGVector, OpenAIEmbeddings and sqlalchemy are imported on first use, they are slow to import
+import threading
+import asyncio
+import atexit
+import os
 
+from .embeddings_cache import CachedEmbeddings
+from .mmap_vectorstore import MmapVectorStore, default_index_path
 
-def load_vectorstore_helper(connection_string, collection_name="embeddings", embeddings_function=OpenAIEmbeddings()):
+# "pgvector" queries Postgres; "mmap" answers queries in process from a memory-mapped export of the collection
+# (see utils.mmap_vectorstore, export it with python -m utils.mmap_vectorstore --collection <name>)
+VECTORSTORE_BACKEND = os.getenv("VECTORSTORE_BACKEND", "pgvector")
+
+# Connection pool settings shared by every pooled vector store engine. pool_pre_ping checks each connection
+# before it is handed out, so connections dropped by the database are replaced instead of failing a request.
+DEFAULT_ENGINE_ARGS = {
+    "pool_size": 5,
+    "max_overflow": 5,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+
+# Process-wide registry: one engine per connection string, one PGVector per (connection string, collection name) and
+# one MmapVectorStore per ("mmap", collection name)
+_engines = {}
+_vectorstores = {}
+_registry_lock = threading.Lock()
+_query_embeddings = None
+
+
+def _connection_string(host, port, driver, user, password, database):
+    # Same format as PGVector.connection_string_from_db_params, without importing PGVector
+    return f"postgresql+{driver}://{user}:{password}@{host}:{port}/{database}"
+
+
+def load_vectorstore_helper(connection_string, collection_name="embeddings", embeddings_function=None,
+                            connection=None):
+    from langchain_community.vectorstores.pgvector import PGVector
+
+    if embeddings_function is None:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings_function = OpenAIEmbeddings()
     return PGVector(
         collection_name=collection_name,
         connection_string=connection_string,
         embedding_function=embeddings_function,
+        connection=connection,
     )
 
 
 def load_vectorstore(host="localhost", port=5432, driver="psycopg2", user="postgres", password="postgres",
-                     database="postgres", collection_name="embeddings"):
-    connection_string = PGVector.connection_string_from_db_params(
-        driver=driver,
-        host=host,
-        port=port,
-        database=database,
-        user=user,
-        password=password,
-    )
+                     database="postgres", collection_name="embeddings", backend="pgvector", index_path=None):
+    """
+    Loads a collection from Postgres, or with backend="mmap" from its memory-mapped export.
+
+    Parameters:
+    - host, port, driver, user, password, database: Postgres connection parameters (unused by the "mmap" backend).
+    - collection_name (str, optional): The collection to load. Defaults to "embeddings".
+    - backend (str, optional): "pgvector" or "mmap". Defaults to "pgvector".
+    - index_path (str, optional): Directory of the "mmap" store. Defaults to default_index_path(collection_name).
+
+    Returns:
+    - PGVector or MmapVectorStore: The vector store.
+    """
+    if backend == "mmap":
+        from langchain_openai import OpenAIEmbeddings
+        return MmapVectorStore(index_path or default_index_path(collection_name), OpenAIEmbeddings())
+    if backend != "pgvector":
+        raise ValueError("Unknown vector store backend: " + str(backend))
+
+    connection_string = _connection_string(host=host, port=port, driver=driver, user=user, password=password,
+                                           database=database)
     return load_vectorstore_helper(connection_string, collection_name)
+
+
+def get_query_embeddings():
+    """
+    Returns the process-wide caching embeddings function used by the shared vector stores, so repeated questions and
+    topics are not sent to the OpenAI embeddings API again. Use .stats() on it for hit/miss counters.
+    """
+    global _query_embeddings
+    with _registry_lock:
+        if _query_embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+            _query_embeddings = CachedEmbeddings(OpenAIEmbeddings())
+        return _query_embeddings
+
+
+def _registry_key(backend, connection_string, collection_name):
+    if backend == "mmap":
+        return ("mmap", collection_name)
+    if backend != "pgvector":
+        raise ValueError("Unknown vector store backend: " + str(backend))
+    return (connection_string, collection_name)
+
+
+def get_shared_vectorstore(host="localhost", port=5432, driver="psycopg2", user="postgres", password="postgres",
+                           database="postgres", collection_name="embeddings", engine_args=None, backend=None):
+    """
+    Returns the process-wide vector store for the given connection parameters and collection, building it on first use.
+
+    Unlike load_vectorstore(), repeated calls do not open a new engine or look the collection up again. All
+    collections on the same database share one bounded connection pool. Safe to call from multiple threads.
+
+    Parameters:
+    - host, port, driver, user, password, database: Postgres connection parameters (see load_vectorstore()).
+    - collection_name (str, optional): The collection to load. Defaults to "embeddings".
+    - engine_args (dict, optional): SQLAlchemy engine/pool arguments, only used when the engine is first created.
+      Defaults to DEFAULT_ENGINE_ARGS.
+    - backend (str, optional): "pgvector" or "mmap" (the collection's store at default_index_path()). Defaults to
+      VECTORSTORE_BACKEND.
+
+    Returns:
+    - PGVector or MmapVectorStore: The shared vector store.
+    """
+    backend = backend or VECTORSTORE_BACKEND
+    connection_string = _connection_string(host=host, port=port, driver=driver, user=user, password=password,
+                                           database=database)
+    key = _registry_key(backend, connection_string, collection_name)
+    embeddings_function = get_query_embeddings()
+
+    with _registry_lock:
+        vectorstore = _vectorstores.get(key)
+        if vectorstore is None and backend == "mmap":
+            vectorstore = MmapVectorStore(default_index_path(collection_name), embeddings_function)
+            _vectorstores[key] = vectorstore
+        elif vectorstore is None:
+            engine = _engines.get(connection_string)
+            if engine is None:
+                import sqlalchemy
+                engine = sqlalchemy.create_engine(connection_string, **(engine_args or DEFAULT_ENGINE_ARGS))
+                _engines[connection_string] = engine
+            vectorstore = load_vectorstore_helper(connection_string, collection_name, embeddings_function,
+                                                  connection=engine)
+            _vectorstores[key] = vectorstore
+
+    return vectorstore
+
+
+async def aget_shared_vectorstore(**kwargs):
+    """
+    Awaitable version of get_shared_vectorstore(). Takes the same keyword arguments.
+
+    The registry lookup is done inline; only the first call for a collection, which connects and looks the collection
+    up, runs in a worker thread so it does not block the event loop.
+    """
+    params = {"host": "localhost", "port": 5432, "driver": "psycopg2", "user": "postgres", "password": "postgres",
+              "database": "postgres"}
+    params.update({k: v for k, v in kwargs.items() if k in params})
+    key = _registry_key(kwargs.get("backend") or VECTORSTORE_BACKEND, _connection_string(**params),
+                        kwargs.get("collection_name", "embeddings"))
+
+    vectorstore = _vectorstores.get(key)
+    if vectorstore is None:
+        vectorstore = await asyncio.to_thread(get_shared_vectorstore, **kwargs)
+    return vectorstore
+
+
+def _candidates_statement(vectorstore, collection_uuid, embeddings, fetch_k):
+    # One "top fetch_k rows by distance" select per query embedding, combined with UNION ALL into a single statement
+    import sqlalchemy
+
+    store = vectorstore.EmbeddingStore
+    selects = []
+    for i, embedding in enumerate(embeddings):
+        distance = vectorstore.distance_strategy(embedding).label("distance")
+        subquery = (
+            sqlalchemy.select(sqlalchemy.literal(i).label("query_index"), store.uuid, store.document, store.cmetadata,
+                              store.embedding, distance)
+            .where(store.collection_id == collection_uuid)
+            .order_by(sqlalchemy.asc("distance"))
+            .limit(fetch_k)
+            .subquery()
+        )
+        selects.append(sqlalchemy.select(subquery))
+    return sqlalchemy.union_all(*selects)
+
+
+def supports_batch_search(vectorstore):
+    """Whether search_candidates_by_vectors() can search the vector store (a PGVector collection or a MmapVectorStore)."""
+    if isinstance(vectorstore, MmapVectorStore):
+        return True
+    from langchain_community.vectorstores.pgvector import PGVector
+    return isinstance(vectorstore, PGVector)
+
+
+def search_candidates_by_vectors(vectorstore, embeddings, fetch_k=20):
+    """
+    Fetches the nearest fetch_k rows for each of several query embeddings from a PGVector collection in a single
+    database round trip (or from a MmapVectorStore in process).
+
+    Parameters:
+    - vectorstore (PGVector or MmapVectorStore): The vector store to search.
+    - embeddings (list): The query embeddings.
+    - fetch_k (int, optional): Number of candidates to fetch per query embedding. Defaults to 20.
+
+    Returns:
+    - list: For each query embedding, a list of (Document, embedding, id) tuples ordered by distance.
+    """
+    if isinstance(vectorstore, MmapVectorStore):
+        return vectorstore.search_candidates_by_vectors(embeddings, fetch_k)
+
+    from langchain_core.documents import Document
+    from sqlalchemy.orm import Session
+
+    results = [[] for _ in embeddings]
+    if not embeddings:
+        return results
+
+    with Session(vectorstore._bind) as session:
+        collection = vectorstore.get_collection(session)
+        if not collection:
+            raise ValueError("Collection not found")
+        rows = session.execute(_candidates_statement(vectorstore, collection.uuid, embeddings, fetch_k)).all()
+
+    for row in sorted(rows, key=lambda row: (row.query_index, row.distance)):
+        document = Document(page_content=row.document, metadata=row.cmetadata)
+        results[row.query_index].append((document, row.embedding, str(row.uuid)))
+
+    return results
+
+
+def check_vectorstores():
+    """
+    Runs a trivial query against every pooled engine. Engines that fail are disposed and dropped from the registry
+    (together with their vector stores) so the next get_shared_vectorstore() call rebuilds them.
+
+    Returns:
+    - dict: Maps each connection string to True if healthy, False otherwise.
+    """
+    with _registry_lock:
+        engines = dict(_engines)
+
+    import sqlalchemy
+
+    health = {}
+    for connection_string, engine in engines.items():
+        try:
+            with engine.connect() as connection:
+                connection.execute(sqlalchemy.text("SELECT 1"))
+            health[connection_string] = True
+        except Exception as e:
+            print("ERROR: vector store health check failed: " + str(e))
+            health[connection_string] = False
+            with _registry_lock:
+                if _engines.get(connection_string) is engine:
+                    del _engines[connection_string]
+                    for key in [key for key in _vectorstores if key[0] == connection_string]:
+                        del _vectorstores[key]
+            engine.dispose()
+
+    return health
+
+
+def close_vectorstores():
+    """
+    Disposes every pooled engine and empties the registry. Called automatically at interpreter exit; call it
+    explicitly when shutting a worker down or after forking.
+    """
+    with _registry_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+        _vectorstores.clear()
+
+    for engine in engines:
+        engine.dispose()
+
+
+atexit.register(close_vectorstores)